@@ -0,0 +1,340 @@
+# -*- coding: utf-8 -*-
+"""
+异步网页服务入口（ASYNC_SERVER=True 时使用，需要安装 aiohttp）
+搜索、状态和媒体文件接口在事件循环中处理：搜索和推理在线程池中执行，文件通过 aiohttp 非阻塞发送（支持 Range），
+等待视频片段截取不占用线程。其它接口（页面、登录、上传、扫描等）转交给原有的 flask 应用在线程池中处理。
+"""
+import asyncio
+import base64
+import io
+import logging
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote
+
+from aiohttp import web
+from itsdangerous import BadSignature
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header, parse_etags
+
+from app.config import *
+from app.main import app, create_video_clip_job, get_status_info, match
+from app.models.database import get_image_path_time_checksum_by_id, get_video_path_time_checksum_by_id, is_video_exist
+from app.models.models import DatabaseSession
+from app.services.clip_cache import clip_job_manager
+from app.services.process_assets import get_video_poster
+from app.services.thumbnail_cache import (
+    THUMBNAIL_MIMETYPES,
+    THUMBNAIL_SIZE,
+    choose_thumbnail_format,
+    get_poster_key,
+    poster_cache,
+    thumbnail_cache,
+)
+from app.services.utils import resize_image_with_aspect_ratio
+
+logger = logging.getLogger(__name__)
+
+# 搜索和推理使用的线程池，numpy/torch 计算时会释放 GIL。数据库查询、缩略图和 flask 接口使用事件循环默认的线程池
+search_executor = ThreadPoolExecutor(max_workers=ASYNC_SEARCH_THREADS, thread_name_prefix="search")
+
+
+def run_in_executor(func, *args, executor=None):
+    """在线程池中执行阻塞的函数"""
+    return asyncio.get_running_loop().run_in_executor(executor, func, *args)
+
+
+def load_session(request: web.Request) -> dict:
+    """读取 flask 的 session cookie，与 flask 接口共用登录状态和上传文件路径"""
+    cookie = request.cookies.get(app.config["SESSION_COOKIE_NAME"])
+    if not cookie:
+        return {}
+    serializer = app.session_interface.get_signing_serializer(app)
+    try:
+        return serializer.loads(cookie, max_age=int(app.permanent_session_lifetime.total_seconds()))
+    except BadSignature:
+        return {}
+
+
+def save_session(response: web.StreamResponse, data: dict):
+    """把修改后的 session 写回 cookie"""
+    serializer = app.session_interface.get_signing_serializer(app)
+    response.set_cookie(app.config["SESSION_COOKIE_NAME"], serializer.dumps(dict(data)), path="/", httponly=True)
+
+
+def login_required(handler):
+    """与 flask 的 login_required 相同，未登录时重定向到登录页面"""
+
+    async def wrapper(request: web.Request):
+        if ENABLE_LOGIN and "username" not in load_session(request):
+            raise web.HTTPFound("/login")
+        return await handler(request)
+
+    return wrapper
+
+
+def if_none_match(request: web.Request, etag: str) -> bool:
+    """浏览器缓存的版本是否与 etag 相同"""
+    return parse_etags(request.headers.get("If-None-Match")).contains(etag)
+
+
+def read_cached_image(cache, key: str, fmt: str, create_image) -> bytes:
+    """读取缓存的缩略图或预览图，没有缓存时生成。缩略图很小，直接读入内存返回"""
+    file = cache.get_or_create(key, fmt, create_image)
+    if isinstance(file, io.BytesIO):
+        return file.getvalue()
+    with open(file, "rb") as f:
+        return f.read()
+
+
+def cached_image_response(content, etag: str, mimetype: str) -> web.Response:
+    """
+    返回缩略图或预览图，带 ETag，浏览器缓存的版本相同时返回 304
+    :param content: bytes, 图片内容，为 None 时返回 304
+    """
+    if content is None:
+        response = web.Response(status=304)
+    else:
+        response = web.Response(body=content, content_type=mimetype)
+    response.headers["ETag"] = f'"{etag}"'
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+async def wait_clip_job(job, timeout: float = None) -> bool:
+    """
+    等待截取任务结束，定期检查任务状态，不占用线程
+    :param timeout: float, 最长等待秒数，None表示一直等待
+    :return: bool, 任务是否已结束
+    """
+    loop = asyncio.get_running_loop()
+    deadline = None if timeout is None else loop.time() + timeout
+    while not job.done.is_set() and (deadline is None or loop.time() < deadline):
+        await asyncio.sleep(0.1)
+    return job.done.is_set()
+
+
+@login_required
+async def api_match(request: web.Request):
+    """匹配文字对应的素材，与 flask 的 /api/match 相同"""
+    try:
+        data = await request.json()
+    except ValueError:
+        data = None
+    session = load_session(request)
+    result, status, upload_used = await run_in_executor(
+        match, data, session.get("upload_file_path", ""), executor=search_executor)
+    if isinstance(result, str):
+        response = web.Response(text=result, status=status)
+    else:
+        response = web.json_response(result, status=status)
+    if upload_used:  # 只有在使用上传文件时才清空session
+        session["upload_file_path"] = ""
+        save_session(response, session)
+    return response
+
+
+@login_required
+async def api_status(request: web.Request):
+    """状态"""
+    return web.json_response(await run_in_executor(get_status_info))
+
+
+@login_required
+async def api_get_image(request: web.Request):
+    """读取图片，与 flask 的 /api/get_image 相同"""
+    image_id = int(request.match_info["image_id"])
+
+    def get_record():
+        with DatabaseSession() as session:
+            return get_image_path_time_checksum_by_id(session, image_id)
+
+    record = await run_in_executor(get_record)
+    if record is None:
+        raise web.HTTPNotFound()
+    path, modify_time, checksum = record
+    if request.query.get("thumbnail") != "1" or os.path.splitext(path)[-1].lower() == ".gif":
+        return web.FileResponse(path)
+    fmt = choose_thumbnail_format(parse_accept_header(request.headers.get("Accept"), MIMEAccept))
+    key = thumbnail_cache.get_key(image_id, modify_time, checksum, fmt)
+    thumbnail = None
+    if not if_none_match(request, key):
+        thumbnail = await run_in_executor(
+            read_cached_image, thumbnail_cache, key, fmt, lambda: resize_image_with_aspect_ratio(path, THUMBNAIL_SIZE))
+    response = cached_image_response(thumbnail, key, THUMBNAIL_MIMETYPES[fmt])
+    response.headers["Vary"] = "Accept"
+    return response
+
+
+@login_required
+async def api_get_video(request: web.Request):
+    """读取视频，支持 Range 请求"""
+    path = base64.urlsafe_b64decode(request.match_info["video_path"]).decode()
+
+    def exists():
+        with DatabaseSession() as session:
+            return is_video_exist(session, path)
+
+    if not await run_in_executor(exists):  # 如果路径不在数据库中，则返回404，防止任意文件读取攻击
+        raise web.HTTPNotFound()
+    return web.FileResponse(path)
+
+
+@login_required
+async def api_get_video_frame(request: web.Request):
+    """读取视频预览图"""
+    video_id, frame_time = int(request.match_info["video_id"]), int(request.match_info["frame_time"])
+
+    def get_record():
+        with DatabaseSession() as session:
+            return get_video_path_time_checksum_by_id(session, video_id)
+
+    record = await run_in_executor(get_record)
+    if record is None:
+        raise web.HTTPNotFound()
+    path, modify_time, checksum = record
+    key = get_poster_key(path, frame_time, modify_time, checksum)
+    poster = None
+    if not if_none_match(request, key):
+        def create_poster():  # 扫描时没有保存或已被淘汰，从视频中读取这一帧
+            image = get_video_poster(path, frame_time)
+            if image is None:
+                raise web.HTTPNotFound()
+            return image
+
+        poster = await run_in_executor(read_cached_image, poster_cache, key, "jpeg", create_poster)
+    return cached_image_response(poster, key, "image/jpeg")
+
+
+async def send_video_clip(job) -> web.StreamResponse:
+    """等待任务完成并返回视频片段，截取失败时返回500"""
+    await wait_clip_job(job)
+    file_path = await run_in_executor(clip_job_manager.get_file, job)
+    if file_path is None:
+        if job.status == job.DONE:  # 刚好被淘汰，重新截取
+            return await send_video_clip(await run_in_executor(clip_job_manager.submit_again, job))
+        raise web.HTTPInternalServerError()
+    return web.FileResponse(file_path, headers={
+        "Content-Disposition": f"inline; filename*=UTF-8''{quote(job.download_name)}"})
+
+
+async def submit_video_clip_job(request: web.Request):
+    """根据请求路径提交截取任务，视频不在数据库中时返回404"""
+    job = await run_in_executor(
+        create_video_clip_job, request.match_info["video_path"],
+        int(request.match_info["start_time"]), int(request.match_info["end_time"]))
+    if job is None:
+        raise web.HTTPNotFound()
+    return job
+
+
+@login_required
+async def api_download_video_clip(request: web.Request):
+    """下载视频片段，等待后台截取完成后返回"""
+    return await send_video_clip(await submit_video_clip_job(request))
+
+
+@login_required
+async def api_create_video_clip_job(request: web.Request):
+    """提交截取视频片段的任务，立即返回"""
+    return web.json_response((await submit_video_clip_job(request)).to_dict())
+
+
+@login_required
+async def api_get_video_clip_job(request: web.Request):
+    """查询截取任务的状态，wait 参数为任务未结束时最多等待的秒数"""
+    job = clip_job_manager.get_job(request.match_info["job_id"])
+    if job is None:
+        raise web.HTTPNotFound()
+    try:
+        wait = float(request.query.get("wait", 0))
+    except ValueError:
+        wait = 0
+    if wait > 0:
+        await wait_clip_job(job, min(wait, 60))
+    return web.json_response(job.to_dict())
+
+
+@login_required
+async def api_get_video_clip(request: web.Request):
+    """下载截取任务生成的视频片段，任务未结束时等待完成"""
+    job = clip_job_manager.get_job(request.match_info["job_id"])
+    if job is None:
+        raise web.HTTPNotFound()
+    return await send_video_clip(job)
+
+
+async def handle_wsgi(request: web.Request):
+    """把其它请求转交给 flask 应用，在线程池中执行"""
+    body = await request.read()
+    environ = {
+        "REQUEST_METHOD": request.method,
+        "SCRIPT_NAME": "",
+        "PATH_INFO": request.path.encode("utf-8").decode("latin-1"),
+        "QUERY_STRING": request.query_string,
+        "SERVER_NAME": HOST,
+        "SERVER_PORT": str(PORT),
+        "SERVER_PROTOCOL": f"HTTP/{request.version.major}.{request.version.minor}",
+        "REMOTE_ADDR": request.remote or "",
+        "wsgi.version": (1, 0),
+        "wsgi.url_scheme": request.scheme,
+        "wsgi.input": io.BytesIO(body),
+        "wsgi.errors": sys.stderr,
+        "wsgi.multithread": True,
+        "wsgi.multiprocess": False,
+        "wsgi.run_once": False,
+        "CONTENT_LENGTH": str(len(body)),
+    }
+    if "Content-Type" in request.headers:
+        environ["CONTENT_TYPE"] = request.headers["Content-Type"]
+    for name, value in request.headers.items():
+        key = "HTTP_" + name.upper().replace("-", "_")
+        if key not in ("HTTP_CONTENT_TYPE", "HTTP_CONTENT_LENGTH"):
+            environ[key] = f"{environ[key]},{value}" if key in environ else value
+    response = {}
+
+    def start_response(status, headers, exc_info=None):
+        response["status"] = int(status.split(" ", 1)[0])
+        response["headers"] = headers
+
+    def call():
+        result = app(environ, start_response)
+        try:
+            return b"".join(result)
+        finally:
+            if hasattr(result, "close"):
+                result.close()
+
+    content = await run_in_executor(call)
+    headers = [(name, value) for name, value in response["headers"] if name.lower() != "content-length"]
+    return web.Response(status=response["status"], headers=headers, body=content)
+
+
+def create_async_app() -> web.Application:
+    """创建异步应用，未在这里注册的路由由 flask 处理"""
+    async_app = web.Application(client_max_size=1024 ** 3)
+    async_app.router.add_post("/api/match", api_match)
+    async_app.router.add_get("/api/status", api_status)
+    async_app.router.add_get("/api/get_image/{image_id:\\d+}", api_get_image)
+    async_app.router.add_get("/api/get_video/{video_path}", api_get_video)
+    async_app.router.add_get("/api/get_video_frame/{video_id:\\d+}/{frame_time:\\d+}", api_get_video_frame)
+    async_app.router.add_get(
+        "/api/download_video_clip/{video_path}/{start_time:\\d+}/{end_time:\\d+}", api_download_video_clip)
+    async_app.router.add_route(
+        "*", "/api/video_clip_job/{video_path}/{start_time:\\d+}/{end_time:\\d+}", api_create_video_clip_job)
+    async_app.router.add_get("/api/video_clip_job/{job_id}", api_get_video_clip_job)
+    async_app.router.add_get("/api/get_video_clip/{job_id}", api_get_video_clip)
+    async_app.router.add_route("*", "/{tail:.*}", handle_wsgi)
+    return async_app
+
+
+def run_async_server(sock=None):
+    """
+    启动异步网页服务
+    :param sock: 监听套接字，多进程模式下由主进程创建；为 None 时监听 HOST:PORT
+    """
+    if sock is None:
+        web.run_app(create_async_app(), host=HOST, port=PORT, print=None)
+    else:
+        web.run_app(create_async_app(), sock=sock, print=None, handle_signals=False)
@@ -1,11 +1,13 @@
-import importlib.util
 import os
 
-import torch
-
 # *****服务器配置*****
 HOST = os.getenv('HOST', '127.0.0.1')  # 监听IP，如果想允许远程访问，把这个改成0.0.0.0
 PORT = int(os.getenv('PORT', 8085))  # 监听端口
+SERVE_WORKERS = int(os.getenv('SERVE_WORKERS', 0))  # 网页服务的工作进程数，大于1时使用多进程模式（仅Linux/macOS）：主进程负责扫描并把特征发布到共享索引，工作进程只负责搜索，共用同一份特征内存。0或1表示单进程
+ASYNC_SERVER = os.getenv('ASYNC_SERVER', 'False').lower() == 'true'  # 是否使用异步网页服务（需要安装aiohttp）。搜索和推理在线程池中执行，文件非阻塞发送，等待截取视频片段不占用线程，适合大量用户同时访问
+ASYNC_SEARCH_THREADS = int(os.getenv('ASYNC_SEARCH_THREADS', 4))  # 异步网页服务中执行搜索和推理的线程数
+SHARED_INDEX_PATH = os.getenv('SHARED_INDEX_PATH', './data/shared_index')  # 多进程模式下共享索引的保存目录
+SHARED_INDEX_REFRESH = int(os.getenv('SHARED_INDEX_REFRESH', 10))  # 多进程模式下检查素材变化并重新发布共享索引的间隔，单位秒
 
 # *****扫描配置*****
 # Windows系统的路径写法例子：'D:/照片'
@@ -22,7 +24,15 @@ AUTO_SCAN = os.getenv('AUTO_SCAN', 'False').lower() == 'true'  # 是否自动扫
 AUTO_SCAN_START_TIME = tuple(map(int, os.getenv('AUTO_SCAN_START_TIME', '22:30').split(':')))  # 自动扫描开始时间
 AUTO_SCAN_END_TIME = tuple(map(int, os.getenv('AUTO_SCAN_END_TIME', '8:00').split(':')))  # 自动扫描结束时间
 AUTO_SAVE_INTERVAL = int(os.getenv('AUTO_SAVE_INTERVAL', 100))  # 扫描自动保存间隔，默认为每 100 个文件自动保存一次
+SCAN_WALK_WORKERS = int(os.getenv('SCAN_WALK_WORKERS', 4))  # 遍历目录时并发的线程数，素材在NAS/NFS等远程目录时可以适当调高
+SCAN_FULL_WALK_DAYS = int(os.getenv('SCAN_FULL_WALK_DAYS', 7))  # 目录缓存有效天数。扫描时修改时间没变的目录直接沿用数据库中的文件，不再重新列出；超过这个天数会强制重新遍历一次。0表示不使用目录缓存
+SCAN_STREAMING = os.getenv('SCAN_STREAMING', 'False').lower() == 'true'  # 是否使用流式扫描。开启后按路径顺序边遍历边与数据库比对，不会把所有文件路径读入内存，适合千万级文件；但不支持断点恢复和目录缓存
+STATS_RECONCILE_INTERVAL = int(os.getenv('STATS_RECONCILE_INTERVAL', 600))  # 素材数量统计在增删时同步更新，每隔多少秒重新统计一次数据库以修正误差
 ENABLE_FILE_WATCH = os.getenv('ENABLE_FILE_WATCH', 'True').lower() == 'false'  # 是否启用文件监控，启用后会自动扫描新增或修改的文件，默认开启
+FILE_WATCH_SETTLE_SECONDS = float(os.getenv('FILE_WATCH_SETTLE_SECONDS', 2))  # 文件监控等待文件写完的时间，单位秒。文件大小和修改时间在这段时间内没有变化才会处理，避免读取复制到一半的文件
+FILE_WATCH_MAX_RETRIES = int(os.getenv('FILE_WATCH_MAX_RETRIES', 8))  # 文件一直在变化时推迟处理的最多次数，每次推迟的时间翻倍，超过后放弃，由之后的扫描处理
+FILE_WATCH_MAX_BACKOFF = float(os.getenv('FILE_WATCH_MAX_BACKOFF', 60))  # 推迟处理的最长间隔，单位秒
+FILE_WATCH_QUEUE_SIZE = int(os.getenv('FILE_WATCH_QUEUE_SIZE', 10000))  # 文件监控等待处理的文件数上限，超出后丢弃新的事件，处理完队列后自动扫描一次补上
 
 # *****模型配置*****
 # 更换模型需要删库重新扫描！否则搜索会报错。数据库路径见下面SQLALCHEMY_DATABASE_URL参数。模型越大，扫描速度越慢，且占用的内存和显存越大。
@@ -36,7 +46,19 @@ ENABLE_FILE_WATCH = os.getenv('ENABLE_FILE_WATCH', 'True').lower() == 'false'  #
 # 英文小模型： "openai/clip-vit-base-patch16"
 # 英文大模型："openai/clip-vit-large-patch14-336"
 MODEL_NAME = os.getenv('MODEL_NAME', "OFA-Sys/chinese-clip-vit-base-patch16")  # CLIP模型
-DEVICE = os.getenv('DEVICE', 'auto')  # 推理设备，auto/cpu/cuda/mps
+DEVICE = os.getenv('DEVICE', 'auto')  # 推理设备，auto/cpu/cuda/mps。auto会在第一次加载模型时自动选择，优先级：cuda > mps > directml > cpu
+SEARCH_ONLY = os.getenv('SEARCH_ONLY', 'False').lower() == 'true'  # 仅搜索模式，用于只提供搜索的节点。只加载文字模型，图像模型在第一次以图搜索时才加载；不能扫描，也不启动自动扫描和文件监控
+INFERENCE_PRECISION = os.getenv('INFERENCE_PRECISION', 'fp32').lower()  # 推理精度：fp32/int8/bf16。int8对线性层做动态量化，只支持CPU；bf16使用自动混合精度，支持CPU和部分显卡。不同精度的特征不完全相同，更换后建议重新扫描
+PRECISION_MIN_SIMILARITY = float(os.getenv('PRECISION_MIN_SIMILARITY', 0.98))  # 使用int8/bf16时，加载模型后用样本比较与fp32特征的余弦相似度，低于这个值则回退到fp32
+ENABLE_INFERENCE_WORKER = os.getenv('ENABLE_INFERENCE_WORKER', 'True').lower() == 'true'  # 是否使用共享推理线程。开启后所有推理请求在同一个线程中排队执行，同时到达的搜索请求合并成一批计算，扫描使用另一个低优先级的推理线程
+INFERENCE_BATCH_WAIT_MS = int(os.getenv('INFERENCE_BATCH_WAIT_MS', 5))  # 共享推理线程收到搜索请求后，等待多少毫秒以合并同时到达的其它请求
+INFERENCE_MAX_BATCH = int(os.getenv('INFERENCE_MAX_BATCH', 32))  # 共享推理线程合并请求时，一批最多包含多少张图片或多少条文字
+SCAN_INFERENCE_PROCESSES = int(os.getenv('SCAN_INFERENCE_PROCESSES', 0))  # 扫描时使用多少个推理进程，每个进程加载一份模型，只在CPU推理时生效。0表示不使用多进程。CPU核心较多时可以设置为 核心数/SCAN_INFERENCE_THREADS，可用 tests/benchmark_inference_pool.py 测试
+SCAN_INFERENCE_THREADS = int(os.getenv('SCAN_INFERENCE_THREADS', 4))  # 每个推理进程使用的线程数
+SCAN_NICE = int(os.getenv('SCAN_NICE', 10))  # 扫描线程和推理进程的nice值（0-19，越大优先级越低），避免扫描拖慢搜索。0表示不调整。只在Linux上生效
+SCAN_THREAD_BUDGET = int(os.getenv('SCAN_THREAD_BUDGET', 0))  # 扫描最多使用的线程数，限制校验线程数和 推理进程数*每进程线程数。0表示不限制
+SCAN_YIELD_MAX_WAIT = float(os.getenv('SCAN_YIELD_MAX_WAIT', 5))  # 有搜索正在进行时，扫描在两个批次之间暂停等待，最多等待多少秒。0表示不暂停
+MODEL_WARMUP = os.getenv('MODEL_WARMUP', 'True').lower() == 'true'  # 是否在启动后于后台线程预加载模型。模型总是在第一次推理时才加载，网页服务无需等待模型加载即可启动
 
 # *****搜索配置*****
 CACHE_SIZE = int(os.getenv('CACHE_SIZE', 64))  # 搜索缓存条目数量，表示缓存最近的n次搜索结果，0表示不缓存。缓存保存在内存中。图片搜索和视频搜索分开缓存。重启程序或扫描完成会清空缓存，或前端点击清空缓存（前端按钮已隐藏）。
@@ -49,35 +71,27 @@ LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO')  # 日志等级：NOTSET/DEBUG/INFO/W
 
 # *****其它配置*****
 SQLALCHEMY_DATABASE_URL = os.getenv('SQLALCHEMY_DATABASE_URL', 'sqlite:///./data/instance/assets.db')  # 数据库保存路径
-TEMP_PATH = os.getenv('TEMP_PATH', './data/tmp')  # 临时目录路径
+TEMP_PATH = os.getenv('TEMP_PATH', './data/tmp')  # 临时目录路径，启动时会被清空
+SCAN_JOURNAL_PATH = os.getenv('SCAN_JOURNAL_PATH', './data/scan_journal')  # 扫描日志目录，扫描中断（包括程序崩溃或重启）后从这里继续扫描，不能放在临时目录中
+THUMBNAIL_CACHE_PATH = os.getenv('THUMBNAIL_CACHE_PATH', './data/thumbnails')  # 缩略图缓存目录，重启后保留
+THUMBNAIL_CACHE_SIZE = int(os.getenv('THUMBNAIL_CACHE_SIZE', 1024))  # 缩略图缓存最大占用空间，单位MB，超出后删除最久没有使用的缩略图。0表示不缓存
+SCAN_THUMBNAILS = os.getenv('SCAN_THUMBNAILS', 'False').lower() == 'true'  # 扫描时是否用解码好的图片顺便生成缩略图并存入缩略图缓存，搜索结果第一次展示时不需要再读取原图
+THUMBNAIL_FORMAT = os.getenv('THUMBNAIL_FORMAT', 'auto').lower()  # 缩略图格式：auto/webp/jpeg。auto会在浏览器支持时使用体积更小的webp
+SCAN_VIDEO_POSTERS = os.getenv('SCAN_VIDEO_POSTERS', 'True').lower() == 'true'  # 扫描视频时是否为每个采样帧保存一张小的JPEG预览图，视频搜索结果直接展示预览图，不需要加载原视频
+VIDEO_POSTER_PATH = os.getenv('VIDEO_POSTER_PATH', './data/video_posters')  # 视频预览图缓存目录
+VIDEO_POSTER_CACHE_SIZE = int(os.getenv('VIDEO_POSTER_CACHE_SIZE', 1024))  # 视频预览图缓存最大占用空间，单位MB，超出后删除最久没有使用的预览图。被删除的预览图会在访问时重新生成
+VIDEO_CLIP_PATH = os.getenv('VIDEO_CLIP_PATH', './data/video_clips')  # 视频片段缓存目录，重启后保留
+VIDEO_CLIP_CACHE_SIZE = int(os.getenv('VIDEO_CLIP_CACHE_SIZE', 2048))  # 视频片段缓存最大占用空间，单位MB，超出后删除最久没有下载的片段
+VIDEO_CLIP_WORKERS = int(os.getenv('VIDEO_CLIP_WORKERS', 2))  # 后台截取视频片段的并发ffmpeg进程数
 VIDEO_EXTENSION_LENGTH = int(os.getenv('VIDEO_EXTENSION_LENGTH', 0))  # 下载视频片段时，视频前后增加的时长，单位为秒
 ENABLE_LOGIN = os.getenv('ENABLE_LOGIN', 'False').lower() == 'true'  # 是否启用登录
 USERNAME = os.getenv('USERNAME', 'admin')  # 登录用户名
 PASSWORD = os.getenv('PASSWORD', 'MaterialSearch')  # 登录密码
 FLASK_DEBUG = os.getenv('FLASK_DEBUG', 'False').lower() == 'true'  # flask 调试开关（热重载）
 ENABLE_CHECKSUM = os.getenv('ENABLE_CHECKSUM', 'False').lower() == 'true'  # 是否启用文件校验（如果是，则通过文件校验来判断文件是否更新，否则通过修改时间判断）
-
-# *****DEVICE处理*****
-if DEVICE == 'auto':  # 自动选择设备，优先级：cuda > mps > directml > cpu
-    if torch.cuda.is_available():
-        DEVICE = 'cuda'
-    elif torch.backends.mps.is_available():
-        DEVICE = 'mps'
-    elif importlib.util.find_spec("torch_directml") is not None:
-        try:
-            import torch_directml
-
-            if torch_directml.device_count() > 0:
-                DEVICE = torch_directml.device()
-                x = torch.rand((1, 1), device=DEVICE)  # 测试是否可用
-                x = 1.0 - x
-            else:
-                DEVICE = 'cpu'
-        except Exception as e:
-            print("使用CPU:", repr(e))
-            DEVICE = 'cpu'
-    else:
-        DEVICE = 'cpu'
+CHECKSUM_MODE = os.getenv('CHECKSUM_MODE', 'fingerprint').lower()  # 文件校验方式：fingerprint（只读取文件大小和头、尾、中间的若干块数据计算指纹，速度快）/sha1（读取整个文件计算SHA1，最准确但大文件很慢）
+REUSE_DUPLICATE_FEATURES = os.getenv('REUSE_DUPLICATE_FEATURES', str(CHECKSUM_MODE == 'sha1')).lower() == 'true'  # 启用文件校验时，新文件的校验值与数据库中已有的文件相同（同一个文件的多个副本）则直接复制已有的特征，不重新计算。默认只在 sha1 方式下启用，fingerprint 方式只采样部分数据，不同的文件也可能得到相同的指纹
+CHECKSUM_WORKERS = int(os.getenv('CHECKSUM_WORKERS', 4))  # 扫描时计算文件校验的并发线程数
 
 # *****打印配置内容*****
 print("********** 运行配置 / RUNNING CONFIGURATIONS **********")
@@ -1,28 +1,59 @@
+import base64
 import logging
 import os
 import secrets
 import shutil
+import signal
 import threading
+import time
 from functools import wraps
-from io import BytesIO
 
 from flask import Flask, abort, jsonify, redirect, request, send_file, session, url_for
 
 from app.config import *
-from app.models.database import get_image_path_by_id, is_video_exist, get_pexels_video_count
-from app.models.models import DatabaseSession, DatabaseSessionPexelsVideo
-from app.services.process_assets import match_text_and_image, process_image, process_text
+from app.models.database import (
+    asset_stats,
+    get_image_path_time_checksum_by_id,
+    get_video_path_time_checksum_by_id,
+    get_video_time_checksum_by_path,
+    is_video_exist,
+)
+from app.models.models import DatabaseSession, create_tables, engine, engine_pexels_video
+from app.services.process_assets import (
+    get_video_poster,
+    is_model_ready,
+    match_text_and_image,
+    process_image,
+    process_text,
+    reset_after_fork,
+    start_inference_worker,
+    start_model_warmup,
+    use_text_model_only,
+)
 from app.routes.scan import Scanner
 from app.routes.search import (
     clean_cache,
+    get_search_stats,
     search_image_by_image,
     search_image_by_text_path_time,
     search_video_by_image,
     search_video_by_text_path_time,
     search_pexels_video_by_text,
 )
-from app.services.utils import crop_video, get_hash, resize_image_with_aspect_ratio
+from app.services.utils import get_hash, resize_image_with_aspect_ratio
+from app.services.clip_cache import clip_job_manager
 from app.services.file_watcher import FileWatcher
+from app.services.prefork import PreforkServer, prefork_supported
+from app.services.resource_governor import resource_governor
+from app.services.shared_index import shared_index
+from app.services.thumbnail_cache import (
+    THUMBNAIL_MIMETYPES,
+    THUMBNAIL_SIZE,
+    choose_thumbnail_format,
+    get_poster_key,
+    poster_cache,
+    thumbnail_cache,
+)
 
 logger = logging.getLogger(__name__)
 app = Flask(__name__,
@@ -36,6 +67,14 @@ scanner = Scanner()
 file_watcher = None
 
 
+def clean_temp_path():
+    """
+    删除临时目录中所有文件并重新创建。需要在重启后保留的文件（如扫描日志，见 SCAN_JOURNAL_PATH）不能放在临时目录中
+    """
+    shutil.rmtree(f'{TEMP_PATH}', ignore_errors=True)
+    os.makedirs(f'{TEMP_PATH}/upload')
+
+
 def init():
     """
     清理和创建临时文件夹，初始化扫描线程（包括数据库初始化），根据AUTO_SCAN决定是否开启自动扫描线程
@@ -45,12 +84,16 @@ def init():
     for path in ASSETS_PATH:
         if not os.path.isdir(path):
             logger.warning(f"ASSETS_PATH检查：路径 {path} 不存在！请检查输入的路径是否正确！")
-    # 删除临时目录中所有文件
-    shutil.rmtree(f'{TEMP_PATH}', ignore_errors=True)
-    os.makedirs(f'{TEMP_PATH}/upload')
-    os.makedirs(f'{TEMP_PATH}/video_clips')
+    clean_temp_path()
+    start_inference_worker()  # 在主线程中启动，不继承扫描线程的优先级
+    # 后台预加载模型，不阻塞网页服务启动
+    if MODEL_WARMUP:
+        start_model_warmup()
     # 初始化扫描线程
     scanner.init()
+    if SEARCH_ONLY:  # 仅搜索模式不扫描，也不启动文件监控
+        logger.info("仅搜索模式，已禁用扫描和文件监控")
+        return
     if AUTO_SCAN:
         auto_scan_thread = threading.Thread(target=scanner.auto_scan, args=())
         auto_scan_thread.start()
@@ -65,6 +108,71 @@ def init():
             file_watcher = None
 
 
+def init_worker():
+    """
+    多进程模式下工作进程的初始化：只负责搜索，使用主进程发布的共享索引，只加载文字模型
+    """
+    # 分叉前主进程已经用过数据库连接，工作进程不能继续使用这些连接
+    engine.dispose(close=False)
+    engine_pexels_video.dispose(close=False)
+    shared_index.attach()
+    # 工作进程退出后重新启动的工作进程是从已经初始化的主进程分叉出来的，丢弃继承的模型和推理线程
+    reset_after_fork()
+    use_text_model_only()
+    start_inference_worker()
+    if MODEL_WARMUP:
+        start_model_warmup()
+
+
+def init_master():
+    """
+    多进程模式下主进程的初始化：负责扫描和文件监控，定期把素材的变化发布到共享索引，并保存扫描状态供工作进程读取
+    """
+    init()
+    if hasattr(signal, "SIGUSR1"):  # 工作进程收到 /api/scan 请求后通知主进程扫描
+        signal.signal(signal.SIGUSR1, lambda *_: start_scan())
+
+    def publish_loop():
+        last_check = time.time()
+        while True:
+            time.sleep(1)
+            try:
+                shared_index.write_status(get_scan_status())
+                if time.time() - last_check >= SHARED_INDEX_REFRESH:
+                    last_check = time.time()
+                    shared_index.publish_if_changed()
+            except Exception as e:
+                logger.exception(f"发布共享索引出错：{repr(e)}")
+
+    threading.Thread(target=publish_loop, name="SharedIndexPublisher", daemon=True).start()
+
+
+def serve():
+    """
+    启动网页服务。SERVE_WORKERS 大于1且系统支持时使用多进程模式，否则使用单进程的服务；ASYNC_SERVER 时使用异步服务，否则使用 flask 服务
+    """
+    logging.getLogger('werkzeug').setLevel(LOG_LEVEL)
+    serve_socket = None
+    if ASYNC_SERVER:
+        from app.async_main import run_async_server
+        serve_socket = run_async_server
+    if SERVE_WORKERS > 1 and not SEARCH_ONLY:
+        if prefork_supported():
+            server = PreforkServer(app, HOST, PORT, SERVE_WORKERS, worker_init=init_worker, serve_socket=serve_socket)
+            server.bind()
+            # 在分叉之前发布一次索引，工作进程启动后就可以搜索
+            create_tables()
+            shared_index.publish()
+            server.run(master_init=init_master)
+            return
+        logger.warning("当前系统不支持多进程模式，使用单进程模式")
+    init()
+    if serve_socket is not None:
+        serve_socket()
+    else:
+        app.run(port=PORT, host=HOST, debug=FLASK_DEBUG)
+
+
 def login_required(view_func):
     """
     装饰器函数，用于控制需要登录认证的视图
@@ -120,29 +228,62 @@ def logout():
     return redirect(url_for("login"))
 
 
+def start_scan():
+    """
+    在后台线程中开始扫描
+    :return: str, 扫描状态
+    """
+    if scanner.is_scanning:
+        return "already scanning"
+    scan_thread = threading.Thread(target=scanner.scan, args=(False,))
+    scan_thread.start()
+    return "start scanning"
+
+
 @app.route("/api/scan", methods=["GET"])
 @login_required
 def api_scan():
     """开始扫描"""
     global scanner
-    if not scanner.is_scanning:
-        scan_thread = threading.Thread(target=scanner.scan, args=(False,))
-        scan_thread.start()
+    if SEARCH_ONLY:
+        return jsonify({"status": "search only"})
+    if shared_index.attached:  # 多进程模式，由主进程扫描
+        status = shared_index.read_status()
+        if status and status["status"]:
+            return jsonify({"status": "already scanning"})
+        os.kill(os.getppid(), signal.SIGUSR1)
         return jsonify({"status": "start scanning"})
-    return jsonify({"status": "already scanning"})
+    return jsonify({"status": start_scan()})
+
+
+def get_scan_status():
+    """获取扫描和素材数量的状态"""
+    result = scanner.get_status()
+    result["total_pexels_videos"] = asset_stats.total_pexels_videos
+    result["file_watch_running"] = file_watcher.is_running() if file_watcher else False
+    result["file_watch"] = file_watcher.get_status() if file_watcher else None
+    return result
+
+
+def get_status_info():
+    """获取服务状态，供 flask 和异步服务共用"""
+    # 多进程模式下扫描在主进程中进行，读取主进程保存的状态
+    result = (shared_index.read_status() if shared_index.attached else None) or get_scan_status()
+    result["file_watch_enabled"] = ENABLE_FILE_WATCH
+    result["serve_workers"] = SERVE_WORKERS if shared_index.attached else 1
+    result["model_ready"] = is_model_ready()
+    result["search_only"] = SEARCH_ONLY
+    result["search_stats"] = get_search_stats()
+    result["throttling"] = resource_governor.get_status()
+    result["video_clips"] = clip_job_manager.get_status()
+    return result
 
 
 @app.route("/api/status", methods=["GET"])
 @login_required
 def api_status():
     """状态"""
-    global scanner, file_watcher
-    result = scanner.get_status()
-    with DatabaseSessionPexelsVideo() as session:
-        result["total_pexels_videos"] = get_pexels_video_count(session)
-    result["file_watch_enabled"] = ENABLE_FILE_WATCH
-    result["file_watch_running"] = file_watcher.is_running() if file_watcher else False
-    return jsonify(result)
+    return jsonify(get_status_info())
 
 
 @app.route("/api/clean_cache", methods=["GET", "POST"])
@@ -156,21 +297,22 @@ def api_clean_cache():
     return "", 204
 
 
-@app.route("/api/match", methods=["POST"])
-@login_required
-def api_match():
+@resource_governor.searching()  # 搜索期间扫描暂停让出资源
+def match(data, upload_file_path):
     """
-    匹配文字对应的素材
-    :return: json格式的素材信息列表
+    匹配文字对应的素材，供 flask 和异步服务共用
+    :param data: dict, 搜索参数
+    :param upload_file_path: string, session 中保存的上传文件路径
+    :return: (结果, HTTP状态码, 是否使用了上传的文件)。结果为 list/dict 时以 json 返回，为 str 时直接返回
     """
+    if shared_index.refresh():  # 主进程发布了新的共享索引，之前的搜索结果已经过期
+        clean_cache()
     try:
-        data = request.get_json()
-        logger.info(f"收到搜索请求: search_type={data.get('search_type')}, top_n={data.get('top_n')}")
-
         # 参数验证
         if not data:
             logger.error("请求数据为空")
-            return jsonify({"error": "请求数据为空"}), 400
+            return {"error": "请求数据为空"}, 400, False
+        logger.info(f"收到搜索请求: search_type={data.get('search_type')}, top_n={data.get('top_n')}")
 
         # 获取参数，使用.get()避免KeyError
         try:
@@ -187,19 +329,16 @@ def api_match():
             negative = data.get("negative", "")
         except (ValueError, TypeError) as e:
             logger.error(f"参数类型转换错误: {e}, data={data}")
-            return jsonify({"error": f"参数类型错误: {str(e)}"}), 400
+            return {"error": f"参数类型错误: {str(e)}"}, 400, False
 
         logger.info(f"搜索参数: search_type={search_type}, top_n={top_n}, path={path}, positive={positive}")
 
-        upload_file_path = session.get('upload_file_path', '')
-
         # 只在需要上传文件的搜索类型时检查和清空session
-        if search_type in (1, 3, 4):
+        upload_used = search_type in (1, 3, 4)
+        if upload_used:
             if not upload_file_path or not os.path.exists(upload_file_path):
                 logger.error(f"上传文件检查失败: upload_file_path={upload_file_path}, exists={os.path.exists(upload_file_path) if upload_file_path else False}")
-                return "你没有上传文件！", 400
-            # 只有在使用上传文件时才清空session
-            session['upload_file_path'] = ""
+                return "你没有上传文件！", 400, False
         else:
             # 不需要上传文件的搜索类型，不清空session，保留上一次的上传
             logger.info(f"搜索类型{search_type}不需要上传文件，保留session中的upload_file_path")
@@ -219,7 +358,7 @@ def api_match():
         elif search_type == 4:  # 图文相似度匹配
             score = match_text_and_image(process_text(positive), process_image(upload_file_path)) * 100
             logger.info(f"图文相似度: {score}")
-            return jsonify({"score": "%.2f" % score})
+            return {"score": "%.2f" % score}, 200, upload_used
         elif search_type == 5:  # 以图搜图(图片是数据库中的)
             results = search_image_by_image(img_id, image_threshold, path, start_time, end_time)
         elif search_type == 6:  # 以图搜视频(图片是数据库中的)
@@ -228,14 +367,29 @@ def api_match():
             results = search_pexels_video_by_text(positive, positive_threshold)
         else:  # 空
             logger.error(f"search_type不正确：{search_type}")
-            return jsonify({"error": f"不支持的搜索类型: {search_type}"}), 400
+            return {"error": f"不支持的搜索类型: {search_type}"}, 400, False
 
         logger.info(f"搜索结果数量: {len(results)}, 返回前{top_n}个")
-        return jsonify(results[:top_n])
+        return results[:top_n], 200, upload_used
 
     except Exception as e:
         logger.error(f"搜索过程中发生错误: {e}", exc_info=True)
-        return jsonify({"error": str(e)}), 500
+        return {"error": str(e)}, 500, False
+
+
+@app.route("/api/match", methods=["POST"])
+@login_required
+def api_match():
+    """
+    匹配文字对应的素材
+    :return: json格式的素材信息列表
+    """
+    result, status, upload_used = match(request.get_json(silent=True), session.get('upload_file_path', ''))
+    if upload_used:  # 只有在使用上传文件时才清空session
+        session['upload_file_path'] = ""
+    if isinstance(result, str):
+        return result, status
+    return jsonify(result), status
 
 
 @app.route("/api/get_image/<int:image_id>", methods=["GET"])
@@ -247,17 +401,25 @@ def api_get_image(image_id):
     :return: 图片文件
     """
     with DatabaseSession() as session:
-        path = get_image_path_by_id(session, image_id)
-        logger.debug(path)
+        record = get_image_path_time_checksum_by_id(session, image_id)
+    if record is None:
+        abort(404)
+    path, modify_time, checksum = record
+    logger.debug(path)
     # 静态图片压缩返回
-    if request.args.get("thumbnail") == "1" and os.path.splitext(path)[-1] != "gif":
-        # 这里转换成RGB然后压缩成JPEG格式返回。也可以不转换RGB，压缩成WEBP格式，这样可以保留透明通道。
-        # 目前暂时使用JPEG格式，如果切换成WEBP，还需要实际测试两者的文件大小和质量。
-        image = resize_image_with_aspect_ratio(path, (640, 480), convert_rgb=True)
-        image_io = BytesIO()
-        image.save(image_io, 'JPEG', quality=60)
-        image_io.seek(0)
-        return send_file(image_io, mimetype='image/jpeg')
+    if request.args.get("thumbnail") == "1" and os.path.splitext(path)[-1].lower() != ".gif":
+        # 缩略图缓存在磁盘上，键同时用作 ETag，浏览器每次都会重新验证，图片没有变化时返回 304
+        fmt = choose_thumbnail_format(request.accept_mimetypes)
+        key = thumbnail_cache.get_key(image_id, modify_time, checksum, fmt)
+        if request.if_none_match.contains(key):
+            response = app.response_class(status=304)
+        else:
+            thumbnail = thumbnail_cache.get_or_create(key, fmt, lambda: resize_image_with_aspect_ratio(path, THUMBNAIL_SIZE))
+            response = send_file(thumbnail, mimetype=THUMBNAIL_MIMETYPES[fmt], etag=False, conditional=False)
+        response.set_etag(key)
+        response.headers["Cache-Control"] = "private, no-cache"
+        response.vary.add("Accept")
+        return response
     return send_file(path)
 
 
@@ -277,34 +439,137 @@ def api_get_video(video_path):
     return send_file(path)
 
 
-@app.route(
-    "/api/download_video_clip/<video_path>/<int:start_time>/<int:end_time>",
-    methods=["GET"],
-)
+@app.route("/api/get_video_frame/<int:video_id>/<int:frame_time>", methods=["GET"])
 @login_required
-def api_download_video_clip(video_path, start_time, end_time):
+def api_get_video_frame(video_id, frame_time):
+    """
+    读取视频预览图
+    :param video_id: int, 视频在数据库中的id（任意一帧的id）
+    :param frame_time: int, 帧所在的时间，单位秒
+    :return: JPEG 预览图
+    """
+    with DatabaseSession() as session:
+        record = get_video_path_time_checksum_by_id(session, video_id)
+    if record is None:
+        abort(404)
+    path, modify_time, checksum = record
+    key = get_poster_key(path, frame_time, modify_time, checksum)
+    if request.if_none_match.contains(key):
+        response = app.response_class(status=304)
+    else:
+        def create_poster():  # 扫描时没有保存或已被淘汰，从视频中读取这一帧
+            image = get_video_poster(path, frame_time)
+            if image is None:
+                abort(404)
+            return image
+
+        poster = poster_cache.get_or_create(key, "jpeg", create_poster)
+        response = send_file(poster, mimetype="image/jpeg", etag=False, conditional=False)
+    response.set_etag(key)
+    response.headers["Cache-Control"] = "private, no-cache"
+    return response
+
+
+def create_video_clip_job(video_path, start_time, end_time):
     """
-    下载视频片段
+    提交截取视频片段的任务，供 flask 和异步服务共用
     :param video_path: string, 经过base64.urlsafe_b64encode的字符串，解码后可以得到视频在服务器上的绝对路径
     :param start_time: int, 视频开始秒数
     :param end_time: int, 视频结束秒数
-    :return: 视频文件
+    :return: ClipJob，视频不在数据库中时返回 None
     """
     path = base64.urlsafe_b64decode(video_path).decode()
     logger.debug(path)
     with DatabaseSession() as session:
-        if not is_video_exist(session, path):  # 如果路径不在数据库中，则返回404，防止任意文件读取攻击
-            abort(404)
+        record = get_video_time_checksum_by_path(session, path)
+    if record is None:  # 如果路径不在数据库中，则返回404，防止任意文件读取攻击
+        return None
     # 根据VIDEO_EXTENSION_LENGTH调整时长
     start_time -= VIDEO_EXTENSION_LENGTH
     end_time += VIDEO_EXTENSION_LENGTH
     if start_time < 0:
         start_time = 0
-    # 调用ffmpeg截取视频片段
-    output_path = f"{TEMP_PATH}/video_clips/{start_time}_{end_time}_" + os.path.basename(path)
-    if not os.path.exists(output_path):  # 如果存在说明已经剪过，直接返回，如果不存在则剪
-        crop_video(path, output_path, start_time, end_time)
-    return send_file(output_path)
+    return clip_job_manager.submit(path, *record, start_time, end_time)
+
+
+def submit_video_clip_job(video_path, start_time, end_time):
+    """提交截取视频片段的任务，视频不在数据库中时返回404"""
+    job = create_video_clip_job(video_path, start_time, end_time)
+    if job is None:
+        abort(404)
+    return job
+
+
+def send_video_clip(job):
+    """等待任务完成并返回视频片段，截取失败时返回500"""
+    clip_job_manager.wait(job)
+    file_path = clip_job_manager.get_file(job)
+    if file_path is None:
+        if job.status == job.DONE:  # 刚好被淘汰，重新截取
+            return send_video_clip(clip_job_manager.submit_again(job))
+        abort(500)
+    return send_file(file_path, download_name=job.download_name)
+
+
+@app.route(
+    "/api/download_video_clip/<video_path>/<int:start_time>/<int:end_time>",
+    methods=["GET"],
+)
+@login_required
+def api_download_video_clip(video_path, start_time, end_time):
+    """
+    下载视频片段，等待后台截取完成后返回
+    :param video_path: string, 经过base64.urlsafe_b64encode的字符串，解码后可以得到视频在服务器上的绝对路径
+    :param start_time: int, 视频开始秒数
+    :param end_time: int, 视频结束秒数
+    :return: 视频文件
+    """
+    return send_video_clip(submit_video_clip_job(video_path, start_time, end_time))
+
+
+@app.route(
+    "/api/video_clip_job/<video_path>/<int:start_time>/<int:end_time>",
+    methods=["GET", "POST"],
+)
+@login_required
+def api_create_video_clip_job(video_path, start_time, end_time):
+    """
+    提交截取视频片段的任务，立即返回，之后通过 /api/video_clip_job/<job_id> 查询进度
+    :return: json, 任务id和状态
+    """
+    return jsonify(submit_video_clip_job(video_path, start_time, end_time).to_dict())
+
+
+@app.route("/api/video_clip_job/<job_id>", methods=["GET"])
+@login_required
+def api_get_video_clip_job(job_id):
+    """
+    查询截取任务的状态
+    :param job_id: string, 任务id
+    :param wait: 可选的查询参数，任务未结束时最多等待的秒数（长轮询），默认不等待
+    :return: json, 任务id和状态
+    """
+    job = clip_job_manager.get_job(job_id)
+    if job is None:
+        abort(404)
+    wait = request.args.get("wait", 0, type=float)
+    if wait > 0:
+        clip_job_manager.wait(job, min(wait, 60))
+    return jsonify(job.to_dict())
+
+
+@app.route("/api/get_video_clip/<job_id>", methods=["GET"])
+@login_required
+def api_get_video_clip(job_id):
+    """
+    下载截取任务生成的视频片段，任务未结束时等待完成
+    :param job_id: string, 任务id
+    :return: 视频文件
+    """
+    job = clip_job_manager.get_job(job_id)
+    if job is None:
+        abort(404)
+    return send_video_clip(job)
 
 
 @app.route("/api/upload", methods=["POST"])
@@ -329,6 +594,4 @@ def api_upload():
 
 
 if __name__ == "__main__":
-    init()
-    logging.getLogger('werkzeug').setLevel(LOG_LEVEL)
-    app.run(port=PORT, host=HOST, debug=FLASK_DEBUG)
+    serve()
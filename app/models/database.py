@@ -1,13 +1,43 @@
 import datetime
 import logging
+import threading
+import time
 
-from sqlalchemy import asc
+from sqlalchemy import Integer, String, asc, cast, func, insert
 from sqlalchemy.orm import Session
 
-from app.models.models import Image, Video, PexelsVideo
+from app.models.models import Image, IndexMeta, Video, PexelsVideo, ScanDirectory
+from app.services.utils import is_same_checksum_type
 
 logger = logging.getLogger(__name__)
 
+INDEX_VERSION_KEY = "version"  # IndexMeta 中索引修改计数的键
+
+class AssetStats:
+    """
+    素材数量统计
+    在增删记录的函数中随提交同步更新，这样查询状态时不需要每次都执行 COUNT 查询；定期通过 reconcile_asset_stats 重新统计以修正误差
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.total_images = 0
+        self.total_videos = 0
+        self.total_video_frames = 0
+        self.total_pexels_videos = 0
+        self.reconcile_time = 0  # 上次重新统计的时间戳
+
+    def update(self, images: int = 0, videos: int = 0, video_frames: int = 0, pexels_videos: int = 0):
+        """增减数量，负数表示减少"""
+        with self.lock:
+            self.total_images += images
+            self.total_videos += videos
+            self.total_video_frames += video_frames
+            self.total_pexels_videos += pexels_videos
+
+
+asset_stats = AssetStats()
+
 
 def get_image_features_by_id(session: Session, image_id: int):
     """
@@ -30,63 +60,98 @@ def get_image_path_by_id(session: Session, id: int):
     return path[0]
 
 
+def get_image_path_time_checksum_by_id(session: Session, id: int):
+    """
+    返回id对应的图片路径、修改时间和checksum
+    :return: (path, modify_time, checksum)，不存在时返回 None
+    """
+    record = session.query(Image.path, Image.modify_time, Image.checksum).filter_by(id=id).first()
+    if not record:
+        return None
+    return tuple(record)
+
+
+def get_image_features_by_checksums(session: Session, checksums: list[str]) -> dict[str, bytes]:
+    """获取 checksum 对应的已有图片的 features，用于同一个文件的多个副本复用特征"""
+    features_map = {}
+    for i in range(0, len(checksums), 500):  # 分批查询，避免单条语句参数过多
+        query = session.query(Image.checksum, Image.features).filter(Image.checksum.in_(checksums[i:i + 500]))
+        for checksum, features in query:
+            features_map.setdefault(checksum, features)
+    return features_map
+
+
 def get_image_count(session: Session):
     """获取图片总数"""
     return session.query(Image).count()
 
 
-def delete_image_if_outdated(session: Session, path: str, modify_time: datetime.datetime, checksum: str = None) -> bool:
+def get_image_path_time_checksum_map(session: Session) -> dict[str, tuple[datetime.datetime, str]]:
     """
-    判断图片是否修改，若修改则删除
-    :param session: Session, 数据库 session
-    :param path: str, 图片路径
-    :param modify_time: datetime.datetime, 图片修改时间
-    :param checksum: str, 图片hash
-    :return: bool, 若文件未修改返回 True
+    一次性读取全部图片的 路径 -> (修改时间, checksum) 字典，不加载 features，用于扫描时在内存中比对文件是否变更
     """
-    record = session.query(Image).filter_by(path=path).first()
-    if not record:
-        return False
-    # 如果有checksum，则判断checksum
-    if checksum and record.checksum:
-        if record.checksum == checksum:
-            logger.debug(f"文件无变更，跳过：{path}")
-            return True
-    else:  # 否则判断modify_time
-        if record.modify_time == modify_time:
-            logger.debug(f"文件无变更，跳过：{path}")
-            return True
-    logger.info(f"文件有更新：{path}")
-    session.delete(record)
-    session.commit()
-    return False
+    query = session.query(Image.path, Image.modify_time, Image.checksum)
+    return {path: (modify_time, checksum) for path, modify_time, checksum in query}
 
 
-def delete_video_if_outdated(session: Session, path: str, modify_time: datetime.datetime, checksum: str = None) -> bool:
+def get_video_path_time_checksum_map(session: Session) -> dict[str, tuple[datetime.datetime, str]]:
     """
-    判断视频是否修改，若修改则删除
-    :param session: Session, 数据库 session
-    :param path: str, 视频路径
-    :param modify_time: datetime.datetime, 视频修改时间
-    :param checksum: str, 视频hash
-    :return: bool, 若文件未修改返回 True
+    一次性读取全部视频的 路径 -> (修改时间, checksum) 字典（每个视频只取一条），不加载 features
     """
-    record = session.query(Video).filter_by(path=path).first()
-    if not record:
-        return False
-    # 如果有checksum，则判断checksum
-    if checksum and record.checksum:
-        if record.checksum == checksum:
-            logger.debug(f"文件无变更，跳过：{path}")
-            return True
-    else:  # 否则判断modify_time
-        if record.modify_time == modify_time:
-            logger.debug(f"文件无变更，跳过：{path}")
-            return True
-    logger.info(f"文件有更新：{path}")
-    session.query(Video).filter_by(path=path).delete()
-    session.commit()
-    return False
+    query = session.query(Video.path, Video.modify_time, Video.checksum).distinct()
+    return {path: (modify_time, checksum) for path, modify_time, checksum in query}
+
+
+def iter_image_records_sorted(session: Session, page_size: int = 10000):
+    """
+    按路径顺序分页读取全部图片的 (路径, 修改时间, checksum)，不加载 features
+    每页是一次独立的短查询（WHERE path > 上一页最后的路径），不会长时间占用数据库连接，因此读取过程中可以同时写入数据库
+    :return: 生成器，按路径升序返回 (path, modify_time, checksum) 元组
+    """
+    last_path = None
+    while True:
+        query = session.query(Image.path, Image.modify_time, Image.checksum)
+        if last_path is not None:
+            query = query.filter(Image.path > last_path)
+        rows = query.order_by(Image.path).limit(page_size).all()
+        if not rows:
+            return
+        yield from rows
+        last_path = rows[-1][0]
+
+
+def iter_video_records_sorted(session: Session, page_size: int = 10000):
+    """
+    按路径顺序分页读取全部视频的 (路径, 修改时间, checksum)，每个视频只取一条，不加载 features
+    :return: 生成器，按路径升序返回 (path, modify_time, checksum) 元组
+    """
+    last_path = None
+    while True:
+        query = session.query(Video.path, Video.modify_time, Video.checksum).distinct()
+        if last_path is not None:
+            query = query.filter(Video.path > last_path)
+        rows = query.order_by(Video.path).limit(page_size).all()
+        if not rows:
+            return
+        yield from rows
+        last_path = rows[-1][0]
+
+
+def is_record_outdated(record: tuple[datetime.datetime, str], modify_time: datetime.datetime, checksum: str = None) -> bool:
+    """
+    根据预加载的 (修改时间, checksum) 判断文件是否有变更
+    :param record: tuple, 数据库中的 (修改时间, checksum)，为 None 表示数据库中没有该文件
+    :param modify_time: datetime.datetime, 文件修改时间
+    :param checksum: str, 文件hash
+    :return: bool, 若数据库中没有该文件或文件已修改返回 True
+    """
+    if record is None:
+        return True
+    record_modify_time, record_checksum = record
+    # 如果有同一种方式计算的checksum，则判断checksum，否则判断modify_time
+    if checksum and record_checksum and is_same_checksum_type(checksum, record_checksum):
+        return record_checksum != checksum
+    return record_modify_time != modify_time
 
 
 def get_video_paths(session: Session, filter_path: str = None, start_time: int = None, end_time: int = None):
@@ -114,6 +179,42 @@ def get_frame_times_features_by_path(session: Session, path: str):
     return frame_times, features
 
 
+def get_video_frame_times_features_by_checksum(session: Session, checksum: str) -> list[tuple[int, bytes]]:
+    """获取与 checksum 相同的一个已有视频的所有帧 (帧时间, features)，没有时返回空列表"""
+    record = session.query(Video.path).filter_by(checksum=checksum).first()
+    if record is None:
+        return []
+    return session.query(Video.frame_time, Video.features).filter_by(path=record[0]).order_by(Video.frame_time).all()
+
+
+def get_video_id_by_path(session: Session, path: str):
+    """获取视频的id（取第一帧的id），用于获取视频预览图"""
+    record = session.query(Video.id).filter_by(path=path).order_by(Video.id).first()
+    return record[0] if record else None
+
+
+def get_video_time_checksum_by_path(session: Session, path: str):
+    """
+    返回视频的修改时间和checksum，用于截取视频片段
+    :return: (modify_time, checksum)，不存在时返回 None
+    """
+    record = session.query(Video.modify_time, Video.checksum).filter_by(path=path).first()
+    if not record:
+        return None
+    return tuple(record)
+
+
+def get_video_path_time_checksum_by_id(session: Session, id: int):
+    """
+    返回id对应的视频路径、修改时间和checksum
+    :return: (path, modify_time, checksum)，不存在时返回 None
+    """
+    record = session.query(Video.path, Video.modify_time, Video.checksum).filter_by(id=id).first()
+    if not record:
+        return None
+    return tuple(record)
+
+
 def get_video_count(session: Session):
     """获取视频总数"""
     return session.query(Video.path).distinct().count()
@@ -129,28 +230,93 @@ def get_video_frame_count(session: Session):
     return session.query(Video).count()
 
 
+def reconcile_asset_stats(session: Session, pexels_session: Session = None):
+    """
+    重新统计素材数量，修正 asset_stats 的误差
+    :param session: Session, 本地扫描数据库 session
+    :param pexels_session: Session, pexels视频数据库 session，为 None 则不统计pexels视频
+    """
+    total_images = get_image_count(session)
+    total_videos = get_video_count(session)
+    total_video_frames = get_video_frame_count(session)
+    total_pexels_videos = get_pexels_video_count(pexels_session) if pexels_session is not None else None
+    with asset_stats.lock:
+        asset_stats.total_images = total_images
+        asset_stats.total_videos = total_videos
+        asset_stats.total_video_frames = total_video_frames
+        if total_pexels_videos is not None:
+            asset_stats.total_pexels_videos = total_pexels_videos
+        asset_stats.reconcile_time = time.time()
 
 
 def delete_image_by_path(session: Session, path: str):
     """删除路径对应的图片数据"""
-    session.query(Image).filter_by(path=path).delete()
+    count = session.query(Image).filter_by(path=path).delete()
+    if count:
+        bump_index_version(session)
     session.commit()
+    asset_stats.update(images=-count)
 
 
 def delete_video_by_path(session: Session, path: str):
     """删除路径对应的视频数据"""
-    session.query(Video).filter_by(path=path).delete()
+    count = session.query(Video).filter_by(path=path).delete()
+    if count:
+        bump_index_version(session)
     session.commit()
+    asset_stats.update(videos=-1 if count else 0, video_frames=-count)
 
 
+def delete_images_by_paths(session: Session, paths: list[str]) -> int:
+    """
+    批量删除路径对应的图片数据
+    :return: int, 删除的图片数量
+    """
+    count = session.query(Image).filter(Image.path.in_(paths)).delete(synchronize_session=False)
+    if count:
+        bump_index_version(session)
+    session.commit()
+    asset_stats.update(images=-count)
+    return count
 
 
-def add_image(session: Session, path: str, modify_time: datetime.datetime, checksum: str, features: bytes):
-    """添加图片到数据库"""
-    logger.info(f"新增文件：{path}")
-    image = Image(path=path, modify_time=modify_time, features=features, checksum=checksum)
-    session.add(image)
+def delete_videos_by_paths(session: Session, paths: list[str]) -> int:
+    """
+    批量删除路径对应的视频数据
+    :return: int, 删除的视频数量
+    """
+    video_count = session.query(Video.path).filter(Video.path.in_(paths)).distinct().count()
+    frame_count = session.query(Video).filter(Video.path.in_(paths)).delete(synchronize_session=False)
+    if frame_count:
+        bump_index_version(session)
     session.commit()
+    asset_stats.update(videos=-video_count, video_frames=-frame_count)
+    return video_count
+
+
+def add_images(session: Session, records: list, replace: bool = False) -> list[int]:
+    """
+    批量添加图片到数据库，只提交一次
+    :param records: list, (path, modify_time, checksum, features) 元组列表
+    :param replace: bool, 是否在同一个事务中先删除这些路径原有的记录（文件被修改时）
+    :return: list[int], 图片id列表，顺序与 records 相同
+    """
+    removed = 0
+    if replace:
+        paths = [path for path, _, _, _ in records]
+        removed = session.query(Image).filter(Image.path.in_(paths)).delete(synchronize_session=False)
+    images = []
+    for path, modify_time, checksum, features in records:
+        logger.info(f"新增文件：{path}")
+        images.append(Image(path=path, modify_time=modify_time, features=features, checksum=checksum))
+    session.add_all(images)
+    session.flush()
+    image_ids = [image.id for image in images]
+    if images or removed:
+        bump_index_version(session)
+    session.commit()
+    asset_stats.update(images=len(images) - removed)
+    return image_ids
 
 
 def add_video(session: Session, path: str, modify_time: datetime.datetime, checksum: str, frame_time_features_generator):
@@ -164,14 +330,83 @@ def add_video(session: Session, path: str, modify_time: datetime.datetime, check
     """
     # 使用 bulk_save_objects 一次性提交，因此处理至一半中断不会导致下次扫描时跳过
     logger.info(f"新增文件：{path}")
-    video_list = (
+    is_new_video = not is_video_exist(session, path)
+    video_list = [
         Video(
             path=path, modify_time=modify_time, frame_time=frame_time, features=features, checksum=checksum
         )
         for frame_time, features in frame_time_features_generator
-    )
+    ]
     session.bulk_save_objects(video_list)
+    if video_list:
+        bump_index_version(session)
+    session.commit()
+    asset_stats.update(videos=1 if is_new_video and video_list else 0, video_frames=len(video_list))
+
+
+def get_image_records_by_checksums(session: Session, checksums: list[str]) -> list[tuple[str, datetime.datetime, str]]:
+    """获取 checksum 在列表中的图片的 (路径, 修改时间, checksum)，不加载 features，用于判断新出现的文件是否是被移动的文件"""
+    records = []
+    for i in range(0, len(checksums), 500):  # 分批查询，避免单条语句参数过多
+        query = session.query(Image.path, Image.modify_time, Image.checksum).filter(Image.checksum.in_(checksums[i:i + 500]))
+        records.extend(tuple(record) for record in query)
+    return records
+
+
+def get_video_records_by_checksums(session: Session, checksums: list[str]) -> list[tuple[str, datetime.datetime, str]]:
+    """获取 checksum 在列表中的视频的 (路径, 修改时间, checksum)（每个视频只取一条），用于判断新出现的文件是否是被移动的文件"""
+    records = []
+    for i in range(0, len(checksums), 500):
+        query = session.query(Video.path, Video.modify_time, Video.checksum).filter(
+            Video.checksum.in_(checksums[i:i + 500])).distinct()
+        records.extend(tuple(record) for record in query)
+    return records
+
+
+def move_images(session: Session, moves: list[tuple[str, str]]) -> list[str]:
+    """
+    文件被移动或重命名时，直接修改图片记录的路径，保留特征，不需要重新计算。只提交一次
+    新路径原有的记录（移动时覆盖了另一个文件）会被删除
+    :param moves: list, (原路径, 新路径) 列表
+    :return: list, 修改了路径的图片的新路径（原路径没有记录的不计入）
+    """
+    removed, moved = 0, []
+    for old_path, new_path in moves:
+        removed += session.query(Image).filter_by(path=new_path).delete(synchronize_session=False)
+        count = session.query(Image).filter_by(path=old_path).update({Image.path: new_path}, synchronize_session=False)
+        if count:
+            logger.info(f"文件已移动：{old_path} -> {new_path}")
+            moved.append(new_path)
+    if removed or moved:
+        bump_index_version(session)
+    session.commit()
+    asset_stats.update(images=-removed)
+    return moved
+
+
+def move_videos(session: Session, moves: list[tuple[str, str]]) -> list[str]:
+    """
+    文件被移动或重命名时，直接修改视频所有帧记录的路径，保留特征，不需要重新计算。只提交一次
+    新路径原有的记录（移动时覆盖了另一个文件）会被删除
+    :param moves: list, (原路径, 新路径) 列表
+    :return: list, 修改了路径的视频的新路径（原路径没有记录的不计入）
+    """
+    removed_videos = removed_frames = 0
+    moved = []
+    for old_path, new_path in moves:
+        count = session.query(Video).filter_by(path=new_path).delete(synchronize_session=False)
+        if count:
+            removed_videos += 1
+            removed_frames += count
+        count = session.query(Video).filter_by(path=old_path).update({Video.path: new_path}, synchronize_session=False)
+        if count:
+            logger.info(f"文件已移动：{old_path} -> {new_path}")
+            moved.append(new_path)
+    if removed_frames or moved:
+        bump_index_version(session)
     session.commit()
+    asset_stats.update(videos=-removed_videos, video_frames=-removed_frames)
+    return moved
 
 
 def add_pexels_video(session: Session, content_loc: str, duration: int, view_count: int, thumbnail_loc: str, title: str, description: str,
@@ -183,27 +418,137 @@ def add_pexels_video(session: Session, content_loc: str, duration: int, view_cou
     )
     session.add(pexels_video)
     session.commit()
+    asset_stats.update(pexels_videos=1)
+
+
+def get_asset_paths(session: Session):
+    """
+    获取数据库中全部图片和视频的路径（视频路径去重），只查询路径
+    :return: 生成器，逐个返回路径
+    """
+    for path, in session.query(Image.path):
+        yield path
+    for path, in session.query(Video.path).distinct():
+        yield path
+
+
+def get_scan_directories(session: Session) -> dict[str, tuple[float, int, datetime.datetime]]:
+    """
+    获取上次扫描记录的全部目录信息（包括已经过期的目录，由遍历时判断是否沿用）
+    :return: dict, 目录路径 -> (目录修改时间, 文件数量, 遍历时间)，读取失败的目录修改时间为 None
+    """
+    query = session.query(ScanDirectory.path, ScanDirectory.modify_time, ScanDirectory.file_count, ScanDirectory.scan_time)
+    return {path: (modify_time, file_count, scan_time) for path, modify_time, file_count, scan_time in query}
+
+
+def save_scan_directories(session: Session, directories: dict[str, tuple[float, int, datetime.datetime]]):
+    """
+    用本次扫描的目录信息替换数据库中的记录
+    :param directories: dict, 目录路径 -> (目录修改时间, 文件数量, 遍历时间)
+    """
+    session.query(ScanDirectory).delete()
+    if directories:
+        session.execute(insert(ScanDirectory), [
+            {"path": path, "modify_time": modify_time, "file_count": file_count, "scan_time": scan_time}
+            for path, (modify_time, file_count, scan_time) in directories.items()
+        ])
+    session.commit()
 
 
-def delete_record_if_not_exist(session: Session, assets: set):
+def get_index_signature(session: Session) -> tuple:
     """
-    删除不存在于 assets 集合中的图片 / 视频的数据库记录
+    获取索引内容的签名，用于判断是否需要重新发布共享索引
+    以索引的修改计数为主（增删改记录时都会增加，见 bump_index_version），再加上图片和视频帧的数量，
+    这样不经过这些函数直接修改数据库（如删库）时签名也会变化
     """
-    for file in session.query(Image):
-        if file.path not in assets:
-            logger.info(f"文件已删除：{file.path}")
-            session.delete(file)
-    for path in session.query(Video.path).distinct():
-        path = path[0]
-        if path not in assets:
-            logger.info(f"文件已删除：{path}")
-            session.query(Video).filter_by(path=path).delete()
+    images = session.query(func.count(Image.id)).scalar()
+    videos = session.query(func.count(Video.id)).scalar()
+    return get_index_version(session), images, videos
+
+
+def get_image_index_rows(session: Session):
+    """
+    逐行读取所有图片的 id, 路径, 修改时间, 特征，用于发布共享索引
+    :return: (行数, 生成器)
+    """
+    query = session.query(Image.id, Image.path, Image.modify_time, Image.features).filter(Image.features.isnot(None))
+    return query.count(), query.order_by(Image.id).yield_per(1000)
+
+
+def get_video_index_rows(session: Session):
+    """
+    逐行读取所有视频帧的 id, 路径, 帧时间, 修改时间, 特征，按路径和帧时间排序，用于发布共享索引
+    :return: (行数, 生成器)
+    """
+    query = session.query(Video.id, Video.path, Video.frame_time, Video.modify_time, Video.features).filter(
+        Video.features.isnot(None))
+    return query.count(), query.order_by(Video.path, Video.frame_time).yield_per(1000)
+
+
+def get_index_meta(session: Session, key: str):
+    """
+    读取索引的元信息，不存在时返回 None
+    """
+    record = session.get(IndexMeta, key)
+    return record.value if record else None
+
+
+def set_index_meta(session: Session, key: str, value: str):
+    """
+    写入索引的元信息
+    """
+    session.merge(IndexMeta(key=key, value=value))
     session.commit()
 
 
+def get_index_version(session: Session) -> int:
+    """读取索引的修改计数"""
+    value = get_index_meta(session, INDEX_VERSION_KEY)
+    return int(value) if value else 0
+
+
+def bump_index_version(session: Session):
+    """
+    增加索引的修改计数，需在增删图片/视频记录或修改其路径的同一个事务中、提交之前调用。
+    只用数量和最大id判断不出替换最新记录（SQLite 会重用被删除的最大id）或只修改路径的变化
+    """
+    updated = session.query(IndexMeta).filter_by(key=INDEX_VERSION_KEY).update(
+        {IndexMeta.value: cast(cast(IndexMeta.value, Integer) + 1, String)}, synchronize_session=False)
+    if not updated:
+        session.add(IndexMeta(key=INDEX_VERSION_KEY, value="1"))
+        session.flush()
+
+
+def get_index_precisions(session: Session) -> list[str]:
+    """
+    获取生成现有索引时使用过的推理精度列表
+    """
+    value = get_index_meta(session, "precision")
+    return value.split(",") if value else []
+
+
+def record_index_precision(session: Session, precision: str) -> list[str]:
+    """
+    记录即将写入索引的特征所使用的推理精度。数据库中没有素材时会清空之前的记录
+    :param session: Session, 数据库 session
+    :param precision: str, 推理精度
+    :return: list[str], 现有索引使用过的推理精度，多于一个说明索引中混合了不同精度的特征
+    """
+    if asset_stats.total_images == 0 and asset_stats.total_videos == 0:
+        precisions = []
+    else:
+        precisions = get_index_precisions(session)
+    if precision not in precisions:
+        precisions.append(precision)
+        set_index_meta(session, "precision", ",".join(precisions))
+        if len(precisions) > 1:
+            logger.warning(f"索引中混合了不同推理精度的特征：{precisions}，建议删库后重新扫描")
+    return precisions
+
+
 def is_video_exist(session: Session, path: str):
     """判断视频是否存在"""
-    video = session.query(Video).filter_by(path=path).first()
+    video = session.query(Video.id).filter_by(path=path).first()
     if video:
         return True
     return False
@@ -221,8 +566,9 @@ def get_image_id_path_features(session: Session) -> tuple[list[int], list[str],
     """
     获取全部图片的 id, 路径, 特征，返回三个列表
     """
-    session.query(Image).filter(Image.features.is_(None)).delete()
+    count = session.query(Image).filter(Image.features.is_(None)).delete()
     session.commit()
+    asset_stats.update(images=-count)
     query = session.query(Image.id, Image.path, Image.features)
     try:
         id_list, path_list, features_list = zip(*query)
@@ -236,8 +582,9 @@ def get_image_id_path_features_filter_by_path_time(session: Session, path: str,
     """
     根据路径和时间，筛选出对应图片的 id, 路径, 特征，返回三个列表
     """
-    session.query(Image).filter(Image.features.is_(None)).delete()
+    count = session.query(Image).filter(Image.features.is_(None)).delete()
     session.commit()
+    asset_stats.update(images=-count)
     query = session.query(Image.id, Image.path, Image.features, Image.modify_time)
     if start_time:
         query = query.filter(Image.modify_time >= datetime.datetime.fromtimestamp(start_time))
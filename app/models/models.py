@@ -1,6 +1,6 @@
 import os
 
-from sqlalchemy import BINARY, Column, DateTime, Integer, String
+from sqlalchemy import BINARY, Column, DateTime, Float, Integer, String
 from sqlalchemy import create_engine
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker
@@ -56,6 +56,21 @@ class Video(BaseModel):
     checksum = Column(String(40), index=True)  # 文件SHA1
 
 
+class ScanDirectory(BaseModel):
+    __tablename__ = "scan_directory"
+    id = Column(Integer, primary_key=True, index=True)
+    path = Column(String(4096), index=True)  # 目录路径
+    modify_time = Column(Float)  # 上次遍历时目录的修改时间（时间戳）
+    file_count = Column(Integer)  # 上次遍历时目录下符合条件的文件数量（不含子目录）
+    scan_time = Column(DateTime, index=True)  # 上次实际列出该目录内容的时间
+
+
+class IndexMeta(BaseModel):
+    __tablename__ = "index_meta"
+    key = Column(String(64), primary_key=True)  # 键
+    value = Column(String(256))  # 值
+
+
 class PexelsVideo(BaseModelPexelsVideo):
     __tablename__ = "PexelsVideo"
     id = Column(Integer, primary_key=True, index=True)
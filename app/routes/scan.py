@@ -1,24 +1,93 @@
 import datetime
 import logging
-import pickle
 import time
+from collections import deque
 from pathlib import Path
 
 from app.config import *
 from app.models.database import (
-    get_image_count,
-    get_video_count,
-    get_video_frame_count,
-    delete_record_if_not_exist,
-    delete_image_if_outdated,
-    delete_video_if_outdated,
+    asset_stats,
+    reconcile_asset_stats,
+    get_index_precisions,
+    record_index_precision,
+    get_asset_paths,
+    get_scan_directories,
+    save_scan_directories,
+    delete_image_by_path,
+    delete_video_by_path,
+    delete_images_by_paths,
+    delete_videos_by_paths,
+    iter_image_records_sorted,
+    iter_video_records_sorted,
+    get_image_path_time_checksum_map,
+    get_video_path_time_checksum_map,
+    get_image_features_by_checksums,
+    get_image_records_by_checksums,
+    get_video_frame_times_features_by_checksum,
+    get_video_records_by_checksums,
+    is_record_outdated,
+    move_images,
+    move_videos,
     add_video,
-    add_image,
+    add_images,
 )
-from app.models.models import create_tables, DatabaseSession
-from app.services.process_assets import process_images, process_video
+from app.models.models import create_tables, DatabaseSession, DatabaseSessionPexelsVideo
+from app.services.file_walker import FileWalker
+from app.services.scan_journal import ScanJournal
+from app.services.inference_pool import InferencePool
+from app.services.resource_governor import resource_governor
+from app.services.thumbnail_cache import get_default_format, thumbnail_cache
+from app.services.process_assets import get_images_data, get_inference_precision, process_images, process_video
 from app.routes.search import clean_cache
-from app.services.utils import get_file_hash
+from app.services.utils import get_file_checksum, thread_pool_map
+
+
+class SortedRecordCursor:
+    """
+    按路径升序读取的数据库记录，用于和按路径升序遍历的文件归并比对
+    扫描过程中新增的记录路径一定不大于已比对过的文件路径，所以读到这类记录时直接跳过，不会被误认为已删除的文件
+    """
+
+    def __init__(self, records):
+        """
+        :param records: 按路径升序返回 (path, modify_time, checksum) 的迭代器
+        """
+        self.records = iter(records)
+        self.current = next(self.records, None)
+        self.last_path = None  # 上一个比对过的文件路径
+
+    def advance(self):
+        self.current = next(self.records, None)
+        while self.current is not None and self.last_path is not None and self.current[0] <= self.last_path:
+            self.current = next(self.records, None)  # 扫描过程中新增的记录
+
+    def pop_before(self, path):
+        """
+        :return: 生成器，返回所有路径小于 path 的记录的路径（这些文件已不存在）
+        """
+        while self.current is not None and self.current[0] < path:
+            yield self.current[0]
+            self.advance()
+
+    def pop_match(self, path):
+        """
+        :return: 路径等于 path 的记录的 (modify_time, checksum)，没有则返回 None。调用前需要先调用 pop_before
+        """
+        record = None
+        if self.current is not None and self.current[0] == path:
+            record = tuple(self.current[1:])
+        self.last_path = path
+        if record is not None:
+            self.advance()
+        return record
+
+    def pop_rest(self):
+        """
+        :return: 生成器，返回剩余所有记录的路径
+        """
+        while self.current is not None:
+            yield self.current[0]
+            self.advance()
 
 
 class Scanner:
@@ -32,14 +101,17 @@ class Scanner:
         self.is_scanning = False
         self.scan_start_time = 0
         self.scanning_files = 0
-        self.total_images = 0
-        self.total_videos = 0
-        self.total_video_frames = 0
         self.scanned_files = 0
         self.is_continue_scan = False
         self.logger = logging.getLogger(__name__)
-        self.temp_file = f"{TEMP_PATH}/assets.pickle"
+        self.journal = ScanJournal(SCAN_JOURNAL_PATH)
         self.assets = set()
+        self.index_precisions = []  # 现有索引使用过的推理精度
+        self.reused_files = 0  # 本次扫描中复用已有特征的文件数
+        self.moved_files = 0  # 本次扫描中直接修改了记录路径的文件数
+        # 扫描时使用的多进程推理池，SCAN_INFERENCE_PROCESSES为0时不启用
+        self.inference_pool = InferencePool(*resource_governor.split_thread_budget(SCAN_INFERENCE_PROCESSES, SCAN_INFERENCE_THREADS))
+        self.pending_image_batches = deque()  # 已提交到推理池、还没写入数据库的图片批次
 
         # 自动扫描时间
         self.start_time = datetime.time(*AUTO_SCAN_START_TIME)
@@ -53,10 +125,13 @@ class Scanner:
 
     def init(self):
         create_tables()
-        with DatabaseSession() as session:
-            self.total_images = get_image_count(session)
-            self.total_videos = get_video_count(session)
-            self.total_video_frames = get_video_frame_count(session)
+        with DatabaseSession() as session, DatabaseSessionPexelsVideo() as pexels_session:
+            reconcile_asset_stats(session, pexels_session)
+            self.index_precisions = get_index_precisions(session)
+        if len(self.index_precisions) > 1:
+            self.logger.warning(f"索引中混合了不同推理精度的特征：{self.index_precisions}，建议删库后重新扫描")
+        elif self.index_precisions and INFERENCE_PRECISION not in self.index_precisions:
+            self.logger.warning(f"现有索引使用 {self.index_precisions[0]} 精度生成，当前配置为 {INFERENCE_PRECISION}")
 
     def get_status(self):
         """
@@ -75,11 +150,16 @@ class Scanner:
             progress = self.scanned_files / self.scanning_files
         else:
             progress = 0
+        # 数量统计在增删记录时已同步更新，这里只是定期重新统计一次，修正可能的误差
+        if not self.is_scanning and time.time() - asset_stats.reconcile_time > STATS_RECONCILE_INTERVAL:
+            with DatabaseSession() as session, DatabaseSessionPexelsVideo() as pexels_session:
+                reconcile_asset_stats(session, pexels_session)
         return {
             "status": self.is_scanning,
-            "total_images": self.total_images,
-            "total_videos": self.total_videos,
-            "total_video_frames": self.total_video_frames,
+            "total_images": asset_stats.total_images,
+            "total_videos": asset_stats.total_videos,
+            "total_video_frames": asset_stats.total_video_frames,
+            "index_precisions": self.index_precisions,
             "scanning_files": self.scanning_files,
             "remain_files": self.scanning_files - self.scanned_files,
             "progress": progress,
@@ -88,37 +168,30 @@ class Scanner:
         }
 
     def save_assets(self):
-        with open(self.temp_file, "wb") as f:
-            pickle.dump(self.assets, f)
+        """把已处理完成的文件追加写入扫描日志"""
+        if not SCAN_STREAMING:
+            self.journal.flush(self.assets)
 
-    def filter_path(self, path) -> bool:
-        """
-        过滤跳过的路径
-        """
-        if type(path) == str:
-            path = Path(path)
-        wrong_ext = path.suffix.lower() not in self.extensions
-        skip = any((path.is_relative_to(p) for p in self.skip_paths))
-        ignore = any((keyword in str(path).lower() for keyword in self.ignore_keywords))
-        self.logger.debug(f"{path} 不匹配后缀：{wrong_ext} 跳过：{skip} 忽略：{ignore}")
-        return not any((wrong_ext, skip, ignore))
+    def finish_asset(self, path):
+        """标记文件已处理完成"""
+        if not SCAN_STREAMING:
+            self.assets.remove(path)
+            self.journal.add(path)
 
     def generate_or_load_assets(self):
         """
-        若无缓存文件，扫描目录到self.assets, 并生成新的缓存文件；
-        否则加载缓存文件到self.assets
+        若无扫描日志，扫描目录到self.assets, 并生成新的扫描日志；
+        否则从扫描日志中读取剩余文件到self.assets
         :return: None
         """
-        if os.path.isfile(self.temp_file):
-            self.logger.info("读取上次的目录缓存")
+        if self.journal.exists():
+            self.logger.info("读取上次的扫描日志")
             self.is_continue_scan = True
-            with open(self.temp_file, "rb") as f:
-                self.assets = pickle.load(f)
-            self.assets = set((i for i in filter(self.filter_path, self.assets)))
+            self.assets = self.journal.load()
         else:
             self.is_continue_scan = False
             self.scan_dir()
-            self.save_assets()
+            self.journal.start(self.assets)
         self.scanning_files = len(self.assets)
 
     def is_current_auto_scan_time(self) -> bool:
@@ -153,92 +226,334 @@ class Scanner:
         遍历文件并将符合条件的文件加入 assets 集合
         """
         self.assets = set()
-        paths = [Path(i) for i in ASSETS_PATH if i]
-        # 遍历根目录及其子目录下的所有文件
-        for path in paths:
-            for file in filter(self.filter_path, path.rglob("*")):
-                self.assets.add(str(file))
+        dir_cache, known_files, expire_time = {}, {}, None
+        if SCAN_FULL_WALK_DAYS > 0:  # 读取上次扫描的目录缓存，超过 SCAN_FULL_WALK_DAYS 天的目录会重新遍历
+            expire_time = datetime.datetime.now() - datetime.timedelta(days=SCAN_FULL_WALK_DAYS)
+            with DatabaseSession() as session:
+                dir_cache = get_scan_directories(session)
+                if dir_cache:
+                    for path in get_asset_paths(session):
+                        known_files.setdefault(os.path.dirname(path) or ".", []).append(path)
+        walker = FileWalker(self.extensions, self.skip_paths, self.ignore_keywords)
+        # 并行遍历根目录及其子目录，跳过的目录不会进入，修改时间没变的目录直接沿用数据库中的文件
+        for file in walker.walk([i for i in ASSETS_PATH if i], dir_cache, known_files, expire_time):
+            self.assets.add(file)
+        self.logger.info(f"遍历目录完成：{len(walker.dir_records)} 个目录，其中 {walker.reused_dirs} 个目录无变更")
+        with DatabaseSession() as session:
+            save_scan_directories(session, walker.dir_records)
+
+    def get_file_info(self, path):
+        """
+        获取文件的修改时间和校验值
+        :param path: string, 文件路径
+        :return: (modify_time, checksum) 元组，文件不存在时返回 None
+        """
+        if not os.path.isfile(path):
+            return None
+        modify_time = os.path.getmtime(path)
+        checksum = None
+        if ENABLE_CHECKSUM:  # 如果启用checksum则用checksum
+            checksum = get_file_checksum(path)
+        try:  # 尝试把modify_time转换成datetime用来写入数据库
+            modify_time = datetime.datetime.fromtimestamp(modify_time)
+        except Exception as e:  # 如果无法转换修改日期，则改为checksum
+            self.logger.warning(f"文件修改日期有问题：{path} {modify_time} 导致datetime转换报错 {repr(e)}")
+            modify_time = None
+            if not checksum:
+                checksum = get_file_checksum(path)
+        return modify_time, checksum
 
     def handle_image_batch(self, session, image_batch_dict):
-        path_list, features_list = process_images(list(image_batch_dict.keys()))
+        """
+        处理一批图片。移动过来的图片直接改写原记录的路径，与已有图片内容相同的图片复用已有的特征，其余的图片计算特征。
+        启用了推理池时，只解码图片并提交到推理池，计算完成后再按顺序写入数据库
+        """
+        image_batch_dict = self.move_files(session, image_batch_dict)
+        records, image_batch_dict = self.split_duplicate_images(session, image_batch_dict)
+        if records:  # 与已有图片内容相同，直接复用特征
+            add_images(session, records)
+            self.reused_files += len(records)
+            for path, _, _, _ in records:
+                self.finish_asset(path)
+        if not image_batch_dict:
+            return
+        thumbnails = {} if SCAN_THUMBNAILS and thumbnail_cache.enabled else None  # 解码时顺便生成的缩略图
+        if self.inference_pool.executor is not None:
+            path_list, images = get_images_data(list(image_batch_dict.keys()), thumbnails=thumbnails)
+            if path_list:
+                file_infos = {path: image_batch_dict[path] for path in path_list}
+                self.pending_image_batches.append((path_list, file_infos, thumbnails, self.inference_pool.submit(images)))
+            self.write_image_batches(session)
+            return
+        path_list, features_list = process_images(list(image_batch_dict.keys()), thumbnails=thumbnails)
+        self.add_images(session, path_list, features_list, image_batch_dict, thumbnails)
+
+    def split_duplicate_images(self, session, file_infos):
+        """
+        找出与数据库中已有图片的 checksum 相同的图片（同一个文件的多个副本），这些图片直接复用已有的特征，不需要解码和推理
+        :param file_infos: dict, 图片路径 -> (modify_time, checksum)
+        :return: (复用特征的 (path, modify_time, checksum, features) 列表, 仍需计算特征的 {图片路径: (modify_time, checksum)})
+        """
+        checksums = list({checksum for _, checksum in file_infos.values() if checksum})
+        if not REUSE_DUPLICATE_FEATURES or not checksums:
+            return [], file_infos
+        features_map = get_image_features_by_checksums(session, checksums)
+        records, remaining = [], {}
+        for path, (modify_time, checksum) in file_infos.items():
+            features = features_map.get(checksum)
+            if features is None:
+                remaining[path] = (modify_time, checksum)
+            else:
+                records.append((path, modify_time, checksum, features))
+        return records, remaining
+
+    def get_duplicate_video_frames(self, session, checksum):
+        """
+        获取与 checksum 相同的已有视频（同一个文件的多个副本）的所有帧，用于直接复用特征
+        :return: list, (帧时间, features) 列表，没有可以复用的视频时返回空列表
+        """
+        if not REUSE_DUPLICATE_FEATURES or not checksum:
+            return []
+        return get_video_frame_times_features_by_checksum(session, checksum)
+
+    def add_images(self, session, path_list, features_list, file_infos, thumbnails=None):
+        """
+        把一批图片的特征写入数据库，并保存扫描时生成的缩略图
+        :param file_infos: dict, 图片路径 -> (modify_time, checksum)
+        :param thumbnails: dict, 图片路径 -> 编码后的缩略图数据
+        """
         if not path_list or features_list is None:
             return
-        for path, features in zip(path_list, features_list):
-            # 写入数据库
-            features = features.tobytes()
-            modify_time, checksum = image_batch_dict[path]
-            add_image(session, path, modify_time, checksum, features)
-            self.assets.remove(path)
-        self.total_images = get_image_count(session)
+        # 整批写入数据库，只提交一次
+        records = [(path, *file_infos[path], features.tobytes()) for path, features in zip(path_list, features_list)]
+        image_ids = add_images(session, records)
+        for path, image_id in zip(path_list, image_ids):
+            if thumbnails and path in thumbnails:
+                modify_time, checksum = file_infos[path]
+                fmt = get_default_format()
+                thumbnail_cache.put(thumbnail_cache.get_key(image_id, modify_time, checksum, fmt), fmt, thumbnails[path])
+            self.finish_asset(path)
+
+    def write_image_batches(self, session, wait_all=False):
+        """
+        按提交顺序把推理池中已完成的图片批次写入数据库。排队的批次达到上限时等待最早的批次完成
+        :param wait_all: bool, 是否等待所有批次完成
+        """
+        while self.pending_image_batches:
+            path_list, file_infos, thumbnails, future = self.pending_image_batches[0]
+            if not (wait_all or future.done() or len(self.pending_image_batches) >= self.inference_pool.max_pending):
+                break
+            self.pending_image_batches.popleft()
+            try:
+                features_list = future.result()
+            except Exception as e:
+                self.logger.exception(f"推理进程计算图片特征失败：{repr(e)}")
+                continue
+            self.add_images(session, path_list, features_list, file_infos, thumbnails)
+
+    def find_moved_paths(self, session, file_infos, is_image=True) -> dict:
+        """
+        找出从别处移动过来的文件：数据库中有修改时间和校验值都相同（文件指纹已包含文件大小）、但原路径已经不存在的记录。
+        整批文件只查询一次数据库。没有校验值时无法可靠地判断是否是同一个文件，不检测移动，按新文件处理
+        :param file_infos: dict, 文件路径 -> (modify_time, checksum)
+        :param is_image: bool, 是图片还是视频
+        :return: dict, 新路径 -> 原路径
+        """
+        checksums = list({checksum for modify_time, checksum in file_infos.values() if checksum and modify_time is not None})
+        if not checksums:
+            return {}
+        get_records = get_image_records_by_checksums if is_image else get_video_records_by_checksums
+        candidates = {}  # (修改时间, checksum) -> 原路径列表
+        for path, modify_time, checksum in get_records(session, checksums):
+            if path not in file_infos:
+                candidates.setdefault((modify_time, checksum), []).append(path)
+        moved, used = {}, set()
+        for path, (modify_time, checksum) in file_infos.items():
+            for old_path in candidates.get((modify_time, checksum), []):
+                if old_path not in used and not os.path.exists(old_path):
+                    moved[path] = old_path
+                    used.add(old_path)
+                    break
+        return moved
+
+    def move_files(self, session, file_infos, is_image=True) -> dict:
+        """
+        把从别处移动过来的文件的原记录路径直接改成新路径，保留特征，不重新计算
+        :param file_infos: dict, 文件路径 -> (modify_time, checksum)
+        :return: dict, 不是移动过来、仍需处理的文件 {文件路径: (modify_time, checksum)}
+        """
+        moved = self.find_moved_paths(session, file_infos, is_image)
+        if not moved:
+            return file_infos
+        moves = [(old_path, path) for path, old_path in moved.items()]
+        self.moved_files += len(move_images(session, moves) if is_image else move_videos(session, moves))
+        for path in moved:
+            self.finish_asset(path)
+        return {path: file_info for path, file_info in file_infos.items() if path not in moved}
+
+    def handle_file(self, session, path, file_info, record, image_batch_dict):
+        """
+        处理单个文件：如果数据库里有这个文件，并且没有发生变化，则跳过；如果是从别处移动过来的文件，则改写原记录的路径；否则进行预处理并入库
+        :param session: Session, 数据库 session
+        :param path: string, 文件路径
+        :param file_info: tuple, 文件的 (modify_time, checksum)
+        :param record: tuple, 数据库中的 (modify_time, checksum)，数据库中没有该文件时为 None
+        :param image_batch_dict: dict, 等待批量处理的图片，达到SCAN_PROCESS_BATCH_SIZE再进行批量处理
+        """
+        modify_time, checksum = file_info
+        if not is_record_outdated(record, modify_time, checksum):
+            self.logger.debug(f"文件无变更，跳过：{path}")
+            self.finish_asset(path)
+            return
+        if path.lower().endswith(IMAGE_EXTENSIONS):  # 图片，批量处理时再判断是否是移动过来的文件
+            if record is not None:
+                self.logger.info(f"文件有更新：{path}")
+                delete_image_by_path(session, path)
+            image_batch_dict[path] = (modify_time, checksum)
+            # 达到SCAN_PROCESS_BATCH_SIZE再进行批量处理
+            if len(image_batch_dict) == SCAN_PROCESS_BATCH_SIZE:
+                self.handle_image_batch(session, image_batch_dict)
+                image_batch_dict.clear()
+            return
+        elif path.lower().endswith(VIDEO_EXTENSIONS):  # 视频
+            if record is not None:
+                self.logger.info(f"文件有更新：{path}")
+                delete_video_by_path(session, path)
+            if not self.move_files(session, {path: file_info}, is_image=False):
+                return
+            frames = self.get_duplicate_video_frames(session, checksum)
+            if frames:  # 与已有视频内容相同，直接复用特征
+                self.reused_files += 1
+                add_video(session, path, modify_time, checksum, frames)
+            else:
+                pool = self.inference_pool if self.inference_pool.executor is not None else None
+                add_video(session, path, modify_time, checksum, process_video(path, pool, (modify_time, checksum)))
+        self.finish_asset(path)
+
+    def scan_assets(self, session, image_batch_dict, auto=False) -> bool:
+        """
+        先读取所有文件路径到self.assets，再与一次性读取的数据库记录比对并处理
+        :return: bool, 是否扫描完所有文件
+        """
+        self.generate_or_load_assets()
+        assets = self.assets.copy()
+        # 一次性读取数据库中已有文件的修改时间和checksum，在内存中比对，避免每个文件查询一次数据库
+        image_records = get_image_path_time_checksum_map(session)
+        video_records = get_video_path_time_checksum_map(session)
+        self.logger.info(f"已读取数据库记录：{len(image_records)} 个图片，{len(video_records)} 个视频")
+        # 不存在的文件记录在处理完文件后再删除，被移动的文件已经改写了路径，不会被删除后重新计算。断点恢复时不删除
+        removed_images, removed_videos = [], []
+        if not self.is_continue_scan:
+            removed_images = [path for path in image_records if path not in assets]
+            removed_videos = [path for path in video_records if path not in assets]
+        is_finished = True
+        # 在线程池中提前读取文件的修改时间和校验值，避免计算checksum时阻塞模型推理
+        for path, file_info in thread_pool_map(self.get_file_info, assets, resource_governor.limit_threads(CHECKSUM_WORKERS)):
+            self.scanned_files += 1
+            if self.scanned_files % AUTO_SAVE_INTERVAL == 0:  # 每扫描 AUTO_SAVE_INTERVAL 个文件重新save一下
+                self.save_assets()
+            if auto and not self.is_current_auto_scan_time():  # 如果是自动扫描，判断时间自动停止
+                self.logger.info(f"超出自动扫描时间，停止扫描")
+                is_finished = False
+                break
+            # 如果文件不存在，则忽略（扫描时文件被移动或删除则会触发这种情况）
+            if file_info is None:
+                continue
+            records = image_records if path.lower().endswith(IMAGE_EXTENSIONS) else video_records
+            self.handle_file(session, path, file_info, records.get(path), image_batch_dict)
+        self.delete_removed_files(session, removed_images, removed_videos)
+        return is_finished
+
+    def scan_streaming(self, session, image_batch_dict, auto=False) -> bool:
+        """
+        流式扫描：按路径顺序遍历文件，同时按路径顺序分页读取数据库记录，两者归并比对得到新增、修改和删除的文件，
+        不需要把所有文件路径和数据库记录读到内存中。不使用扫描日志和目录缓存，中断后下次从头开始（未修改的文件会很快跳过）。
+        :return: bool, 是否扫描完所有文件
+        """
+        image_cursor = SortedRecordCursor(iter_image_records_sorted(session))
+        video_cursor = SortedRecordCursor(iter_video_records_sorted(session))
+        removed_images, removed_videos = [], []  # 不存在的文件，处理完文件后再删除，被移动的文件已经改写了路径，不会被删除后重新计算
+        is_finished = True
+        self.scanning_files = asset_stats.total_images + asset_stats.total_videos  # 文件总数未知，先用数据库中的数量估计
+        walker = FileWalker(self.extensions, self.skip_paths, self.ignore_keywords)
+        paths = walker.walk_sorted([i for i in ASSETS_PATH if i])
+        for path, file_info in thread_pool_map(self.get_file_info, paths, resource_governor.limit_threads(CHECKSUM_WORKERS)):
+            self.scanned_files += 1
+            self.scanning_files = max(self.scanning_files, self.scanned_files)
+            if auto and not self.is_current_auto_scan_time():  # 如果是自动扫描，判断时间自动停止
+                self.logger.info(f"超出自动扫描时间，停止扫描")
+                is_finished = False
+                break
+            if path.lower().endswith(IMAGE_EXTENSIONS):
+                cursor, removed_paths = image_cursor, removed_images
+            else:
+                cursor, removed_paths = video_cursor, removed_videos
+            # 数据库中路径排在当前文件之前、但没有被遍历到的文件已被删除
+            removed_paths.extend(cursor.pop_before(path))
+            record = cursor.pop_match(path)
+            # 遍历后文件又被移动或删除了，数据库中的记录已经从游标中取出，需要在这里记为已删除
+            if file_info is None:
+                if record is not None:
+                    removed_paths.append(path)
+                continue
+            self.handle_file(session, path, file_info, record, image_batch_dict)
+        if is_finished:  # 数据库中排在最后一个文件之后的记录也都已被删除
+            removed_images.extend(image_cursor.pop_rest())
+            removed_videos.extend(video_cursor.pop_rest())
+        self.delete_removed_files(session, removed_images, removed_videos)
+        return is_finished
+
+    def delete_removed_files(self, session, removed_images, removed_videos):
+        """
+        批量删除已不存在的文件的数据库记录，删除后清空列表
+        """
+        for removed_paths, delete_func, name in (
+                (removed_images, delete_images_by_paths, "图片"),
+                (removed_videos, delete_videos_by_paths, "视频"),
+        ):
+            while removed_paths:
+                batch = removed_paths[:1000]
+                for path in batch:
+                    self.logger.debug(f"文件已删除：{path}")
+                count = delete_func(session, batch)
+                self.logger.info(f"删除不存在的文件记录：{count} 个{name}")
+                del removed_paths[:1000]
 
     def scan(self, auto=False):
         """
-        扫描资源。如果存在assets.pickle，则直接读取并开始扫描。如果不存在，则先读取所有文件路径，并写入assets.pickle，然后开始扫描。
-        每100个文件重新保存一次assets.pickle，如果程序被中断，下次可以从断点处继续扫描。扫描完成后删除assets.pickle并清缓存。
+        扫描资源。如果存在扫描日志，则读取剩余文件并开始扫描。如果不存在，则先读取所有文件路径，并写入扫描日志，然后开始扫描。
+        每AUTO_SAVE_INTERVAL个文件把已完成的文件追加到扫描日志，如果程序被中断或超出自动扫描时间，下次可以从断点处继续扫描。扫描完成后删除扫描日志并清缓存。
+        如果开启了SCAN_STREAMING，则使用流式扫描，见 scan_streaming。
         :param auto: 是否由AUTO_SCAN触发的
         """
         self.logger.info("开始扫描")
+        resource_governor.lower_thread_priority()  # 降低扫描线程的优先级，遍历、校验等子线程也会继承
         self.is_scanning = True
         self.scan_start_time = time.time()
-        self.generate_or_load_assets()
+        self.reused_files = 0
+        self.moved_files = 0
         with DatabaseSession() as session:
-            # 删除不存在的文件记录
-            if not self.is_continue_scan:  # 非断点恢复的情况下才删除
-                delete_record_if_not_exist(session, self.assets)
-            # 扫描文件
+            self.index_precisions = record_index_precision(session, get_inference_precision())
+            self.inference_pool.start()
             image_batch_dict = {}  # 批量处理文件的字典，用字典方便某个图片有问题的时候的处理
-            for path in self.assets.copy():
-                self.scanned_files += 1
-                if self.scanned_files % AUTO_SAVE_INTERVAL == 0:  # 每扫描 AUTO_SAVE_INTERVAL 个文件重新save一下
-                    self.save_assets()
-                if auto and not self.is_current_auto_scan_time():  # 如果是自动扫描，判断时间自动停止
-                    self.logger.info(f"超出自动扫描时间，停止扫描")
-                    break
-                # 如果文件不存在，则忽略（扫描时文件被移动或删除则会触发这种情况）
-                if not os.path.isfile(path):
-                    continue
-                modify_time = os.path.getmtime(path)
-                checksum = None
-                if ENABLE_CHECKSUM:  # 如果启用checksum则用checksum
-                    checksum = get_file_hash(path)
-                try:  # 尝试把modify_time转换成datetime用来写入数据库
-                    modify_time = datetime.datetime.fromtimestamp(modify_time)
-                except Exception as e:  # 如果无法转换修改日期，则改为checksum
-                    self.logger.warning("文件修改日期有问题：", path, modify_time, "导致datetime转换报错", repr(e))
-                    modify_time = None
-                    if not checksum:
-                        checksum = get_file_hash(path)
-                # 如果数据库里有这个文件，并且没有发生变化，则跳过，否则进行预处理并入库
-                if path.lower().endswith(IMAGE_EXTENSIONS):  # 图片
-                    not_modified = delete_image_if_outdated(session, path, modify_time, checksum)
-                    if not_modified:
-                        self.assets.remove(path)
-                        continue
-                    image_batch_dict[path] = (modify_time, checksum)
-                    # 达到SCAN_PROCESS_BATCH_SIZE再进行批量处理
-                    if len(image_batch_dict) == SCAN_PROCESS_BATCH_SIZE:
-                        self.handle_image_batch(session, image_batch_dict)
-                        image_batch_dict = {}
-                    continue
-                elif path.lower().endswith(VIDEO_EXTENSIONS):  # 视频
-                    not_modified = delete_video_if_outdated(session, path, modify_time, checksum)
-                    if not_modified:
-                        self.assets.remove(path)
-                        continue
-                    add_video(session, path, modify_time, checksum, process_video(path))
-                    self.total_video_frames = get_video_frame_count(session)
-                    self.total_videos = get_video_count(session)
-                self.assets.remove(path)
+            if SCAN_STREAMING:
+                is_finished = self.scan_streaming(session, image_batch_dict, auto)
+            else:
+                is_finished = self.scan_assets(session, image_batch_dict, auto)
             if len(image_batch_dict) != 0:  # 最后如果图片数量没达到SCAN_PROCESS_BATCH_SIZE，也进行一次处理
                 self.handle_image_batch(session, image_batch_dict)
+            self.write_image_batches(session, wait_all=True)
             # 最后重新统计一下数量
-            self.total_images = get_image_count(session)
-            self.total_videos = get_video_count(session)
-            self.total_video_frames = get_video_frame_count(session)
+            reconcile_asset_stats(session)
+        self.inference_pool.shutdown()  # 扫描结束后释放推理进程中的模型
         self.scanning_files = 0
         self.scanned_files = 0
-        os.remove(self.temp_file)
-        self.logger.info("扫描完成，用时%d秒" % int(time.time() - self.scan_start_time))
+        if is_finished:
+            self.journal.clear()
+        else:  # 保留扫描日志，下次从断点处继续扫描
+            self.save_assets()
+        self.logger.info("扫描完成，用时%d秒，%d 个文件是移动过来的，%d 个文件复用了已有特征" % (
+            int(time.time() - self.scan_start_time), self.moved_files, self.reused_files))
         clean_cache()  # 清空搜索缓存
         self.is_scanning = False
 
@@ -1,3 +1,4 @@
+import base64
 import logging
 import time
 from functools import lru_cache
@@ -10,12 +11,17 @@ from app.models.database import (
     get_image_features_by_id,
     get_video_paths,
     get_frame_times_features_by_path,
+    get_video_id_by_path,
     get_pexels_video_features,
 )
 from app.models.models import DatabaseSession, DatabaseSessionPexelsVideo
 from app.services.process_assets import match_batch, process_image, process_text
+from app.services.shared_index import shared_index
+from app.services.utils import SingleFlight
 
 logger = logging.getLogger(__name__)
+# 合并相同的并发搜索：缓存未命中时，同时到达的相同搜索只计算一次
+search_flight = SingleFlight()
 
 
 def clean_cache():
@@ -29,6 +35,14 @@ def clean_cache():
     search_pexels_video_by_text.cache_clear()
 
 
+def get_search_stats():
+    """
+    获取搜索合并的统计信息
+    :return: dict, executed 为实际执行的搜索次数，coalesced 为合并到其它相同搜索的次数，in_flight 为正在执行的搜索数
+    """
+    return search_flight.get_stats()
+
+
 def search_image_by_feature(
         positive_feature=None,
         negative_feature=None,
@@ -50,11 +64,16 @@ def search_image_by_feature(
     :return: list[dict], 搜索结果列表
     """
     t0 = time.time()
-    with DatabaseSession() as session:
-        ids, paths, features = get_image_id_path_features_filter_by_path_time(session, filter_path, start_time, end_time)
+    snapshot = shared_index.get()
+    if snapshot is not None:  # 多进程模式，使用共享索引
+        ids, paths, features = snapshot.filter_images(filter_path, start_time, end_time)
+    else:
+        with DatabaseSession() as session:
+            ids, paths, features = get_image_id_path_features_filter_by_path_time(session, filter_path, start_time, end_time)
     if len(ids) == 0:  # 没有素材，直接返回空
         return []
-    features = np.frombuffer(b"".join(features), dtype=np.float32).reshape(len(features), -1)
+    if snapshot is None:
+        features = np.frombuffer(b"".join(features), dtype=np.float32).reshape(len(features), -1)
     scores = match_batch(positive_feature, negative_feature, features, positive_threshold, negative_threshold)
     return_list = []
     for id, path, score in zip(ids, paths, scores):
@@ -71,6 +90,7 @@ def search_image_by_feature(
 
 
 @lru_cache(maxsize=CACHE_SIZE)
+@search_flight.wrap
 def search_image_by_text_path_time(
         positive_prompt="",
         negative_prompt="",
@@ -97,6 +117,7 @@ def search_image_by_text_path_time(
 
 
 @lru_cache(maxsize=CACHE_SIZE)
+@search_flight.wrap
 def search_image_by_image(img_id_or_path, threshold=IMAGE_THRESHOLD, filter_path="", start_time=None, end_time=None):
     """
     使用图片搜图片
@@ -159,6 +180,23 @@ def get_video_range(start_index, end_index, scores, frame_times):
     return start_time, end_time
 
 
+def iter_video_features(filter_path="", modify_time_start=None, modify_time_end=None):
+    """
+    逐个读取符合筛选条件的视频的特征，多进程模式下从共享索引读取，否则从数据库读取
+    :return: 生成器，每个视频返回 (路径, 获取视频id的函数, 帧时间列表, 特征矩阵)
+    """
+    snapshot = shared_index.get()
+    if snapshot is not None:
+        for path, video_id, frame_times, features in snapshot.iter_videos(filter_path, modify_time_start, modify_time_end):
+            yield path, lambda video_id=video_id: video_id, frame_times, features
+        return
+    with DatabaseSession() as session:
+        for path in get_video_paths(session, filter_path, modify_time_start, modify_time_end):
+            frame_times, features = get_frame_times_features_by_path(session, path)
+            features = np.frombuffer(b"".join(features), dtype=np.float32).reshape(len(features), -1)
+            yield path, lambda path=path: get_video_id_by_path(session, path), frame_times, features
+
+
 def search_video_by_feature(
         positive_feature=None,
         negative_feature=None,
@@ -181,29 +219,32 @@ def search_video_by_feature(
     """
     t0 = time.time()
     return_list = []
-    with DatabaseSession() as session:
-        for path in get_video_paths(session, filter_path, modify_time_start, modify_time_end):  # 逐个视频比对
-            frame_times, features = get_frame_times_features_by_path(session, path)
-            features = np.frombuffer(b"".join(features), dtype=np.float32).reshape(len(features), -1)
-            scores = match_batch(positive_feature, negative_feature, features, positive_threshold, negative_threshold)
-            index_pairs = get_index_pairs(scores)
-            for start_index, end_index in index_pairs:
-                score = max(scores[start_index: end_index + 1])
-                start_time, end_time = get_video_range(start_index, end_index, scores, frame_times)
-                return_list.append({
-                    "url": "api/get_video/%s" % base64.urlsafe_b64encode(path.encode()).decode()
-                           + "#t=%.1f,%.1f" % (start_time, end_time),
-                    "path": path,
-                    "score": float(score),
-                    "start_time": start_time,
-                    "end_time": end_time,
-                })
+    # 逐个视频比对
+    for path, get_video_id, frame_times, features in iter_video_features(filter_path, modify_time_start, modify_time_end):
+        scores = match_batch(positive_feature, negative_feature, features, positive_threshold, negative_threshold)
+        index_pairs = get_index_pairs(scores)
+        video_id = get_video_id() if index_pairs else None
+        for start_index, end_index in index_pairs:
+            score = max(scores[start_index: end_index + 1])
+            start_time, end_time = get_video_range(start_index, end_index, scores, frame_times)
+            return_list.append({
+                "url": "api/get_video/%s" % base64.urlsafe_b64encode(path.encode()).decode()
+                       + "#t=%.1f,%.1f" % (start_time, end_time),
+                "path": path,
+                "score": float(score),
+                "start_time": start_time,
+                "end_time": end_time,
+                # 片段中分数最高的采样帧作为预览图
+                "poster": "api/get_video_frame/%d/%d" % (
+                    video_id, frame_times[start_index + int(np.argmax(scores[start_index: end_index + 1]))]),
+            })
     logger.info("查询使用时间：%.2f" % (time.time() - t0))
     return_list = sorted(return_list, key=lambda x: x["score"], reverse=True)
     return return_list
 
 
 @lru_cache(maxsize=CACHE_SIZE)
+@search_flight.wrap
 def search_video_by_text_path_time(
         positive_prompt="",
         negative_prompt="",
@@ -230,6 +271,7 @@ def search_video_by_text_path_time(
 
 
 @lru_cache(maxsize=CACHE_SIZE)
+@search_flight.wrap
 def search_video_by_image(img_id_or_path, threshold=IMAGE_THRESHOLD, filter_path="", start_time=None, end_time=None):
     """
     使用图片搜视频
@@ -291,6 +333,7 @@ def search_pexels_video_by_feature(positive_feature, positive_threshold=POSITIVE
 
 
 @lru_cache(maxsize=CACHE_SIZE)
+@search_flight.wrap
 def search_pexels_video_by_text(positive_prompt: str, positive_threshold=POSITIVE_THRESHOLD):
     """
     通过文字搜索pexels视频
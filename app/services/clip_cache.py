@@ -0,0 +1,224 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from app.config import VIDEO_CLIP_CACHE_SIZE, VIDEO_CLIP_PATH, VIDEO_CLIP_WORKERS
+from app.services.file_cache import STALE_TEMP_SECONDS, FileCache
+from app.services.utils import crop_video
+
+logger = logging.getLogger(__name__)
+
+MAX_FINISHED_JOBS = 1000  # 保留的已结束任务数量上限，超出后删除最早结束的任务记录（不删除片段文件）
+LOCK_POLL_SECONDS = 0.5  # 其它进程正在截取同一个片段时，检查是否截取完成的间隔
+
+
+class ClipJob:
+    """一个截取视频片段的任务"""
+
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+    def __init__(self, job_id: str, path: str, ext: str, start_time: int, end_time: int):
+        self.id = job_id
+        self.path = path
+        self.ext = ext
+        self.start_time = start_time
+        self.end_time = end_time
+        self.status = self.PENDING
+        self.error = None
+        self.file_path = None  # 完成后片段在缓存中的路径
+        self.finished_at = None
+        self.done = threading.Event()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (self.DONE, self.FAILED)
+
+    @property
+    def download_name(self) -> str:
+        """下载时使用的文件名"""
+        return f"{self.start_time}_{self.end_time}_" + os.path.basename(self.path)
+
+    def finish(self, status: str, file_path: str = None, error: str = None):
+        self.status = status
+        self.file_path = file_path
+        self.error = error
+        self.finished_at = time.time()
+        self.done.set()
+
+    def to_dict(self) -> dict:
+        return {"job_id": self.id, "status": self.status, "error": self.error}
+
+
+class ClipJobManager:
+    """
+    后台截取视频片段
+    - 请求线程只提交任务，由固定数量的工作线程调用 ffmpeg，避免大量下载请求同时启动 ffmpeg
+    - 相同的片段（视频路径、修改时间、校验值、起止时间都相同）共用同一个任务，正在截取时不会重复截取
+    - 多进程模式下任务信息和锁文件保存在缓存目录中：任何一个工作进程都可以查询其它进程提交的任务，
+      同一个片段只有拿到锁的进程调用 ffmpeg，其它进程等待它完成
+    - ffmpeg 先写到临时文件，完成后再移动到缓存目录，不会读到写了一半的片段
+    - 片段保存在有大小上限的缓存目录中，重启后保留，超出上限时删除最久没有下载的片段
+    """
+
+    def __init__(self, directory: str = VIDEO_CLIP_PATH, max_size_mb: int = VIDEO_CLIP_CACHE_SIZE, workers: int = VIDEO_CLIP_WORKERS):
+        """
+        :param directory: str, 片段缓存目录
+        :param max_size_mb: int, 片段缓存最大占用空间，单位MB
+        :param workers: int, 同时运行的 ffmpeg 进程数
+        """
+        self.cache = FileCache(directory, max_size_mb)
+        self.workers = max(workers, 1)
+        self.executor = None
+        self.jobs = OrderedDict()  # 任务id -> ClipJob，按提交时间排序
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def get_key(path: str, modify_time, checksum: str, start_time: int, end_time: int) -> str:
+        """计算片段的键，同时用作任务id。视频变化后键也会变化，不会下载到旧的片段"""
+        raw = f"{path}|{modify_time}|{checksum or ''}|{start_time}|{end_time}"
+        return hashlib.sha1(raw.encode()).hexdigest()
+
+    def submit(self, path: str, modify_time, checksum: str, start_time: int, end_time: int) -> ClipJob:
+        """
+        提交截取任务。相同的片段已经在截取或已经截取好时，直接返回已有的任务
+        :param path: str, 视频路径
+        :param start_time: int, 开始时间，单位秒
+        :param end_time: int, 结束时间，单位秒
+        :return: ClipJob
+        """
+        job_id = self.get_key(path, modify_time, checksum, start_time, end_time)
+        ext = os.path.splitext(path)[1].lstrip(".").lower() or "mp4"
+        return self.start(job_id, path, ext, start_time, end_time)
+
+    def submit_again(self, job: ClipJob) -> ClipJob:
+        """重新提交已结束的任务，用于片段在下载前被淘汰的情况"""
+        return self.start(job.id, job.path, job.ext, job.start_time, job.end_time)
+
+    def start(self, job_id: str, path: str, ext: str, start_time: int, end_time: int) -> ClipJob:
+        """创建任务并放入队列，已有未结束或可用的任务时直接返回"""
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is not None and (not job.finished or self.get_file(job)):
+                return job
+            job = ClipJob(job_id, path, ext, start_time, end_time)
+            self.cache.put_meta(job_id, {"path": path, "ext": ext, "start_time": start_time, "end_time": end_time})
+            self.jobs[job_id] = job
+            self.jobs.move_to_end(job_id)
+            file_path = self.cache.get(job_id, ext)
+            if file_path is not None:  # 之前（包括重启前）已经截取过
+                job.finish(ClipJob.DONE, file_path)
+            else:
+                if self.executor is None:
+                    self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="clip")
+                self.executor.submit(self.run, job)
+            self.prune()
+        return job
+
+    @staticmethod
+    def acquire_lock(lock_path: str) -> bool:
+        """
+        创建锁文件，已经存在时返回 False。超过 STALE_TEMP_SECONDS 没有释放的锁视为截取进程异常退出时遗留的，删除后下次可以拿到
+        """
+        os.makedirs(os.path.dirname(lock_path), exist_ok=True)
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) > STALE_TEMP_SECONDS:
+                    os.remove(lock_path)
+            except OSError:
+                pass
+            return False
+
+    def run(self, job: ClipJob):
+        """在工作线程中截取片段。其它进程正在截取同一个片段时，等待它完成"""
+        job.status = ClipJob.RUNNING
+        lock_path = self.cache.get_side_path(job.id, "lock")
+        try:
+            while not self.acquire_lock(lock_path):
+                time.sleep(LOCK_POLL_SECONDS)
+                file_path = self.cache.get(job.id, job.ext)
+                if file_path is not None:
+                    job.finish(ClipJob.DONE, file_path)
+                    return
+        except Exception as e:
+            logger.exception(f"截取视频片段出错：{job.path}")
+            job.finish(ClipJob.FAILED, error=repr(e))
+            return
+        temp_path = self.cache.get_temp_path(job.id, job.ext)
+        try:
+            file_path = self.cache.get(job.id, job.ext)
+            if file_path is not None:  # 拿到锁之前其它进程刚好截取完
+                job.finish(ClipJob.DONE, file_path)
+            elif crop_video(job.path, temp_path, job.start_time, job.end_time) and os.path.isfile(temp_path):
+                job.finish(ClipJob.DONE, self.cache.put_file(job.id, job.ext, temp_path))
+            else:
+                job.finish(ClipJob.FAILED, error="ffmpeg 截取失败")
+        except Exception as e:
+            logger.exception(f"截取视频片段出错：{job.path}")
+            job.finish(ClipJob.FAILED, error=repr(e))
+        finally:
+            for path in (temp_path, lock_path):
+                if os.path.exists(path):
+                    os.remove(path)
+
+    def prune(self):
+        """删除过多的已结束任务记录，需持有锁"""
+        finished = [job_id for job_id, job in self.jobs.items() if job.finished]
+        for job_id in finished[:max(len(finished) - MAX_FINISHED_JOBS, 0)]:
+            del self.jobs[job_id]
+
+    def get_job(self, job_id: str):
+        """
+        获取任务，不存在时返回 None。本进程没有这个任务时（多进程模式下由其它工作进程提交），从缓存目录读取任务信息：
+        片段已经截取好时直接返回完成的任务，否则在本进程中提交，由 run 等待其它进程截取完成（或重新截取）
+        """
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is not None or not re.fullmatch(r"[0-9a-f]{40}", job_id):
+            return job
+        meta = self.cache.get_meta(job_id)
+        if meta is None:
+            return None
+        return self.start(job_id, meta["path"], meta["ext"], meta["start_time"], meta["end_time"])
+
+    def get_file(self, job: ClipJob):
+        """
+        获取已完成任务的片段文件，同时更新使用时间
+        :return: str, 文件路径；任务未完成、失败或片段已被淘汰时返回 None
+        """
+        if job.status != ClipJob.DONE:
+            return None
+        return self.cache.get(job.id, job.ext)
+
+    @staticmethod
+    def wait(job: ClipJob, timeout: float = None) -> bool:
+        """
+        等待任务结束
+        :param timeout: float, 最长等待秒数，None表示一直等待
+        :return: bool, 任务是否已结束
+        """
+        return job.done.wait(timeout)
+
+    def get_status(self) -> dict:
+        """获取任务队列状态"""
+        with self.lock:
+            statuses = [job.status for job in self.jobs.values()]
+        return {
+            "pending": statuses.count(ClipJob.PENDING),
+            "running": statuses.count(ClipJob.RUNNING),
+            "cache_mb": round(self.cache.total_bytes / 1024 / 1024, 1),
+        }
+
+
+clip_job_manager = ClipJobManager()
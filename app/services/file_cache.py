@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+import logging
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+STALE_TEMP_SECONDS = 3600  # 超过这个时间没有修改的临时文件和锁文件，视为进程异常退出时遗留的，可以删除
+RESCAN_SECONDS = 60  # 重新统计缓存目录的间隔，多个进程共用缓存目录时，由此得到其它进程写入和淘汰的文件
+
+
+class FileCache:
+    """
+    有大小上限的磁盘文件缓存
+    文件以 键.扩展名 保存，总大小超过上限时按最近使用时间淘汰。命中时更新文件修改时间，重启后按修改时间恢复使用顺序。
+    多进程模式下多个工作进程共用同一个缓存目录：临时文件名包含进程号，每个进程定期重新统计缓存目录（按修改时间排序，
+    包含其它进程的使用记录），总大小上限对所有进程一起生效；本进程没有记录的文件在读取时直接从磁盘查找。
+    """
+
+    def __init__(self, directory: str, max_size_mb: int):
+        """
+        :param directory: str, 缓存目录
+        :param max_size_mb: int, 缓存最大占用空间，单位MB，0表示不缓存
+        """
+        self.directory = os.path.abspath(directory)  # send_file 会把相对路径当作相对于 app 目录
+        self.max_bytes = max_size_mb * 1024 * 1024
+        self.entries = OrderedDict()  # 文件路径 -> 文件大小，按最近使用时间排序
+        self.total_bytes = 0
+        self.loaded = False
+        self.scanned_at = 0  # 上次统计缓存目录的时间
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_bytes > 0
+
+    def get_path(self, key: str, ext: str) -> str:
+        """缓存文件路径，按键的前两位分子目录，避免单个目录文件过多"""
+        return os.path.join(self.directory, key[:2], f"{key}.{ext}")
+
+    def get_temp_path(self, key: str, ext: str) -> str:
+        """写入缓存前使用的临时文件路径，保留扩展名（ffmpeg 等工具根据扩展名确定格式）"""
+        return os.path.join(self.directory, key[:2], f"{key}.{os.getpid()}-{threading.get_ident()}.tmp.{ext}")
+
+    def get_side_path(self, key: str, suffix: str) -> str:
+        """
+        与缓存文件放在一起的附加文件路径，不计入缓存大小
+        :param suffix: str, meta（附加信息，缓存文件被淘汰时一起删除）或 lock（锁文件）
+        """
+        return os.path.join(self.directory, key[:2], f"{key}.{suffix}")
+
+    def put_meta(self, key: str, meta: dict):
+        """保存附加信息，其它进程可以通过 get_meta 读取"""
+        path = self.get_side_path(key, "meta")
+        temp_path = f"{path}.{os.getpid()}-{threading.get_ident()}.tmp"
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(temp_path, path)
+
+    def get_meta(self, key: str):
+        """读取附加信息，没有时返回 None"""
+        try:
+            with open(self.get_side_path(key, "meta"), encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def scan(self):
+        """重新统计缓存目录中的文件，并删除异常退出时遗留的临时文件和锁文件，需持有锁。正在写入的临时文件（可能属于其它进程）保留"""
+        files, now = [], time.time()
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                if ".tmp" in name or name.endswith(".lock"):
+                    if now - stat.st_mtime > STALE_TEMP_SECONDS:
+                        try:
+                            os.remove(path)
+                        except OSError:
+                            pass
+                    continue
+                if name.endswith(".meta"):
+                    continue
+                files.append((stat.st_mtime, path, stat.st_size))
+        self.entries = OrderedDict((path, size) for _, path, size in sorted(files))
+        self.total_bytes = sum(self.entries.values())
+        self.scanned_at = now
+
+    def load(self):
+        """第一次访问时读取缓存目录中已有的文件，之后每 RESCAN_SECONDS 秒重新统计一次，需持有锁"""
+        if self.loaded and time.time() - self.scanned_at < RESCAN_SECONDS:
+            return
+        self.scan()
+        if not self.loaded:
+            self.loaded = True
+            logger.info(f"缓存目录 {self.directory}：{len(self.entries)} 个文件，{self.total_bytes / 1024 / 1024:.1f}MB")
+        self.evict()
+
+    def evict(self):
+        """淘汰最久没有使用的文件，直到总大小不超过上限，需持有锁。刚写入的文件总是保留，即使它本身就超过了上限"""
+        while self.total_bytes > self.max_bytes and len(self.entries) > 1:
+            path, size = self.entries.popitem(last=False)
+            self.total_bytes -= size
+            key = os.path.basename(path).split(".")[0]
+            for file_path in (path, self.get_side_path(key, "meta")):
+                try:
+                    os.remove(file_path)
+                except OSError:
+                    pass
+
+    def get(self, key: str, ext: str):
+        """
+        读取缓存的文件
+        :return: str, 文件路径，不存在时返回 None
+        """
+        path = self.get_path(key, ext)
+        with self.lock:
+            self.load()
+            try:
+                size = os.path.getsize(path)
+            except OSError:  # 不存在，或被其它进程淘汰、被外部删除
+                self.total_bytes -= self.entries.pop(path, 0)
+                return None
+            if path not in self.entries:  # 其它进程写入的文件
+                self.entries[path] = size
+                self.total_bytes += size
+            self.entries.move_to_end(path)
+        try:
+            os.utime(path)  # 记录使用时间，重启后用于恢复淘汰顺序
+        except OSError:
+            pass
+        return path
+
+    def put(self, key: str, ext: str, data: bytes) -> str:
+        """
+        保存数据，先写临时文件再替换，避免读到写了一半的文件
+        :return: str, 文件路径
+        """
+        temp_path = self.get_temp_path(key, ext)
+        os.makedirs(os.path.dirname(temp_path), exist_ok=True)
+        with open(temp_path, "wb") as f:
+            f.write(data)
+        return self.put_file(key, ext, temp_path)
+
+    def put_file(self, key: str, ext: str, temp_path: str) -> str:
+        """
+        把已经写好的临时文件移动到缓存中
+        :param temp_path: str, 临时文件路径，需与缓存目录在同一个文件系统，建议使用 get_temp_path
+        :return: str, 文件路径
+        """
+        path = self.get_path(key, ext)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        size = os.path.getsize(temp_path)
+        os.replace(temp_path, path)
+        with self.lock:
+            self.load()
+            self.total_bytes += size - self.entries.pop(path, 0)
+            self.entries[path] = size
+            self.evict()
+        return path
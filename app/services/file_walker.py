@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+import datetime
+import heapq
+import itertools
+import logging
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+from app.config import SCAN_WALK_WORKERS
+
+logger = logging.getLogger(__name__)
+
+
+class FileWalker:
+    """
+    基于 os.scandir 的并行目录遍历器
+    在进入子目录之前就剪掉跳过路径和包含忽略关键词的目录，多个线程并发遍历不同的子目录（对 NAS/NFS 等远程目录更友好），
+    并以生成器的形式把符合条件的文件路径逐个返回给调用方
+    """
+
+    def __init__(self, extensions, skip_paths, ignore_keywords, max_workers=SCAN_WALK_WORKERS):
+        """
+        :param extensions: tuple[str], 需要的文件后缀（小写）
+        :param skip_paths: list, 跳过的目录
+        :param ignore_keywords: list[str], 忽略关键词（小写），路径中包含这些关键词则跳过
+        :param max_workers: int, 并发遍历的线程数
+        """
+        self.extensions = tuple(extensions)
+        self.skip_paths = {self.normalize(p) for p in skip_paths}
+        self.ignore_keywords = tuple(ignore_keywords)
+        self.max_workers = max(max_workers, 1)
+        self.dir_cache = {}  # 上次扫描的目录信息，目录路径 -> (目录修改时间, 文件数量, 遍历时间)
+        self.dir_children = {}  # 上次扫描的目录结构，目录路径 -> 子目录列表
+        self.expire_time = None  # 在这个时间之前遍历的目录不再沿用缓存，需要重新列出
+        self.known_files = {}  # 数据库中已有的文件，目录路径 -> 文件路径列表
+        self.dir_records = {}  # 本次遍历的目录信息，格式同 dir_cache
+        self.reused_dirs = 0  # 本次遍历中沿用缓存、没有重新列出的目录数量
+
+    @staticmethod
+    def normalize(path) -> str:
+        """统一路径格式，用于和跳过路径比较"""
+        return os.path.normcase(os.path.abspath(path))
+
+    def is_skipped_root(self, path) -> bool:
+        """
+        判断根目录本身是否需要跳过（根目录位于跳过路径之下，或根目录路径包含忽略关键词）
+        """
+        path = self.normalize(path)
+        if any(path == p or path.startswith(p.rstrip(os.sep) + os.sep) for p in self.skip_paths):
+            return True
+        return any(keyword in path.lower() for keyword in self.ignore_keywords)
+
+    def is_ignored_name(self, name: str) -> bool:
+        """文件名或目录名是否包含忽略关键词"""
+        name = name.lower()
+        return any(keyword in name for keyword in self.ignore_keywords)
+
+    def is_wanted_file(self, name: str) -> bool:
+        """文件名是否符合后缀要求且不包含忽略关键词"""
+        return os.path.splitext(name)[1].lower() in self.extensions and not self.is_ignored_name(name)
+
+    def reuse_cached_dir(self, path: str, modify_time: float):
+        """
+        如果目录修改时间与上次扫描时相同（说明目录中没有新增、删除或重命名的文件），并且数据库中该目录的文件数量与上次列出的数量一致，
+        则直接沿用数据库中的文件和上次的子目录，不再列出目录内容。缓存过期的目录需要重新列出
+        :return: (文件路径列表, 子目录列表)，无法沿用时返回 None
+        """
+        cached = self.dir_cache.get(path)
+        if not cached or cached[0] != modify_time or (self.expire_time and cached[2] < self.expire_time):
+            return None
+        files = self.known_files.get(path, [])
+        if len(files) != cached[1]:
+            return None
+        files = [f for f in files if self.is_wanted_file(os.path.basename(f))]
+        dirs = [d for d in self.dir_children.get(path, [])
+                if not self.is_ignored_name(os.path.basename(d)) and self.normalize(d) not in self.skip_paths]
+        return files, dirs
+
+    def scan_one_dir(self, path: str):
+        """
+        列出单个目录，不递归
+        :param path: str, 目录路径
+        :return: (符合条件的文件路径列表, 需要继续遍历的子目录列表, 目录信息)，目录信息格式同 dir_cache，读取失败时为 None
+        """
+        files, dirs = [], []
+        try:
+            modify_time = os.stat(path).st_mtime
+        except OSError as e:
+            logger.warning(f"读取目录失败：{path} {repr(e)}")
+            return files, dirs, None
+        reused = self.reuse_cached_dir(path, modify_time)
+        if reused is not None:
+            logger.debug(f"目录无变更，沿用上次的扫描结果：{path}")
+            return reused[0], reused[1], self.dir_cache[path]
+        try:
+            with os.scandir(path) as it:
+                for entry in it:
+                    if self.is_ignored_name(entry.name):
+                        continue
+                    # 与 pathlib 的路径格式保持一致（如 "." 下的文件不带 "./" 前缀），保证和数据库中已有的路径相同
+                    entry_path = entry.name if path == "." else os.path.join(path, entry.name)
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            if self.normalize(entry_path) not in self.skip_paths:
+                                dirs.append(entry_path)
+                        elif os.path.splitext(entry.name)[1].lower() in self.extensions and entry.is_file():
+                            files.append(entry_path)
+                    except OSError as e:
+                        logger.warning(f"读取文件信息失败：{entry.path} {repr(e)}")
+        except OSError as e:
+            logger.warning(f"读取目录失败：{path} {repr(e)}")
+            return files, dirs, None
+        return files, dirs, (modify_time, len(files), datetime.datetime.now())
+
+    def walk(self, root_paths, dir_cache=None, known_files=None, expire_time=None):
+        """
+        并行遍历多个根目录
+        :param root_paths: list, 根目录列表
+        :param dir_cache: dict, 上次扫描的全部目录信息，目录路径 -> (目录修改时间, 文件数量, 遍历时间)，为空则完整遍历。
+            过期的目录也要传入，沿用上级目录的缓存时才能得到完整的子目录列表
+        :param known_files: dict, 数据库中已有的文件，目录路径 -> 文件路径列表
+        :param expire_time: datetime, 在这个时间之前遍历的目录不再沿用缓存
+        :return: 生成器，逐个返回符合条件的文件路径（str），顺序不固定。遍历结束后 self.dir_records 为本次的目录信息
+        """
+        self.dir_cache = dir_cache or {}
+        self.known_files = known_files or {}
+        self.expire_time = expire_time
+        self.dir_children = {}
+        for directory in self.dir_cache:
+            parent = os.path.dirname(directory) or "."
+            if parent != directory:
+                self.dir_children.setdefault(parent, []).append(directory)
+        self.dir_records = {}
+        self.reused_dirs = 0
+        roots = [str(Path(p)) for p in root_paths if p and not self.is_skipped_root(p)]
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="FileWalker") as executor:
+            pending = {executor.submit(self.scan_one_dir, root): root for root in roots}
+            while pending:
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path = pending.pop(future)
+                    files, dirs, record = future.result()
+                    if record is None:
+                        # 读取失败的目录也要记录，上级目录沿用缓存时才不会漏掉它；修改时间为空，下次一定会重新列出
+                        record = (None, 0, datetime.datetime.now())
+                    elif record is self.dir_cache.get(path):
+                        self.reused_dirs += 1
+                    self.dir_records[path] = record
+                    for directory in dirs:
+                        pending[executor.submit(self.scan_one_dir, directory)] = directory
+                    yield from files
+
+    def walk_sorted(self, root_paths, prefetch=None):
+        """
+        按路径字符串顺序遍历多个根目录（与数据库 ORDER BY path 的顺序一致），用于和数据库记录归并比对
+        用一个堆保存已列出但还没返回的文件和还没展开的目录：目录以 "目录路径 + 分隔符" 为键，它下面所有文件的路径都不小于这个键，
+        所以目录总是在需要它下面的文件之前被展开。内存占用只和当前展开的目录大小有关，与素材总数无关。
+        最多提前 prefetch 个目录提交到线程池列出（总是最先需要展开的那些目录），展开时直接取结果，
+        不会把很宽的目录树中所有兄弟目录的内容同时读入内存。
+        :param root_paths: list, 根目录列表
+        :param prefetch: int, 最多同时提前列出的目录数，默认为线程数的2倍
+        :return: 生成器，按路径升序逐个返回符合条件的文件路径（str），不会重复
+        """
+        prefetch = max(prefetch or self.max_workers * 2, 1)
+        roots = [str(Path(p)) for p in root_paths if p and not self.is_skipped_root(p)]
+        heap = []  # (键, 序号, 路径, 是否是目录)
+        dir_heap = []  # 还没提交列出的目录 (键, 序号, 路径)，与 heap 中的目录顺序相同
+        futures = {}  # 已提交列出、还没展开的目录，序号 -> (键, 路径, future)
+        counter = itertools.count()  # 键相同时按入堆顺序排序
+        last_path = None
+        with ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="FileWalker") as executor:
+            def push_dir(directory):
+                if directory == ".":  # "." 下的文件不带前缀
+                    key = ""
+                elif directory.endswith(os.sep):  # 如 "/" 或 "C:\\"
+                    key = directory
+                else:
+                    key = directory + os.sep
+                entry = (key, next(counter), directory)
+                heapq.heappush(heap, entry + (True,))
+                heapq.heappush(dir_heap, entry)
+
+            def fill_prefetch():
+                while dir_heap:
+                    if len(futures) >= prefetch:
+                        # 新展开的子目录排在已提交的目录之前时，取消最后才需要、还没开始列出的目录，保证提前列出的总是最先需要的目录
+                        last = max(futures, key=lambda i: (futures[i][0], i))
+                        key, directory, future = futures[last]
+                        if (key, last) < dir_heap[0][:2] or not future.cancel():
+                            return
+                        del futures[last]
+                        heapq.heappush(dir_heap, (key, last, directory))
+                        continue
+                    key, index, directory = heapq.heappop(dir_heap)
+                    futures[index] = (key, directory, executor.submit(self.scan_one_dir, directory))
+
+            for root in roots:
+                push_dir(root)
+            fill_prefetch()
+            while heap:
+                key, index, path, is_dir = heapq.heappop(heap)
+                if not is_dir:  # 文件
+                    if path != last_path:  # 根目录有重叠时跳过重复的文件
+                        last_path = path
+                        yield path
+                    continue
+                if index in futures:
+                    files, dirs, _ = futures.pop(index)[2].result()
+                else:  # 提前列出的目录都已经开始列出、无法取消时，这个目录还没有提交，它一定是 dir_heap 中最小的目录
+                    heapq.heappop(dir_heap)
+                    files, dirs, _ = self.scan_one_dir(path)
+                for file in files:
+                    heapq.heappush(heap, (file, next(counter), file, False))
+                for directory in dirs:
+                    push_dir(directory)
+                fill_prefetch()
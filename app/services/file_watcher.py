@@ -1,32 +1,68 @@
-import datetime
 import logging
 import os
 import threading
+import time
+from collections import OrderedDict
 from pathlib import Path
 from watchdog.events import FileSystemEventHandler
 
 from app.config import (
     ASSETS_PATH,
+    FILE_WATCH_MAX_BACKOFF,
+    FILE_WATCH_MAX_RETRIES,
+    FILE_WATCH_QUEUE_SIZE,
+    FILE_WATCH_SETTLE_SECONDS,
     IMAGE_EXTENSIONS,
     VIDEO_EXTENSIONS,
+    SCAN_PROCESS_BATCH_SIZE,
     SKIP_PATH,
     IGNORE_STRINGS,
 )
 from app.models.database import (
+    add_images,
+    add_video,
     delete_image_by_path,
     delete_video_by_path,
-    get_image_count,
-    get_video_count,
-    get_video_frame_count,
+    move_images,
+    move_videos,
+    record_index_precision,
 )
 from app.models.models import DatabaseSession
-from app.services.process_assets import process_images, process_video
-from app.services.utils import get_file_hash
+from app.services.process_assets import get_inference_precision, process_images, process_video
+from app.services.resource_governor import resource_governor
 
 
 logger = logging.getLogger(__name__)
 
 
+def get_file_stat(path):
+    """
+    读取文件大小和修改时间，用于判断文件是否已经写完
+    :return: (size, mtime)，文件不存在时返回 None
+    """
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime
+
+
+class QueuedFile:
+    """队列中等待处理的文件"""
+
+    def __init__(self, event_type, stat, old_path=None):
+        self.event_type = event_type
+        self.stat = stat  # 最后一次看到的 (size, mtime)
+        self.old_path = old_path  # 文件从这个路径移动过来，处理时先把这个路径的记录移过来或删除
+        self.due = 0  # 下一次检查的时间
+        self.retries = 0  # 文件还在写入、推迟处理的次数
+        self.reset_due()
+
+    def reset_due(self):
+        """重新开始等待文件写完，删除事件不需要等待"""
+        self.due = time.time() + (0 if self.event_type == 'deleted' else FILE_WATCH_SETTLE_SECONDS)
+
+
 class FileWatchEventHandler(FileSystemEventHandler):
     """
     文件监控事件处理器
@@ -75,10 +111,17 @@ class FileWatchEventHandler(FileSystemEventHandler):
         old_path = event.src_path
         logger.info(f"触发移动事件: {old_path} -> {file_path}, 是目录: {event.is_directory}")
 
+        # 新旧路径都在监控范围内且类型相同时，由处理线程只修改记录的路径，不重新计算特征
+        if (self.file_watcher.should_watch(old_path) and self.file_watcher.should_watch(file_path)
+                and old_path.lower().endswith(IMAGE_EXTENSIONS) == file_path.lower().endswith(IMAGE_EXTENSIONS)):
+            logger.info(f"移动的文件在监控范围内，添加到队列更新记录路径: {old_path} -> {file_path}")
+            self.file_watcher.add_to_queue(file_path, 'moved', old_path=old_path)
+            return
+
         # 如果旧路径在监控范围内，删除旧记录
         if self.file_watcher.should_watch(old_path):
-            logger.info(f"移动的旧文件在监控范围内，删除旧记录: {old_path}")
-            self.file_watcher.remove_from_database(old_path)
+            logger.info(f"移动的旧文件在监控范围内，添加到队列删除旧记录: {old_path}")
+            self.file_watcher.add_to_queue(old_path, 'deleted')
         else:
             logger.info(f"移动的旧文件不在监控范围内，跳过删除: {old_path}")
 
@@ -101,24 +144,41 @@ class FileWatchEventHandler(FileSystemEventHandler):
             logger.info(f"文件不在监控范围内，跳过删除: {file_path}")
             return
 
-        logger.info(f"检测到文件删除，准备从数据库删除: {file_path}")
-        self.file_watcher.remove_from_database(file_path)
+        logger.info(f"检测到文件删除，添加到队列删除记录: {file_path}")
+        self.file_watcher.add_to_queue(file_path, 'deleted')
 
 
 class FileWatcher:
     """
     文件监控器
-    实时监控文件变化并自动处理
+    实时监控文件变化并自动处理。事件只把文件放入队列，由一个常驻的处理线程取出，只有处理线程写数据库：
+    - 同一个文件的多次事件合并成一次，最后一次事件之后等待 FILE_WATCH_SETTLE_SECONDS 秒再检查
+    - 检查时文件大小和修改时间与上次看到的相同、且修改时间已经过去 FILE_WATCH_SETTLE_SECONDS 秒，才认为文件已经写完；
+      否则按指数退避推迟检查，推迟超过 FILE_WATCH_MAX_RETRIES 次后放弃（之后的扫描会处理）
+    - 图片凑成整批推理并一次写入数据库，视频逐个处理
+    - 文件被移动或重命名时只修改数据库记录的路径，不重新计算特征；删除事件不需要等待，下一次取出队列时就删除记录
+    - 队列中的文件数达到 FILE_WATCH_QUEUE_SIZE 后丢弃新的事件，处理完队列后自动扫描一次，补上被丢弃的文件
     """
 
     def __init__(self, scanner):
         self.scanner = scanner
         self.observer = None
-        self.file_queue = {}  # {file_path: event_type}
+        self.file_queue = OrderedDict()  # {file_path: QueuedFile}
         self.queue_lock = threading.Lock()
+        self.queue_changed = threading.Condition(self.queue_lock)
         self.processing = False
-        self.batch_timer = None
-        self.batch_delay = 2.0  # 批量处理延迟（秒），避免频繁处理
+        self.stopping = False
+        self.worker = None
+        self.overflowed = False  # 队列满后丢弃过事件，需要补扫
+        # 统计信息
+        self.processed_files = 0  # 已处理的文件数
+        self.moved_files = 0  # 直接修改了记录路径的文件数
+        self.reused_files = 0  # 复用已有特征的文件数（同一个文件的多个副本）
+        self.merged_events = 0  # 合并到队列中已有文件的事件数
+        self.dropped_events = 0  # 队列满时丢弃的事件数
+        self.settle_retries = 0  # 文件还在写入、推迟处理的次数
+        self.unsettled_files = 0  # 推迟次数超过上限、放弃处理的文件数
+        self.missing_files = 0  # 处理前已经不存在的文件数
 
         # 处理跳过路径
         self.skip_paths = [Path(i) for i in SKIP_PATH if i]
@@ -164,19 +224,43 @@ class FileWatcher:
 
         return True
 
-    def add_to_queue(self, file_path, event_type):
+    def add_to_queue(self, file_path, event_type, old_path=None):
         """
-        添加文件到处理队列
+        添加文件到处理队列，同一个文件的多次事件合并成一次，并重新开始等待文件写完
+        :param event_type: string, created/modified/moved/deleted
+        :param old_path: string, moved 事件的原路径
         """
+        stat = get_file_stat(file_path)
         with self.queue_lock:
-            self.file_queue[file_path] = event_type
+            if old_path is not None:
+                pending = self.file_queue.pop(old_path, None)
+                if pending is not None and pending.event_type == 'moved':
+                    old_path = pending.old_path  # 连续移动，从最初的路径移过来
+                elif pending is not None:
+                    # 原路径的新内容还没处理，数据库中的记录已经过时，删除原记录、按新文件处理
+                    self.file_queue[old_path] = QueuedFile('deleted', None)
+                    event_type, old_path = 'created', None
+            queued = self.file_queue.get(file_path)
+            if queued is not None:
+                self.merged_events += 1
+                if old_path is not None and queued.old_path not in (None, old_path):
+                    # 新路径上等待移动过来的文件被覆盖了，它的原记录不再需要
+                    self.file_queue.setdefault(queued.old_path, QueuedFile('deleted', None))
+                queued.old_path = old_path or queued.old_path
+                queued.event_type = event_type
+                queued.stat = stat
+                queued.reset_due()
+                self.queue_changed.notify()
+                return
+            if len(self.file_queue) >= FILE_WATCH_QUEUE_SIZE:
+                if not self.overflowed:
+                    logger.warning(f"文件监控队列已满（{FILE_WATCH_QUEUE_SIZE}），丢弃新的事件，处理完队列后将自动扫描")
+                self.overflowed = True
+                self.dropped_events += 1
+                return
+            self.file_queue[file_path] = QueuedFile(event_type, stat, old_path)
             logger.debug(f"添加文件到队列: {file_path} ({event_type})")
-
-        # 重置批量处理计时器
-        if self.batch_timer:
-            self.batch_timer.cancel()
-        self.batch_timer = threading.Timer(self.batch_delay, self.process_queue)
-        self.batch_timer.start()
+            self.queue_changed.notify()
 
     def remove_from_database(self, file_path):
         """
@@ -187,107 +271,211 @@ class FileWatcher:
                 if file_path.lower().endswith(IMAGE_EXTENSIONS):
                     delete_image_by_path(session, file_path)
                     logger.info(f"从数据库删除图片: {file_path}")
-                    self.scanner.total_images = get_image_count(session)
                 elif file_path.lower().endswith(VIDEO_EXTENSIONS):
                     delete_video_by_path(session, file_path)
                     logger.info(f"从数据库删除视频: {file_path}")
-                    self.scanner.total_videos = get_video_count(session)
-                    self.scanner.total_video_frames = get_video_frame_count(session)
             except Exception as e:
                 logger.error(f"删除数据库记录失败: {file_path}, 错误: {e}")
 
-    def process_queue(self):
+    def take_due_files(self) -> dict:
         """
-        批量处理队列中的文件
+        等待并取出到了检查时间的文件，停止时取出全部文件
+        :return: dict, {file_path: QueuedFile}，停止且队列为空时返回空字典
         """
         with self.queue_lock:
-            if not self.file_queue:
-                return
-
-            files_to_process = self.file_queue.copy()
+            while not self.stopping:
+                now = time.time()
+                due = [path for path, queued in self.file_queue.items() if queued.due <= now]
+                if due:
+                    return OrderedDict((path, self.file_queue.pop(path)) for path in due)
+                if self.file_queue:
+                    self.queue_changed.wait(min(queued.due for queued in self.file_queue.values()) - now)
+                else:
+                    self.queue_changed.wait()
+            files = OrderedDict(self.file_queue)
             self.file_queue.clear()
+            return files
 
-        if not files_to_process:
-            return
-
+    def check_settled(self, files: dict) -> dict:
+        """
+        检查文件是否已经写完，没有写完的文件按指数退避放回队列。删除事件和已经不存在的文件直接交给处理线程删除记录
+        :param files: dict, {file_path: QueuedFile}
+        :return: dict, 已经写完或需要删除记录的文件 {file_path: QueuedFile}
+        """
+        settled = OrderedDict()
+        now = time.time()
+        for path, queued in files.items():
+            if queued.event_type == 'deleted':
+                settled[path] = queued
+                continue
+            stat = get_file_stat(path)
+            if stat is None:
+                self.missing_files += 1
+                logger.debug(f"文件不存在，删除记录: {path}")
+                queued.event_type = 'deleted'
+                settled[path] = queued
+                continue
+            if self.stopping or (stat == queued.stat and now - stat[1] >= FILE_WATCH_SETTLE_SECONDS):
+                settled[path] = queued
+                continue
+            queued.retries += 1
+            self.settle_retries += 1
+            if queued.retries > FILE_WATCH_MAX_RETRIES:
+                self.unsettled_files += 1
+                logger.warning(f"文件一直在变化，放弃处理，之后的扫描会处理: {path}")
+                continue
+            queued.stat = stat
+            queued.due = now + min(FILE_WATCH_SETTLE_SECONDS * 2 ** queued.retries, FILE_WATCH_MAX_BACKOFF)
+            with self.queue_lock:
+                if path in self.file_queue:  # 检查期间又有新的事件，已经重新放入队列
+                    self.merged_events += 1
+                    if self.file_queue[path].old_path is None:
+                        self.file_queue[path].old_path = queued.old_path
+                else:
+                    self.file_queue[path] = queued
+        return settled
+
+    def run(self):
+        """处理线程：不断取出队列中已经写完的文件并处理"""
+        resource_governor.lower_thread_priority()  # 在处理线程中降低优先级，不影响其它线程
+        while True:
+            files = self.take_due_files()
+            if not files:
+                if self.stopping:
+                    return
+                continue
+            files_to_process = self.check_settled(files)
+            if files_to_process:
+                self.process_files(files_to_process)
+            with self.queue_lock:
+                rescan = self.overflowed and not self.file_queue
+                if rescan:
+                    self.overflowed = False
+            if rescan and not self.stopping and not self.scanner.is_scanning:
+                logger.info("文件监控队列曾经溢出，开始扫描以补上被丢弃的文件")
+                threading.Thread(target=self.scanner.scan, args=(False,)).start()
+
+    def process_files(self, files_to_process):
+        """
+        批量处理文件：先处理移动和删除，再把图片按 SCAN_PROCESS_BATCH_SIZE 分批推理并整批写入数据库，视频逐个处理。
+        原路径在数据库中没有记录、无法直接修改路径的移动，删除原记录后按新文件处理
+        :param files_to_process: dict, {file_path: QueuedFile}
+        """
         logger.info(f"开始处理 {len(files_to_process)} 个文件变化")
         self.processing = True
+        moved = self.move_in_database(files_to_process)
+        images, videos = [], []
+        for file_path, queued in files_to_process.items():
+            if file_path in moved:
+                continue
+            if queued.old_path is not None:
+                self.remove_from_database(queued.old_path)
+            if queued.event_type == 'deleted':
+                self.remove_from_database(file_path)
+                continue
+            file_info = self.scanner.get_file_info(file_path)
+            if file_info is None:
+                logger.debug(f"文件不存在，跳过: {file_path}")
+                continue
+            if file_path.lower().endswith(IMAGE_EXTENSIONS):
+                images.append((file_path, file_info))
+            elif file_path.lower().endswith(VIDEO_EXTENSIONS):
+                videos.append((file_path, file_info))
 
         try:
             with DatabaseSession() as session:
-                for file_path, event_type in files_to_process.items():
-                    if not os.path.exists(file_path):
-                        logger.debug(f"文件不存在，跳过: {file_path}")
-                        continue
-
+                self.scanner.index_precisions = record_index_precision(session, get_inference_precision())
+                for i in range(0, len(images), SCAN_PROCESS_BATCH_SIZE):
+                    try:
+                        self.process_image_batch(session, dict(images[i:i + SCAN_PROCESS_BATCH_SIZE]))
+                    except Exception as e:
+                        session.rollback()
+                        logger.error(f"处理图片失败: {[path for path, _ in images[i:i + SCAN_PROCESS_BATCH_SIZE]]}, 错误: {e}")
+                for file_path, file_info in videos:
                     try:
-                        if file_path.lower().endswith(IMAGE_EXTENSIONS):
-                            self.process_image(session, file_path)
-                        elif file_path.lower().endswith(VIDEO_EXTENSIONS):
-                            self.process_video(session, file_path)
+                        self.process_video(session, file_path, file_info)
                     except Exception as e:
+                        session.rollback()
                         logger.error(f"处理文件失败: {file_path}, 错误: {e}")
         except Exception as e:
             logger.error(f"批量处理文件时发生错误: {e}")
         finally:
             self.processing = False
+            self.processed_files += len(files_to_process)
             logger.info("文件变化处理完成")
 
-    def process_image(self, session, file_path):
+    def move_in_database(self, files) -> set:
         """
-        处理图片文件
+        修改移动过来的文件的数据库记录路径，保留特征，不重新计算。图片和视频各提交一次
+        :param files: dict, {file_path: QueuedFile}
+        :return: set, 成功修改了路径的新路径
         """
-        modify_time = os.path.getmtime(file_path)
-        checksum = None
-
-        try:
-            modify_time = datetime.datetime.fromtimestamp(modify_time)
-        except Exception as e:
-            logger.warning(f"文件修改日期转换失败: {file_path}, 错误: {e}")
-            modify_time = datetime.datetime.now()
-            checksum = get_file_hash(file_path)
-
-        # 如果checksum为None，则使用空字符串
-        if checksum is None:
-            checksum = ""
+        image_moves, video_moves = [], []
+        for file_path, queued in files.items():
+            if queued.event_type == 'moved' and queued.old_path is not None:
+                moves = image_moves if file_path.lower().endswith(IMAGE_EXTENSIONS) else video_moves
+                moves.append((queued.old_path, file_path))
+        moved = set()
+        if not image_moves and not video_moves:
+            return moved
+        with DatabaseSession() as session:
+            for move, moves in ((move_images, image_moves), (move_videos, video_moves)):
+                if not moves:
+                    continue
+                try:
+                    moved.update(move(session, moves))
+                except Exception as e:
+                    session.rollback()
+                    logger.error(f"更新数据库记录路径失败: {moves}, 错误: {e}")
+        self.moved_files += len(moved)
+        return moved
 
-        # 使用批量处理
-        path_list, features_list = process_images([file_path])
-        if not path_list or features_list is None:
+    def process_image_batch(self, session, file_infos):
+        """
+        处理一批图片，整批推理后一次写入数据库，替换这些路径原有的记录。与已有图片内容相同的图片直接复用特征
+        :param file_infos: dict, {file_path: (modify_time, checksum)}
+        """
+        records, file_infos = self.scanner.split_duplicate_images(session, file_infos)
+        self.reused_files += len(records)
+        if file_infos:
+            path_list, features_list = process_images(list(file_infos.keys()))
+            if path_list and features_list is not None:
+                records += [(path, *file_infos[path], features.tobytes()) for path, features in zip(path_list, features_list)]
+        if not records:
             return
+        add_images(session, records, replace=True)
+        logger.info(f"添加/更新 {len(records)} 张图片到数据库")
 
-        for path, features in zip(path_list, features_list):
-            features = features.tobytes()
-            from app.models.database import add_image
-            add_image(session, path, modify_time, checksum, features)
-            logger.info(f"添加/更新图片到数据库: {path}")
-
-        self.scanner.total_images = get_image_count(session)
-
-    def process_video(self, session, file_path):
+    def process_video(self, session, file_path, file_info):
         """
-        处理视频文件
+        处理视频文件，替换原有的记录
         """
-        modify_time = os.path.getmtime(file_path)
-        checksum = None
-
-        try:
-            modify_time = datetime.datetime.fromtimestamp(modify_time)
-        except Exception as e:
-            logger.warning(f"文件修改日期转换失败: {file_path}, 错误: {e}")
-            modify_time = datetime.datetime.now()
-            checksum = get_file_hash(file_path)
-
-        # 如果checksum为None，则使用空字符串
-        if checksum is None:
-            checksum = ""
-
-        from app.models.database import add_video
-        add_video(session, file_path, modify_time, checksum, process_video(file_path))
+        modify_time, checksum = file_info
+        delete_video_by_path(session, file_path)
+        frames = self.scanner.get_duplicate_video_frames(session, checksum)
+        if frames:  # 与已有视频内容相同，直接复用特征
+            self.reused_files += 1
+            add_video(session, file_path, modify_time, checksum, frames)
+        else:
+            add_video(session, file_path, modify_time, checksum, process_video(file_path, poster_info=(modify_time, checksum)))
         logger.info(f"添加/更新视频到数据库: {file_path}")
 
-        self.scanner.total_videos = get_video_count(session)
-        self.scanner.total_video_frames = get_video_frame_count(session)
+    def get_status(self) -> dict:
+        """获取文件监控的处理状态"""
+        with self.queue_lock:
+            queued = len(self.file_queue)
+        return {
+            "queued_files": queued,
+            "processing": self.processing,
+            "processed_files": self.processed_files,
+            "moved_files": self.moved_files,
+            "reused_files": self.reused_files,
+            "merged_events": self.merged_events,
+            "dropped_events": self.dropped_events,
+            "settle_retries": self.settle_retries,
+            "unsettled_files": self.unsettled_files,
+            "missing_files": self.missing_files,
+        }
 
     def start(self):
         """
@@ -322,6 +510,9 @@ class FileWatcher:
             return
 
         try:
+            self.stopping = False
+            self.worker = threading.Thread(target=self.run, name="FileWatchWorker", daemon=True)
+            self.worker.start()
             self.observer.start()
             logger.info(f"文件监控已成功启动，正在监控 {len(paths_to_watch)} 个目录")
             logger.info(f"监控状态: alive={self.observer.is_alive()}, event_handler={event_handler}")
@@ -334,17 +525,17 @@ class FileWatcher:
         """
         停止文件监控
         """
-        if self.batch_timer:
-            self.batch_timer.cancel()
-            self.batch_timer = None
-
         if self.observer:
-            # 处理剩余队列中的文件
-            self.process_queue()
-
             self.observer.stop()
             self.observer.join()
             self.observer = None
+            # 处理剩余队列中的文件
+            with self.queue_lock:
+                self.stopping = True
+                self.queue_changed.notify()
+            if self.worker:
+                self.worker.join()
+                self.worker = None
             logger.info("文件监控已停止")
 
     def is_running(self):
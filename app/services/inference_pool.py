@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+import logging
+import multiprocessing
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from app.config import SCAN_INFERENCE_PROCESSES, SCAN_INFERENCE_THREADS
+from app.services.resource_governor import resource_governor
+
+logger = logging.getLogger(__name__)
+
+
+def init_worker(threads: int):
+    """
+    推理进程初始化：限制线程数并加载模型
+    :param threads: int, 每个进程的推理线程数
+    """
+    resource_governor.lower_thread_priority()  # 在 torch 创建线程池之前调整，之后的推理线程都会继承
+    import torch
+
+    torch.set_num_threads(threads)
+    try:
+        torch.set_num_interop_threads(1)
+    except RuntimeError:  # 已经开始并行计算后不能再设置
+        pass
+    from app.services.process_assets import ensure_models_loaded
+
+    ensure_models_loaded()
+
+
+def encode_images_in_worker(images: list):
+    """在推理进程中计算图片特征"""
+    from app.services.process_assets import encode_images
+
+    return encode_images(images)
+
+
+class InferencePool:
+    """
+    多进程CPU推理池，用于扫描
+    一个模型实例在多核CPU上的小批量推理无法随线程数线性加速，改为启动多个进程，每个进程加载一份模型并只使用少量线程，
+    扫描时把解码好的批次分发给各个进程并发计算。只在推理设备为CPU时启用，模型在每个进程中各占一份内存。
+    """
+
+    def __init__(self, processes: int = SCAN_INFERENCE_PROCESSES, threads: int = SCAN_INFERENCE_THREADS):
+        """
+        :param processes: int, 推理进程数，0表示不使用推理池
+        :param threads: int, 每个进程的推理线程数
+        """
+        self.processes = processes
+        self.threads = max(threads, 1)
+        self.executor = None
+        self.lock = threading.Lock()
+
+    @property
+    def max_pending(self) -> int:
+        """同时等待计算的批次数量上限，保证每个进程都有下一个批次可算，又不会占用过多内存"""
+        return self.processes * 2
+
+    def is_enabled(self) -> bool:
+        """是否可以使用推理池"""
+        if self.processes <= 0:
+            return False
+        from app.services.process_assets import get_device
+
+        return str(get_device()) == "cpu"
+
+    def start(self) -> bool:
+        """
+        启动推理进程，已启动时直接返回
+        :return: bool, 是否启用了推理池
+        """
+        if self.executor is not None:
+            return True
+        if not self.is_enabled():
+            return False
+        with self.lock:
+            if self.executor is None:
+                logger.info(f"启动推理进程池：{self.processes} 个进程，每个进程 {self.threads} 个线程")
+                # 使用 spawn，避免 fork 时复制父进程中已初始化的 torch 线程池
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=init_worker,
+                    initargs=(self.threads,),
+                )
+        return True
+
+    def submit(self, images: list) -> Future:
+        """
+        提交一个批次
+        :param images: list, 解码后的图片列表
+        :return: Future, 结果为归一化的图片特征，出错时为 None
+        """
+        resource_governor.yield_to_searches()
+        self.start()
+        return self.executor.submit(encode_images_in_worker, images)
+
+    def shutdown(self):
+        """关闭推理进程，释放模型占用的内存"""
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+                self.executor = None
+                logger.info("推理进程池已关闭")
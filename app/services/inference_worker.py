@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+import itertools
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+from app.config import INFERENCE_BATCH_WAIT_MS, INFERENCE_MAX_BATCH
+from app.services.resource_governor import resource_governor
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_SEARCH = 0  # 搜索请求，优先处理
+PRIORITY_SCAN = 1  # 扫描和文件监控
+
+
+class InferenceWorker:
+    """
+    共享推理线程
+    所有线程的编码请求都放入同一个优先级队列，由一个线程依次执行，避免多个请求同时在同一个模型上做小批量推理而互相争抢CPU/GPU。
+    取出一个搜索请求后，会再等待 INFERENCE_BATCH_WAIT_MS 毫秒，把这段时间内到达的同类请求合并成一个批次一起计算；
+    扫描请求本身已经是批量的，不额外等待。同一个队列中优先级高的请求会插到排队中的请求前面。
+    推理线程及 torch 为它创建的计算线程的调度优先级与推理线程相同，而新线程继承创建它的线程的优先级，
+    所以搜索使用的推理线程要在启动时由主线程创建（见 process_assets.start_inference_worker），
+    扫描使用另一个 low_priority 的推理线程，启动后自己降低优先级，不影响搜索。
+    """
+
+    def __init__(self, handlers: dict, batch_wait_ms: int = INFERENCE_BATCH_WAIT_MS, max_batch: int = INFERENCE_MAX_BATCH,
+                 low_priority: bool = False):
+        """
+        :param handlers: dict, 请求类型 -> 处理函数。处理函数输入数据列表，返回与之一一对应的特征数组，出错时返回 None
+        :param batch_wait_ms: int, 合并搜索请求时的等待时间，单位毫秒
+        :param max_batch: int, 合并后一个批次最多包含的数据条数（单个请求超过这个数量时单独处理）
+        :param low_priority: bool, 是否降低推理线程的调度优先级（nice 值调整为 SCAN_NICE），用于扫描
+        """
+        self.handlers = handlers
+        self.batch_wait = batch_wait_ms / 1000
+        self.max_batch = max(max_batch, 1)
+        self.queue = queue.PriorityQueue()
+        self.counter = itertools.count()  # 同优先级按提交顺序处理，也避免比较后面的元素
+        self.low_priority = low_priority
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def start(self):
+        """启动推理线程。第一次提交请求时会自动调用，但这时推理线程会继承提交请求的线程的优先级"""
+        if self.thread is not None:
+            return
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.loop, name="InferenceWorker", daemon=True)
+                self.thread.start()
+
+    def reset_after_fork(self):
+        """
+        在分叉出的子进程中调用。推理线程不会被复制到子进程，父进程队列中的请求也不属于子进程，
+        重置后第一次提交请求时（或调用 start 时）在子进程中重新启动推理线程
+        """
+        self.queue = queue.PriorityQueue()
+        self.counter = itertools.count()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def submit(self, kind: str, items: list, priority: int = PRIORITY_SEARCH) -> Future:
+        """
+        提交编码请求
+        :param kind: str, 请求类型，对应 handlers 中的键
+        :param items: list, 需要编码的数据列表
+        :param priority: int, 优先级，数值越小越优先
+        :return: Future, 结果为与 items 一一对应的特征数组，出错时为 None
+        """
+        self.start()
+        future = Future()
+        self.queue.put((priority, next(self.counter), kind, items, future))
+        return future
+
+    def run(self, kind: str, items: list, priority: int = PRIORITY_SEARCH):
+        """提交编码请求并等待结果"""
+        return self.submit(kind, items, priority).result()
+
+    def collect(self) -> list:
+        """
+        从队列中取出一个批次的请求：同一类型，数据总数不超过 max_batch
+        :return: list, 请求列表
+        """
+        first = self.queue.get()
+        batch, skipped = [first], []
+        count = len(first[3])
+        deadline = time.time() + (self.batch_wait if first[0] == PRIORITY_SEARCH else 0)
+        while count < self.max_batch:
+            timeout = deadline - time.time()
+            try:
+                request = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if request[2] != first[2]:  # 类型不同，留到下个批次
+                skipped.append(request)
+                continue
+            if count + len(request[3]) > self.max_batch:
+                skipped.append(request)
+                break
+            batch.append(request)
+            count += len(request[3])
+        for request in skipped:
+            self.queue.put(request)
+        return batch
+
+    def execute(self, kind: str, batch: list):
+        """
+        计算一个批次并把结果分给各个请求。合并后的批次出错时，逐个请求重新计算，避免一个请求的错误影响其它请求
+        """
+        handler = self.handlers[kind]
+        try:
+            result = handler([item for request in batch for item in request[3]])
+        except Exception as e:
+            result = None
+            if len(batch) == 1:
+                batch[0][4].set_exception(e)
+                return
+        if result is None and len(batch) > 1:
+            for request in batch:
+                self.execute(kind, [request])
+            return
+        offset = 0
+        for request in batch:
+            count = len(request[3])
+            request[4].set_result(None if result is None else result[offset:offset + count])
+            offset += count
+
+    def loop(self):
+        """推理线程主循环"""
+        if self.low_priority:  # 在 torch 创建计算线程之前调整，计算线程也会继承
+            resource_governor.lower_thread_priority()
+        while True:
+            batch = self.collect()
+            kind = batch[0][2]
+            if len(batch) > 1:
+                logger.debug(f"合并 {len(batch)} 个 {kind} 请求一起推理")
+            try:
+                self.execute(kind, batch)
+            except Exception as e:  # 保证推理线程不会退出，且不会有请求一直等待
+                logger.exception(f"推理线程出错：{repr(e)}")
+                for request in batch:
+                    if not request[4].done():
+                        request[4].set_exception(e)
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import signal
+import socket
+import sys
+import time
+
+from werkzeug.serving import make_server
+
+logger = logging.getLogger(__name__)
+
+
+def prefork_supported() -> bool:
+    """是否支持多进程预分叉（需要 os.fork，Windows 不支持）"""
+    return hasattr(os, "fork")
+
+
+class PreforkServer:
+    """
+    预分叉的多进程网页服务
+    主进程监听端口后分叉出多个工作进程，工作进程共用同一个监听套接字，各自使用多线程的 werkzeug 服务（或 serve_socket 指定的服务）处理请求；
+    工作进程意外退出时主进程会重新启动一个。主进程本身不处理请求，可以用来扫描和发布共享索引
+    """
+
+    def __init__(self, app, host: str, port: int, workers: int, worker_init=None, serve_socket=None):
+        """
+        :param app: Flask 应用
+        :param workers: int, 工作进程数
+        :param worker_init: 函数，工作进程启动后、开始处理请求之前调用
+        :param serve_socket: 函数，参数为监听套接字，在工作进程中处理请求直到退出。默认使用多线程的 werkzeug 服务
+        """
+        self.app = app
+        self.host = host
+        self.port = port
+        self.workers = workers
+        self.worker_init = worker_init
+        self.serve_socket = serve_socket or self.serve_wsgi
+        self.sock = None
+        self.children = set()
+        self.stopping = False
+
+    def bind(self):
+        """创建监听套接字，需在分叉之前调用"""
+        family = socket.AF_INET6 if ":" in self.host else socket.AF_INET
+        self.sock = socket.create_server((self.host, self.port), family=family, backlog=128)
+        self.sock.set_inheritable(True)
+        logger.info(f"多进程模式：监听 http://{self.host}:{self.port}，{self.workers} 个工作进程")
+
+    def spawn_worker(self):
+        """分叉出一个工作进程"""
+        pid = os.fork()
+        if pid:
+            self.children.add(pid)
+            return
+        # 工作进程：Ctrl+C 由主进程统一处理，收到 SIGTERM 直接退出
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        code = 0
+        try:
+            if self.worker_init is not None:
+                self.worker_init()
+            self.serve_socket(self.sock)
+        except BaseException:
+            logger.exception(f"工作进程 {os.getpid()} 异常退出")
+            code = 1
+        finally:
+            sys.stdout.flush()
+            os._exit(code)
+
+    def serve_wsgi(self, sock):
+        """在工作进程中使用多线程的 werkzeug 服务处理请求"""
+        server = make_server(self.host, self.port, self.app, threaded=True, fd=sock.fileno())
+        server.serve_forever()
+
+    def stop(self, *_):
+        """停止所有工作进程"""
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except OSError:
+                pass
+
+    def run(self, master_init=None):
+        """
+        启动工作进程并在主进程中等待，直到收到 SIGINT/SIGTERM
+        :param master_init: 函数，工作进程全部启动后在主进程中调用。工作进程在此之前分叉，不会继承它启动的线程
+        """
+        if self.sock is None:
+            self.bind()
+        for _ in range(self.workers):
+            self.spawn_worker()
+        signal.signal(signal.SIGINT, self.stop)
+        signal.signal(signal.SIGTERM, self.stop)
+        if master_init is not None:
+            master_init()
+        while self.children:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                break
+            if pid == 0:
+                time.sleep(1)
+                continue
+            self.children.discard(pid)
+            if not self.stopping:
+                logger.warning(f"工作进程 {pid} 已退出（状态 {status}），重新启动")
+                time.sleep(1)  # 避免启动即崩溃时不停重启
+                self.spawn_worker()
+        self.sock.close()
+        logger.info("所有工作进程已退出")
@@ -1,45 +1,223 @@
 # 预处理图片和视频，建立索引，加快搜索速度
+# torch 和 transformers 导入较慢，只在第一次加载模型时才导入，这样网页服务可以立即启动
+import contextlib
+import importlib.util
 import logging
+import threading
 import time
 import traceback
+from collections import deque
 
-import torch
 import cv2
 import numpy as np
 import requests
 from PIL import Image
 from tqdm import trange
-from transformers import AutoModelForZeroShotImageClassification, AutoProcessor
 
 from app.config import *
+from app.services.inference_worker import PRIORITY_SCAN, PRIORITY_SEARCH, InferenceWorker
+from app.services.resource_governor import resource_governor
+from app.services.thumbnail_cache import (
+    POSTER_SIZE,
+    THUMBNAIL_SIZE,
+    encode_thumbnail,
+    get_default_format,
+    get_poster_key,
+    poster_cache,
+)
+from app.services.utils import resize_pil_image_with_aspect_ratio
 
 from tqdm import tqdm
 
 logger = logging.getLogger(__name__)
 
 # 全局模型变量
-clip_model = None
+clip_model = None  # text_only 时只包含文字模型
+clip_vision_model = None  # text_only 时按需加载的图像模型，否则不使用
+text_only = SEARCH_ONLY  # 是否只加载文字模型，多进程部署的工作进程只负责搜索，也只加载文字模型
 clip_processor = None
+device = None  # 实际使用的推理设备，第一次加载模型时根据 DEVICE 确定
+precision = "fp32"  # 实际使用的推理精度，加载模型时根据 INFERENCE_PRECISION 确定，不支持或误差过大时为 fp32
+model_lock = threading.Lock()
+vision_model_lock = threading.Lock()
+# CLIP 类模型中文字模型和图像模型对应的属性名
+TEXT_TOWER_MODULES = ("text_model", "text_projection")
+VISION_TOWER_MODULES = ("vision_model", "visual_projection")
 
-def load_models():
+
+def get_device():
     """
-    优化的模型加载函数，提供详细的进度信息和加速加载
-    优先使用本地缓存，首次运行时自动下载
+    根据 DEVICE 配置确定推理设备，只在第一次调用时检测
+    DEVICE 为 auto 时自动选择设备，优先级：cuda > mps > directml > cpu
     """
-    global clip_model, clip_processor
+    global device
+    if device is not None:
+        return device
+    import torch
+    device = DEVICE
+    if device == 'auto':
+        if torch.cuda.is_available():
+            device = 'cuda'
+        elif torch.backends.mps.is_available():
+            device = 'mps'
+        elif importlib.util.find_spec("torch_directml") is not None:
+            try:
+                import torch_directml
+
+                if torch_directml.device_count() > 0:
+                    device = torch_directml.device()
+                    x = torch.rand((1, 1), device=device)  # 测试是否可用
+                    x = 1.0 - x
+                else:
+                    device = 'cpu'
+            except Exception as e:
+                print("使用CPU:", repr(e))
+                device = 'cpu'
+        else:
+            device = 'cpu'
+    logger.info(f"推理设备：{device}")
+    return device
 
-    logger.info("Loading model...")
-    print("\n" + "=" * 70)
-    print("模型加载 / Model Loading")
-    print("=" * 70)
-    print(f"模型名称 / Model: {MODEL_NAME}")
-    print(f"设备 / Device: {DEVICE}")
-    print("-" * 70)
 
-    start_time = time.time()
+def is_model_ready() -> bool:
+    """模型是否已加载完成"""
+    return clip_model is not None
 
-    # 检查本地缓存是否存在
-    import os
+
+def ensure_models_loaded():
+    """
+    确保模型已加载，第一次推理时调用。多个线程同时调用时只会加载一次，其余线程等待加载完成
+    """
+    if clip_model is not None:
+        return
+    with model_lock:
+        if clip_model is None:
+            load_models()
+
+
+def get_inference_precision() -> str:
+    """获取实际使用的推理精度，模型未加载时会先加载模型"""
+    ensure_models_loaded()
+    return precision
+
+
+def inference_context(mode: str = None):
+    """
+    推理时使用的上下文：关闭梯度记录，bf16 时开启自动混合精度
+    :param mode: str, 推理精度，默认为当前使用的精度
+    """
+    import torch
+    stack = contextlib.ExitStack()
+    stack.enter_context(torch.inference_mode())
+    if (mode or precision) == "bf16":
+        stack.enter_context(torch.autocast(device_type=torch.device(device).type, dtype=torch.bfloat16))
+    return stack
+
+
+def get_sample_features(model, processor, mode: str):
+    """
+    用固定的样本图片和文字计算归一化后的特征，用于比较不同精度的误差
+    :return: <class 'numpy.nparray'>, 样本特征，shape=(样本数, m)
+    """
+    import torch
+    features = []
+    with inference_context(mode):
+        if getattr(model, "vision_model", None) is not None:
+            rng = np.random.default_rng(0)
+            gradient = np.tile(np.linspace(0, 255, 224, dtype=np.uint8)[None, :, None], (224, 1, 3))
+            images = [
+                rng.integers(0, 256, (224, 224, 3), dtype=np.uint8),
+                gradient,
+                np.full((224, 224, 3), (200, 60, 30), dtype=np.uint8),
+                np.zeros((224, 224, 3), dtype=np.uint8),
+            ]
+            inputs = processor(images=images, return_tensors="pt")["pixel_values"].to(device)
+            features.append(model.get_image_features(inputs).float())
+        if getattr(model, "text_model", None) is not None:
+            texts = ["一只猫", "海边的日落", "a photo of a dog", "city street at night"]
+            inputs = processor(text=texts, return_tensors="pt", padding=True)
+            features.append(model.get_text_features(
+                input_ids=inputs["input_ids"].to(device), attention_mask=inputs["attention_mask"].to(device)).float())
+    features = torch.cat(features)
+    features = features / torch.norm(features, dim=1, keepdim=True)
+    return features.cpu().numpy()
+
+
+def apply_precision(model, processor):
+    """
+    根据 INFERENCE_PRECISION 转换模型精度，并与 fp32 比较样本特征的误差，不支持或误差过大时回退到 fp32
+    :return: (转换后的模型, 实际使用的推理精度)
+    """
+    import torch
+    mode = INFERENCE_PRECISION
+    if mode == "fp32":
+        return model, "fp32"
+    device_type = torch.device(device).type
+    if mode == "int8":
+        if device_type != "cpu":
+            logger.warning(f"int8 动态量化只支持CPU，当前设备为 {device}，使用 fp32")
+            return model, "fp32"
+        new_model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    elif mode == "bf16":
+        if not (device_type == "cpu" or (device_type == "cuda" and torch.cuda.is_bf16_supported())):
+            logger.warning(f"当前设备 {device} 不支持 bf16，使用 fp32")
+            return model, "fp32"
+        new_model = model
+    else:
+        logger.warning(f"不支持的推理精度：{mode}，使用 fp32")
+        return model, "fp32"
+    reference = get_sample_features(model, processor, "fp32")
+    features = get_sample_features(new_model, processor, mode)
+    min_similarity = float((reference * features).sum(axis=1).min())
+    if min_similarity < PRECISION_MIN_SIMILARITY:
+        logger.warning(f"{mode} 与 fp32 的特征相似度最低为 {min_similarity:.4f}，低于 {PRECISION_MIN_SIMILARITY}，使用 fp32")
+        return model, "fp32"
+    logger.info(f"使用 {mode} 推理，与 fp32 的特征相似度最低为 {min_similarity:.4f}")
+    return new_model, mode
+
+
+def strip_tower(model, module_names):
+    """
+    删除模型中不需要的部分（文字模型或图像模型）。加载模型时在读取权重之前调用，不需要的部分不会分配内存
+    :param model: CLIP 模型
+    :param module_names: tuple[str], 需要删除的子模块属性名
+    :return: 删除后的模型
+    """
+    for name in module_names:
+        if getattr(model, name, None) is not None:
+            setattr(model, name, None)
+    return model
+
+
+def load_clip_model(drop_modules=(), **kwargs):
+    """
+    加载 CLIP 模型。drop_modules 不为空时，在加载权重之前就删除不需要的部分（文字模型或图像模型），
+    这部分既不分配内存也不读取权重。Chinese-CLIP 等模型没有单独的文字/图像模型类，所以用删除了子模块的模型类来加载
+    :param drop_modules: tuple[str], 不需要的子模块属性名
+    :param kwargs: 传给 from_pretrained 的参数
+    :return: 模型
+    """
+    from transformers import AutoConfig, AutoModelForZeroShotImageClassification, MODEL_FOR_ZERO_SHOT_IMAGE_CLASSIFICATION_MAPPING
+
+    if not drop_modules:
+        return AutoModelForZeroShotImageClassification.from_pretrained(MODEL_NAME, **kwargs)
+    config = AutoConfig.from_pretrained(MODEL_NAME, **kwargs)
+
+    class TowerModel(MODEL_FOR_ZERO_SHOT_IMAGE_CLASSIFICATION_MAPPING[type(config)]):
+        _keys_to_ignore_on_load_unexpected = [rf"^{name}\." for name in drop_modules]  # 不需要的权重，加载时跳过且不警告
+
+        def __init__(self, *args, **model_kwargs):
+            super().__init__(*args, **model_kwargs)  # low_cpu_mem_usage 时在 meta 设备上创建，不分配内存
+            strip_tower(self, drop_modules)
+
+    return TowerModel.from_pretrained(MODEL_NAME, config=config, low_cpu_mem_usage=True, **kwargs)
+
+
+def get_model_cache():
+    """
+    获取模型缓存目录，并检查模型是否已下载
+    :return: (缓存目录, 是否已缓存)
+    """
     # 使用绝对路径，确保模型下载到 data/cache 目录
     project_root = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
     cache_dir = os.path.join(project_root, 'data', 'cache')
@@ -65,6 +243,75 @@ def load_models():
                         os.path.exists(os.path.join(snapshot_path, 'model.safetensors'))):
                         model_cached = True
                         break
+    return cache_dir, model_cached
+
+
+def get_vision_model():
+    """
+    获取用于计算图片特征的模型。text_only 时图像模型只在第一次以图搜索时才加载
+    """
+    global clip_vision_model
+    ensure_models_loaded()
+    if not text_only:
+        return clip_model
+    if clip_vision_model is not None:
+        return clip_vision_model
+    with vision_model_lock:
+        if clip_vision_model is None:
+            start_time = time.time()
+            cache_dir, model_cached = get_model_cache()
+            model = load_clip_model(TEXT_TOWER_MODULES, cache_dir=cache_dir, local_files_only=model_cached).to(get_device())
+            model, vision_precision = apply_precision(model, clip_processor)
+            if vision_precision != precision:
+                logger.warning(f"图像模型的推理精度 {vision_precision} 与文字模型 {precision} 不同")
+            clip_vision_model = model
+            logger.info(f"图像模型按需加载完成，耗时 {time.time() - start_time:.2f}s")
+    return clip_vision_model
+
+
+def use_text_model_only():
+    """只加载文字模型，图像模型在第一次以图搜索时才加载。需在加载模型之前调用"""
+    global text_only
+    text_only = True
+
+
+def start_model_warmup():
+    """
+    在后台线程中预加载模型，不阻塞网页服务启动
+    """
+
+    def warmup():
+        try:
+            ensure_models_loaded()
+        except Exception as e:
+            logger.exception(f"预加载模型失败：{repr(e)}")
+
+    threading.Thread(target=warmup, name="ModelWarmup", daemon=True).start()
+
+
+def load_models():
+    """
+    优化的模型加载函数，提供详细的进度信息和加速加载
+    优先使用本地缓存，首次运行时自动下载
+    """
+    global clip_model, clip_processor, precision
+    from transformers import AutoProcessor
+
+    device = get_device()
+    logger.info("Loading model...")
+    print("\n" + "=" * 70)
+    print("模型加载 / Model Loading")
+    print("=" * 70)
+    print(f"模型名称 / Model: {MODEL_NAME}")
+    print(f"设备 / Device: {device}")
+    if text_only:
+        print("仅搜索模式，只加载文字模型 / Search-only mode, loading text model only")
+    print("-" * 70)
+
+    start_time = time.time()
+
+    # 检查本地缓存是否存在
+    cache_dir, model_cached = get_model_cache()
 
     # 使用更细粒度的进度条
     with tqdm(total=6, desc='总进度 / Total Progress', unit='step',
@@ -100,11 +347,8 @@ def load_models():
             print(f"      (首次运行会自动下载模型，请耐心等待)")
             print(f"      (First run will download model, please be patient)")
         pbar.set_description("模型 / Model")
-        clip_model = AutoModelForZeroShotImageClassification.from_pretrained(
-            MODEL_NAME,
-            cache_dir=cache_dir,
-            local_files_only=use_local_only
-        )
+        # text_only 时不加载图像模型，只加载文字模型
+        model = load_clip_model(VISION_TOWER_MODULES if text_only else (), cache_dir=cache_dir, local_files_only=use_local_only)
         pbar.update(1)
         model_time = time.time() - step_start
         print(f"      ✓ 完成 / Completed ({model_time:.2f}s)")
@@ -113,7 +357,7 @@ def load_models():
         step_start = time.time()
         print(f"\n[4/6] 加载处理器 / Loading processor...")
         pbar.set_description("处理器 / Processor")
-        clip_processor = AutoProcessor.from_pretrained(
+        processor = AutoProcessor.from_pretrained(
             MODEL_NAME,
             cache_dir=cache_dir,
             local_files_only=use_local_only
@@ -123,9 +367,11 @@ def load_models():
 
         # 步骤 5: 移动模型到设备
         step_start = time.time()
-        print(f"\n[5/6] 将模型移动到 {DEVICE} / Moving model to {DEVICE}...")
-        pbar.set_description(f"设备 / {DEVICE}")
-        clip_model = clip_model.to(DEVICE)
+        print(f"\n[5/6] 将模型移动到 {device} / Moving model to {device}...")
+        pbar.set_description(f"设备 / {device}")
+        model = model.to(device)
+        model, model_precision = apply_precision(model, processor)
+        print(f"      推理精度 / Precision: {model_precision}")
         pbar.update(1)
         print(f"      ✓ 完成 / Completed ({time.time() - step_start:.2f}s)")
 
@@ -133,11 +379,15 @@ def load_models():
         step_start = time.time()
         print(f"\n[6/6] 模型评估 / Evaluating model...")
         pbar.set_description("评估 / Evaluating")
-        # 创建一个有效的测试图像（纯黑图像）
-        dummy_image = Image.new('RGB', (224, 224), color=(0, 0, 0))
-        with torch.no_grad():
-            inputs = clip_processor(images=dummy_image, return_tensors="pt")["pixel_values"].to(DEVICE)
-            _ = clip_model.get_image_features(inputs)
+        with inference_context(model_precision):
+            if text_only:
+                inputs = processor(text="test", return_tensors="pt", padding=True)["input_ids"].to(device)
+                _ = model.get_text_features(inputs)
+            else:
+                # 创建一个有效的测试图像（纯黑图像）
+                dummy_image = Image.new('RGB', (224, 224), color=(0, 0, 0))
+                inputs = processor(images=dummy_image, return_tensors="pt")["pixel_values"].to(device)
+                _ = model.get_image_features(inputs)
         pbar.update(1)
         print(f"      ✓ 完成 / Completed ({time.time() - step_start:.2f}s)")
 
@@ -153,23 +403,46 @@ def load_models():
     print("=" * 70 + "\n")
 
     logger.info(f"Model loaded in {total_time:.2f}s")
+    # 全部加载完成后再赋值，其它线程通过 is_model_ready 看到的一定是可用的模型
+    clip_processor = processor
+    precision = model_precision
+    clip_model = model
 
-# 启动时加载模型
-load_models()
 
-
-def get_image_feature(images):
+def get_image_feature(images, priority=PRIORITY_SCAN):
     """
-    :param images: 图片列表
+    :param images: 图片列表，或单张图片
+    :param priority: int, 推理优先级，搜索时使用 PRIORITY_SEARCH
     :return: feature
     """
-    if images is None or len(images) == 0:
+    if images is None:
         return None
+    if not isinstance(images, list):
+        images = [images]
+    if len(images) == 0:
+        return None
+    if priority == PRIORITY_SCAN:  # 扫描的批次先让搜索执行
+        resource_governor.yield_to_searches()
+    if ENABLE_INFERENCE_WORKER:
+        worker = scan_inference_worker if priority == PRIORITY_SCAN else inference_worker
+        return worker.run("image", images, priority)
+    return encode_images(images)
+
+
+def encode_images(images: list):
+    """
+    计算图片特征
+    :param images: 图片列表
+    :return: <class 'numpy.nparray'>, 归一化的图片特征，shape=(n, m)，出错时返回 None
+    """
+    import torch
+    model = get_vision_model()
     features = None
     try:
-        inputs = clip_processor(images=images, return_tensors="pt")["pixel_values"].to(DEVICE)
-        features = clip_model.get_image_features(inputs)
-        normalized_features = features / torch.norm(features, dim=1, keepdim=True)  # 归一化，方便后续计算余弦相似度
+        inputs = clip_processor(images=images, return_tensors="pt")["pixel_values"].to(device)
+        with inference_context():
+            features = model.get_image_features(inputs).float()
+            normalized_features = features / torch.norm(features, dim=1, keepdim=True)  # 归一化，方便后续计算余弦相似度
         features = normalized_features.detach().cpu().numpy()
     except Exception as e:
         logger.exception("处理图片报错：type=%s error=%s" % (type(images), repr(e)))
@@ -187,11 +460,12 @@ def get_image_feature(images):
     return features
 
 
-def get_image_data(path: str, ignore_small_images: bool = True):
+def get_image_data(path: str, ignore_small_images: bool = True, thumbnails: dict = None):
     """
     获取图片像素数据，如果出错返回 None
     :param path: string, 图片路径
     :param ignore_small_images: bool, 是否忽略尺寸过小的图片
+    :param thumbnails: dict, 传入时顺便用解码好的图片生成缩略图，保存为 路径 -> 编码后的缩略图数据
     :return: <class 'numpy.nparray'>, 图片数据，如果出错返回 None
     """
     try:
@@ -201,6 +475,12 @@ def get_image_data(path: str, ignore_small_images: bool = True):
             if width < IMAGE_MIN_WIDTH or height < IMAGE_MIN_HEIGHT:
                 return None
                 # processor 中也会这样预处理 Image
+        if thumbnails is not None and os.path.splitext(path)[-1].lower() != ".gif":
+            try:
+                thumbnail = resize_pil_image_with_aspect_ratio(image, THUMBNAIL_SIZE)
+                thumbnails[path] = encode_thumbnail(thumbnail, get_default_format())
+            except Exception as e:  # 缩略图生成失败不影响扫描，搜索时会重新生成
+                logger.warning(f"生成缩略图失败：{path} {repr(e)}")
         # 在这里提前转为 np.array 避免到时候抛出异常
         image = image.convert('RGB')
         image = np.array(image)
@@ -211,38 +491,52 @@ def get_image_data(path: str, ignore_small_images: bool = True):
         return None
 
 
-def process_image(path, ignore_small_images=True):
+def process_image(path, ignore_small_images=True, priority=PRIORITY_SEARCH):
     """
     处理图片，返回图片特征
     :param path: string, 图片路径
     :param ignore_small_images: bool, 是否忽略尺寸过小的图片
+    :param priority: int, 推理优先级，默认用于搜索
     :return: <class 'numpy.nparray'>, 图片特征
     """
     image = get_image_data(path, ignore_small_images)
     if image is None:
         return None
-    feature = get_image_feature(image)
+    feature = get_image_feature(image, priority)
     return feature
 
 
-def process_images(path_list, ignore_small_images=True):
+def process_images(path_list, ignore_small_images=True, thumbnails=None):
     """
     处理图片，返回图片特征
     :param path_list: string, 图片路径列表
     :param ignore_small_images: bool, 是否忽略尺寸过小的图片
+    :param thumbnails: dict, 传入时顺便生成缩略图，见 get_image_data
     :return: <class 'numpy.nparray'>, 图片特征
     """
+    path_list, images = get_images_data(path_list, ignore_small_images, thumbnails)
+    if not images:
+        return None, None
+    feature = get_image_feature(images)
+    return path_list, feature
+
+
+def get_images_data(path_list, ignore_small_images=True, thumbnails=None):
+    """
+    读取多张图片的像素数据，跳过读取失败的图片
+    :param path_list: list[str], 图片路径列表，读取失败的路径会从中删除
+    :param ignore_small_images: bool, 是否忽略尺寸过小的图片
+    :param thumbnails: dict, 传入时顺便生成缩略图，见 get_image_data
+    :return: (list[str], list[<class 'numpy.nparray'>]), (读取成功的图片路径列表, 图片数据列表)
+    """
     images = []
     for path in path_list.copy():
-        image = get_image_data(path, ignore_small_images)
+        image = get_image_data(path, ignore_small_images, thumbnails)
         if image is None:
             path_list.remove(path)
             continue
         images.append(image)
-    if not images:
-        return None, None
-    feature = get_image_feature(images)
-    return path_list, feature
+    return path_list, images
 
 
 def process_web_image(url):
@@ -291,21 +585,95 @@ def get_frames(video: cv2.VideoCapture):
     yield ids, frames
 
 
-def process_video(path):
+def get_poster_image(frame):
+    """
+    把视频帧缩小成预览图
+    :param frame: <class 'numpy.nparray'>, cv2 读取的 BGR 帧数据
+    :return: PIL.Image, 预览图
+    """
+    image = Image.fromarray(cv2.cvtColor(frame, cv2.COLOR_BGR2RGB))
+    return resize_pil_image_with_aspect_ratio(image, POSTER_SIZE)
+
+
+def save_posters(frame_batches, path, modify_time, checksum):
+    """
+    在计算特征之前，为每个采样帧保存一张预览图，帧数据原样返回
+    :param frame_batches: 生成器，返回 (帧编号列表, 帧像素数据列表)
+    :return: 生成器，与 frame_batches 相同
+    """
+    for ids, frames in frame_batches:
+        for frame_time, frame in zip(ids, frames):
+            try:
+                key = get_poster_key(path, frame_time, modify_time, checksum)
+                poster_cache.put(key, "jpeg", encode_thumbnail(get_poster_image(frame), "jpeg"))
+            except Exception as e:  # 预览图保存失败不影响扫描，访问时会重新生成
+                logger.warning(f"保存视频预览图失败：{path} {frame_time} {repr(e)}")
+        yield ids, frames
+
+
+def get_video_poster(path, frame_time):
+    """
+    读取视频指定时间的帧并生成预览图，用于预览图缓存中没有的情况
+    :param path: string, 视频路径
+    :param frame_time: int, 帧所在的时间，单位秒
+    :return: PIL.Image, 预览图，读取失败时返回 None
+    """
+    video = cv2.VideoCapture(path)
+    try:
+        video.set(cv2.CAP_PROP_POS_MSEC, frame_time * 1000)
+        ret, frame = video.read()
+        if not ret:
+            return None
+        return get_poster_image(frame)
+    except Exception as e:
+        logger.warning(f"读取视频帧失败：{path} {frame_time} {repr(e)}")
+        return None
+    finally:
+        video.release()
+
+
+def encode_frame_batches(frame_batches, pool=None):
+    """
+    按顺序计算每一批帧的特征
+    :param frame_batches: 生成器，返回 (帧编号列表, 帧像素数据列表)
+    :param pool: InferencePool, 推理进程池，传入时多个批次同时在不同进程中计算
+    :return: 生成器，按输入顺序返回 (帧编号列表, 特征)
+    """
+    if pool is None:
+        for ids, frames in frame_batches:
+            if frames:
+                yield ids, get_image_feature(frames)
+        return
+    pending = deque()
+    for ids, frames in frame_batches:
+        if not frames:
+            continue
+        pending.append((ids, pool.submit(frames)))
+        if len(pending) >= pool.max_pending:
+            ids, future = pending.popleft()
+            yield ids, future.result()
+    while pending:
+        ids, future = pending.popleft()
+        yield ids, future.result()
+
+
+def process_video(path, pool=None, poster_info=None):
     """
     处理视频并返回处理完成的数据
     返回一个生成器，每调用一次则返回视频下一个帧的数据
     :param path: string, 视频路径
+    :param pool: InferencePool, 推理进程池，扫描时传入
+    :param poster_info: tuple, 视频的 (modify_time, checksum)，传入且开启了 SCAN_VIDEO_POSTERS 时为每个采样帧保存预览图
     :return: [int, <class 'numpy.nparray'>], [当前是第几帧（被采集的才算），图片特征]
     """
     logger.info(f"处理视频中：{path}")
     video = None
     try:
         video = cv2.VideoCapture(path)
-        for ids, frames in get_frames(video):
-            if not frames:
-                continue
-            features = get_image_feature(frames)
+        frame_batches = get_frames(video)
+        if poster_info is not None and SCAN_VIDEO_POSTERS and poster_cache.enabled:
+            frame_batches = save_posters(frame_batches, path, *poster_info)
+        for ids, features in encode_frame_batches(frame_batches, pool):
             if features is None:
                 logger.warning("features is None in process_video")
                 continue
@@ -328,16 +696,32 @@ def process_text(input_text):
     :param input_text: string, 被处理的字符串
     :return: <class 'numpy.nparray'>,  文字特征
     """
-    feature = None
     if not input_text:
         return None
+    if ENABLE_INFERENCE_WORKER:
+        return inference_worker.run("text", [input_text], PRIORITY_SEARCH)
+    return encode_texts([input_text])
+
+
+def encode_texts(input_texts: list):
+    """
+    计算文字特征，多条文字会补齐到相同长度后一起计算
+    :param input_texts: list[str], 文字列表
+    :return: <class 'numpy.nparray'>, 归一化的文字特征，shape=(n, m)，出错时返回 None
+    """
+    import torch
+    ensure_models_loaded()
+    feature = None
     try:
-        text = clip_processor(text=input_text, return_tensors="pt", padding=True)["input_ids"].to(DEVICE)
-        feature = clip_model.get_text_features(text)
-        normalize_feature = feature / torch.norm(feature, dim=1, keepdim=True)  # 归一化，方便后续计算余弦相似度
+        inputs = clip_processor(text=input_texts, return_tensors="pt", padding=True)
+        with inference_context():
+            # 传入 attention_mask，补齐的部分不影响特征
+            feature = clip_model.get_text_features(
+                input_ids=inputs["input_ids"].to(device), attention_mask=inputs["attention_mask"].to(device)).float()
+            normalize_feature = feature / torch.norm(feature, dim=1, keepdim=True)  # 归一化，方便后续计算余弦相似度
         feature = normalize_feature.detach().cpu().numpy()
     except Exception as e:
-        logger.exception("处理文字报错：text=%s error=%s" % (input_text, repr(e)))
+        logger.exception("处理文字报错：text=%s error=%s" % (input_texts, repr(e)))
         traceback.print_stack()
         if feature is not None:
             print("feature.shape:", feature.shape)
@@ -345,6 +729,35 @@ def process_text(input_text):
     return feature
 
 
+# 共享推理线程，搜索的编码请求都通过它执行
+inference_worker = InferenceWorker({"image": encode_images, "text": encode_texts})
+# 扫描和文件监控使用的低优先级推理线程
+scan_inference_worker = InferenceWorker({"image": encode_images}, low_priority=True)
+
+
+def reset_after_fork():
+    """
+    在分叉出的子进程中调用，丢弃从父进程继承的模型和推理线程。
+    多进程模式下重新启动的工作进程是从已经加载了模型、启动了推理线程的主进程分叉出来的：推理线程不会被复制到子进程，
+    父进程的锁可能正被其它线程持有，模型也要按子进程的需要（只加载文字模型）重新加载
+    """
+    global clip_model, clip_vision_model, clip_processor, precision, model_lock, vision_model_lock
+    clip_model = clip_vision_model = clip_processor = None
+    precision = "fp32"
+    model_lock = threading.Lock()
+    vision_model_lock = threading.Lock()
+    inference_worker.reset_after_fork()
+    scan_inference_worker.reset_after_fork()
+
+
+def start_inference_worker():
+    """
+    启动搜索使用的共享推理线程，需在启动时由主线程调用，推理线程才不会继承扫描线程降低后的优先级
+    """
+    if ENABLE_INFERENCE_WORKER:
+        inference_worker.start()
+
+
 def match_text_and_image(text_feature, image_feature):
     """
     匹配文字和图片，返回余弦相似度
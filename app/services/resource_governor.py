@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from app.config import SCAN_NICE, SCAN_THREAD_BUDGET, SCAN_YIELD_MAX_WAIT
+
+logger = logging.getLogger(__name__)
+
+
+class ResourceGovernor:
+    """
+    资源调度，保证扫描（手动扫描、自动扫描、文件监控）不会拖慢搜索
+    - 搜索请求通过 searching() 登记，扫描在每个推理批次之前调用 yield_to_searches()，有搜索正在进行时暂停等待
+    - 扫描线程和推理进程降低操作系统调度优先级
+    - 扫描使用的线程数和推理进程数受 SCAN_THREAD_BUDGET 限制
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.search_done = threading.Condition(self.lock)
+        self.active_searches = 0  # 正在进行的搜索数量
+        self.yielding = 0  # 正在为搜索暂停的扫描任务数量
+        self.yield_count = 0  # 扫描暂停的总次数
+        self.yield_seconds = 0.0  # 扫描暂停的总时长
+
+    @contextmanager
+    def searching(self):
+        """在搜索请求处理期间使用，登记正在进行的搜索"""
+        with self.lock:
+            self.active_searches += 1
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.active_searches -= 1
+                if self.active_searches == 0:
+                    self.search_done.notify_all()
+
+    def yield_to_searches(self):
+        """
+        扫描在两个批次之间调用：有搜索正在进行时暂停，直到搜索全部完成，最多等待 SCAN_YIELD_MAX_WAIT 秒，避免扫描被一直阻塞
+        """
+        with self.lock:
+            if self.active_searches == 0 or SCAN_YIELD_MAX_WAIT <= 0:
+                return
+            t0 = time.time()
+            self.yielding += 1
+            self.yield_count += 1
+            self.search_done.wait_for(lambda: self.active_searches == 0, timeout=SCAN_YIELD_MAX_WAIT)
+            self.yielding -= 1
+            self.yield_seconds += time.time() - t0
+
+    @staticmethod
+    def lower_thread_priority():
+        """
+        降低当前线程的调度优先级（nice 值调整为 SCAN_NICE），之后在这个线程中创建的线程和进程也会继承这个优先级。
+        只在支持按线程设置优先级的系统（Linux）上生效
+        """
+        if SCAN_NICE <= 0 or not hasattr(os, "setpriority"):
+            return
+        try:
+            thread_id = threading.get_native_id()
+            current = os.getpriority(os.PRIO_PROCESS, thread_id)
+            if current < SCAN_NICE:
+                os.setpriority(os.PRIO_PROCESS, thread_id, SCAN_NICE)
+        except OSError as e:
+            logger.debug(f"无法降低线程优先级：{repr(e)}")
+
+    @staticmethod
+    def limit_threads(count: int) -> int:
+        """按 SCAN_THREAD_BUDGET 限制扫描使用的线程数"""
+        if SCAN_THREAD_BUDGET > 0:
+            count = min(count, SCAN_THREAD_BUDGET)
+        return max(count, 1)
+
+    @staticmethod
+    def split_thread_budget(processes: int, threads: int) -> tuple[int, int]:
+        """
+        按 SCAN_THREAD_BUDGET 限制推理进程数和每个进程的线程数，使两者的乘积不超过预算
+        :return: (进程数, 每个进程的线程数)
+        """
+        if SCAN_THREAD_BUDGET <= 0 or processes <= 0:
+            return processes, threads
+        processes = min(processes, SCAN_THREAD_BUDGET)
+        return processes, max(min(threads, SCAN_THREAD_BUDGET // processes), 1)
+
+    def get_status(self) -> dict:
+        """获取当前的调度状态"""
+        with self.lock:
+            return {
+                "active_searches": self.active_searches,
+                "scan_yielding": self.yielding > 0,
+                "yield_count": self.yield_count,
+                "yield_seconds": round(self.yield_seconds, 2),
+                "scan_nice": SCAN_NICE,
+                "thread_budget": SCAN_THREAD_BUDGET,
+            }
+
+
+resource_governor = ResourceGovernor()
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+
+class ScanJournal:
+    """
+    扫描日志，用于断点恢复
+    扫描开始时把待扫描文件列表一次性写入 assets 文件，扫描过程中只把处理完成的文件追加写入 done 文件，
+    因此每次保存的开销只和这一批文件的数量有关；断点恢复时两者做差集即可得到剩余文件。
+    done 文件中的记录数超过剩余文件数时进行压缩：把剩余文件重新写入 assets 文件并清空 done 文件。
+    每行一个 JSON 字符串，可以保存包含换行符或无法解码字符的路径。
+    """
+
+    compact_min_records = 10000  # done 文件至少有这么多条记录才考虑压缩
+
+    def __init__(self, directory: str):
+        """
+        :param directory: string, 日志文件所在目录
+        """
+        self.directory = directory
+        self.assets_file = os.path.join(directory, "assets.jsonl")
+        self.done_file = os.path.join(directory, "done.jsonl")
+        self.done_buffer = []  # 还没写入 done 文件的已完成文件
+        self.done_count = 0  # done 文件中的记录数
+
+    def exists(self) -> bool:
+        """是否存在上次未完成的扫描"""
+        return os.path.isfile(self.assets_file)
+
+    @staticmethod
+    def read_lines(file_path: str) -> set:
+        """读取日志文件，忽略（程序中断导致的）不完整的行"""
+        result = set()
+        if not os.path.isfile(file_path):
+            return result
+        with open(file_path, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    result.add(json.loads(line))
+                except ValueError:
+                    logger.warning(f"扫描日志中有无法解析的行，已忽略：{line!r}")
+        return result
+
+    def start(self, assets):
+        """
+        开始新的扫描，写入待扫描文件列表并清空 done 文件
+        :param assets: 待扫描的文件路径集合
+        """
+        os.makedirs(self.directory, exist_ok=True)
+        temp_file = self.assets_file + ".tmp"
+        with open(temp_file, "w", encoding="utf-8") as f:
+            for path in assets:
+                f.write(json.dumps(path) + "\n")
+        os.replace(temp_file, self.assets_file)  # 先写临时文件再替换，避免写到一半中断导致文件损坏
+        if os.path.isfile(self.done_file):
+            os.remove(self.done_file)
+        self.done_buffer = []
+        self.done_count = 0
+
+    def load(self) -> set:
+        """
+        读取上次未完成的扫描
+        :return: set, 剩余待扫描的文件路径
+        """
+        assets = self.read_lines(self.assets_file)
+        done = self.read_lines(self.done_file)
+        remaining = assets - done
+        self.start(remaining)  # 重新写入剩余文件，同时丢弃 done 文件中可能不完整的最后一行
+        return remaining
+
+    def add(self, path: str):
+        """标记文件已处理完成，在下次 flush 时写入"""
+        self.done_buffer.append(path)
+
+    def flush(self, remaining: set = None):
+        """
+        把已完成的文件追加写入 done 文件
+        :param remaining: set, 当前剩余待扫描的文件，传入时会在需要的时候压缩日志
+        """
+        if self.done_buffer:
+            with open(self.done_file, "a", encoding="utf-8") as f:
+                f.write("".join(json.dumps(path) + "\n" for path in self.done_buffer))
+            self.done_count += len(self.done_buffer)
+            self.done_buffer = []
+        if remaining is not None and self.done_count >= max(len(remaining), self.compact_min_records):
+            logger.debug(f"压缩扫描日志：已完成 {self.done_count} 个，剩余 {len(remaining)} 个")
+            self.start(remaining)
+
+    def clear(self):
+        """扫描完成，删除日志文件"""
+        for file_path in (self.assets_file, self.done_file):
+            if os.path.isfile(file_path):
+                os.remove(file_path)
+        self.done_buffer = []
+        self.done_count = 0
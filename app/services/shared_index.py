@@ -0,0 +1,260 @@
+# -*- coding: utf-8 -*-
+import json
+import logging
+import os
+import shutil
+import threading
+import time
+
+import numpy as np
+
+from app.config import SHARED_INDEX_PATH
+from app.models.database import get_image_index_rows, get_index_signature, get_video_index_rows
+from app.models.models import DatabaseSession
+
+logger = logging.getLogger(__name__)
+
+CHECK_INTERVAL = 1  # 工作进程检查索引版本的最小间隔，单位秒
+
+
+def get_timestamp(modify_time) -> float:
+    """
+    修改时间转换为时间戳。扫描时无法转换修改时间的文件没有修改时间，使用 NaN，按时间筛选时与数据库中的 NULL 一样不会被选中
+    """
+    return modify_time.timestamp() if modify_time is not None else float("nan")
+
+
+def write_feature_rows(directory: str, name: str, count: int, rows, feature_index: int):
+    """
+    把查询结果中的特征逐行写入 .npy 文件，不需要先把全部特征读入内存
+    扫描在发布过程中增删素材时，实际行数可能与 count 不同：多出的行不写入，缺少的行在读取时按 meta.json 中的行数截掉
+    :param count: int, 预计的行数，用于预先分配文件大小
+    :param rows: 查询结果的行生成器
+    :param feature_index: int, 特征在行中的位置
+    :return: 生成器，返回已写入特征的行
+    """
+    features = None
+    written = 0
+    for row in rows:
+        if written >= count:
+            break
+        feature = np.frombuffer(row[feature_index], dtype=np.float32)
+        if features is None:
+            features = np.lib.format.open_memmap(
+                os.path.join(directory, f"{name}.npy"), mode="w+", dtype=np.float32, shape=(count, len(feature)))
+        features[written] = feature
+        written += 1
+        yield row
+    if features is None:
+        np.save(os.path.join(directory, f"{name}.npy"), np.zeros((0, 0), dtype=np.float32))
+    else:
+        features.flush()
+        del features
+
+
+class IndexSnapshot:
+    """
+    已发布的一个版本的索引。特征矩阵以只读 mmap 方式打开，所有工作进程共用操作系统的页缓存，内存占用不随进程数增加；
+    路径列表较小，每个进程各读一份
+    """
+
+    def __init__(self, directory: str):
+        with open(os.path.join(directory, "meta.json"), encoding="utf-8") as f:
+            meta = json.load(f)
+        self.version = os.path.basename(directory)
+        image_count, frame_count = meta["images"], meta["video_frames"]
+
+        def load(name, count):
+            return np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")[:count]
+
+        self.image_features = load("image_features", image_count)
+        self.image_ids = load("image_ids", image_count)
+        self.image_times = load("image_times", image_count)
+        self.video_features = load("video_features", frame_count)
+        self.video_frame_times = load("video_frame_times", frame_count)
+        self.video_offsets = np.load(os.path.join(directory, "video_offsets.npy"))
+        self.video_ids = np.load(os.path.join(directory, "video_ids.npy"))
+        self.video_times = np.load(os.path.join(directory, "video_times.npy"))
+        with open(os.path.join(directory, "paths.json"), encoding="utf-8") as f:
+            paths = json.load(f)
+        self.image_paths = paths["images"][:image_count]
+        self.video_paths = paths["videos"]
+
+    @staticmethod
+    def get_mask(paths: list, times: np.ndarray, filter_path: str, start_time: int, end_time: int) -> np.ndarray:
+        """按路径和修改时间筛选，与数据库查询的条件一致（路径不区分大小写）"""
+        mask = np.ones(len(paths), dtype=bool)
+        if start_time:
+            mask &= times >= start_time
+        if end_time:
+            mask &= times <= end_time
+        if filter_path:
+            filter_path = filter_path.lower()
+            mask &= np.fromiter((filter_path in path.lower() for path in paths), dtype=bool, count=len(paths))
+        return mask
+
+    def filter_images(self, filter_path: str, start_time: int, end_time: int):
+        """
+        根据路径和时间筛选图片
+        :return: (id列表, 路径列表, 特征矩阵)。没有筛选条件时特征矩阵直接使用 mmap，不复制
+        """
+        mask = self.get_mask(self.image_paths, self.image_times, filter_path, start_time, end_time)
+        if mask.all():
+            return self.image_ids.tolist(), self.image_paths, self.image_features
+        paths = [path for path, selected in zip(self.image_paths, mask) if selected]
+        return self.image_ids[mask].tolist(), paths, self.image_features[mask]
+
+    def iter_videos(self, filter_path: str, start_time: int, end_time: int):
+        """
+        根据路径和时间筛选视频
+        :return: 生成器，每个视频返回 (路径, 视频id, 帧时间列表, 特征矩阵)
+        """
+        mask = self.get_mask(self.video_paths, self.video_times, filter_path, start_time, end_time)
+        for i in np.flatnonzero(mask):
+            start, end = self.video_offsets[i], self.video_offsets[i + 1]
+            yield self.video_paths[i], int(self.video_ids[i]), self.video_frame_times[start:end].tolist(), self.video_features[start:end]
+
+
+class SharedIndex:
+    """
+    多进程部署时的共享搜索索引
+    主进程从数据库读取所有特征，写成 .npy 文件发布到 SHARED_INDEX_PATH 下的一个新版本目录，再原子地更新 current 指针；
+    工作进程通过 attach() 启用后，以只读 mmap 方式打开当前版本搜索，不再每次搜索都从数据库读取特征。
+    发布新版本后旧版本目录会被删除，已经打开旧版本的进程在 Linux/macOS 上仍可以继续读取，直到切换到新版本。
+    """
+
+    def __init__(self, directory: str = SHARED_INDEX_PATH):
+        self.directory = os.path.abspath(directory)
+        self.attached = False
+        self.snapshot = None
+        self.checked_at = 0
+        self.published_signature = None
+        self.lock = threading.Lock()
+
+    @property
+    def pointer_path(self) -> str:
+        return os.path.join(self.directory, "current")
+
+    @property
+    def status_path(self) -> str:
+        return os.path.join(self.directory, "status.json")
+
+    def publish(self) -> str:
+        """
+        从数据库读取特征并发布一个新版本
+        :return: str, 新版本号
+        """
+        t0 = time.time()
+        version = str(int(t0 * 1000))
+        temp_dir = os.path.join(self.directory, f"{version}.tmp")
+        os.makedirs(temp_dir, exist_ok=True)
+        with DatabaseSession() as session:
+            signature = get_index_signature(session)
+            count, rows = get_image_index_rows(session)
+            image_ids, image_paths, image_times = [], [], []
+            for id, path, modify_time, _ in write_feature_rows(temp_dir, "image_features", count, rows, 3):
+                image_ids.append(id)
+                image_paths.append(path)
+                image_times.append(get_timestamp(modify_time))
+            count, rows = get_video_index_rows(session)
+            frame_times, video_paths, video_ids, video_times, offsets = [], [], [], [], []
+            for id, path, frame_time, modify_time, _ in write_feature_rows(temp_dir, "video_features", count, rows, 4):
+                if not video_paths or video_paths[-1] != path:
+                    video_paths.append(path)
+                    video_ids.append(id)
+                    video_times.append(get_timestamp(modify_time))
+                    offsets.append(len(frame_times))
+                video_ids[-1] = min(video_ids[-1], id)  # 与 get_video_id_by_path 一致，取最小的id
+                frame_times.append(frame_time)
+            offsets.append(len(frame_times))
+        np.save(os.path.join(temp_dir, "image_ids.npy"), np.array(image_ids, dtype=np.int64))
+        np.save(os.path.join(temp_dir, "image_times.npy"), np.array(image_times, dtype=np.float64))
+        np.save(os.path.join(temp_dir, "video_frame_times.npy"), np.array(frame_times, dtype=np.int64))
+        np.save(os.path.join(temp_dir, "video_offsets.npy"), np.array(offsets, dtype=np.int64))
+        np.save(os.path.join(temp_dir, "video_ids.npy"), np.array(video_ids, dtype=np.int64))
+        np.save(os.path.join(temp_dir, "video_times.npy"), np.array(video_times, dtype=np.float64))
+        with open(os.path.join(temp_dir, "paths.json"), "w", encoding="utf-8") as f:
+            json.dump({"images": image_paths, "videos": video_paths}, f, ensure_ascii=False)
+        with open(os.path.join(temp_dir, "meta.json"), "w", encoding="utf-8") as f:
+            json.dump({"images": len(image_ids), "video_frames": len(frame_times)}, f)
+        os.replace(temp_dir, os.path.join(self.directory, version))
+        self.write_file(self.pointer_path, version)
+        self.published_signature = signature
+        for name in os.listdir(self.directory):  # 删除旧版本
+            path = os.path.join(self.directory, name)
+            if name != version and os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+        logger.info(f"共享索引已发布：版本 {version}，{len(image_ids)} 张图片，{len(video_paths)} 个视频，"
+                    f"{len(frame_times)} 帧，耗时 {time.time() - t0:.2f}s")
+        return version
+
+    def publish_if_changed(self) -> bool:
+        """数据库中的素材有变化时发布新版本，返回是否发布"""
+        with DatabaseSession() as session:
+            signature = get_index_signature(session)
+        if signature == self.published_signature:
+            return False
+        self.publish()
+        return True
+
+    @staticmethod
+    def write_file(path: str, content: str):
+        """先写临时文件再替换，读取的进程不会读到写了一半的内容"""
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            f.write(content)
+        os.replace(temp_path, path)
+
+    def write_status(self, status: dict):
+        """主进程保存扫描状态，供工作进程的 /api/status 读取"""
+        self.write_file(self.status_path, json.dumps(status, ensure_ascii=False))
+
+    def read_status(self):
+        """读取主进程保存的扫描状态，没有时返回 None"""
+        try:
+            with open(self.status_path, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def attach(self):
+        """工作进程调用，之后搜索使用共享索引"""
+        self.attached = True
+        self.refresh()
+
+    def refresh(self) -> bool:
+        """
+        检查是否发布了新版本，有则切换，最多每 CHECK_INTERVAL 秒检查一次
+        :return: bool, 是否切换了版本（切换后需要清空搜索缓存）
+        """
+        if not self.attached or time.time() - self.checked_at < CHECK_INTERVAL:
+            return False
+        with self.lock:
+            self.checked_at = time.time()
+            try:
+                with open(self.pointer_path, encoding="utf-8") as f:
+                    version = f.read().strip()
+            except OSError:
+                return False
+            if self.snapshot is not None and self.snapshot.version == version:
+                return False
+            try:
+                self.snapshot = IndexSnapshot(os.path.join(self.directory, version))
+            except (OSError, ValueError, KeyError) as e:  # 刚好被更新的版本替换，下次再读取
+                logger.warning(f"读取共享索引版本 {version} 失败：{repr(e)}")
+                return False
+        logger.info(f"已切换到共享索引版本 {version}")
+        return True
+
+    def get(self):
+        """
+        获取当前版本的索引
+        :return: IndexSnapshot，未启用或还没有发布时返回 None（从数据库读取）
+        """
+        if not self.attached:
+            return None
+        self.refresh()
+        return self.snapshot
+
+
+shared_index = SharedIndex()
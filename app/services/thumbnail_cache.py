@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import logging
+from io import BytesIO
+
+from app.config import THUMBNAIL_CACHE_PATH, THUMBNAIL_CACHE_SIZE, THUMBNAIL_FORMAT, VIDEO_POSTER_CACHE_SIZE, VIDEO_POSTER_PATH
+from app.services.file_cache import FileCache
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_SIZE = (640, 480)  # 缩略图最大宽高
+THUMBNAIL_QUALITY = 60  # 缩略图压缩质量
+THUMBNAIL_MIMETYPES = {"webp": "image/webp", "jpeg": "image/jpeg"}
+POSTER_SIZE = (320, 240)  # 视频预览图最大宽高
+
+
+def choose_thumbnail_format(accept_mimetypes) -> str:
+    """
+    根据 THUMBNAIL_FORMAT 和浏览器的 Accept 请求头选择缩略图格式
+    :param accept_mimetypes: werkzeug 的 MIMEAccept 对象
+    :return: str, webp 或 jpeg
+    """
+    if THUMBNAIL_FORMAT in THUMBNAIL_MIMETYPES:
+        return THUMBNAIL_FORMAT
+    return "webp" if accept_mimetypes["image/webp"] else "jpeg"
+
+
+def get_default_format() -> str:
+    """扫描时预先生成缩略图使用的格式，auto 时使用绝大多数浏览器都支持的 webp"""
+    return THUMBNAIL_FORMAT if THUMBNAIL_FORMAT in THUMBNAIL_MIMETYPES else "webp"
+
+
+def encode_thumbnail(image, fmt: str) -> bytes:
+    """
+    把缩略图编码成 JPEG 或 WebP。WebP 保留透明通道，JPEG 转换成 RGB
+    :param image: PIL.Image, 缩小后的图片
+    :param fmt: str, webp 或 jpeg
+    :return: bytes, 编码后的数据
+    """
+    image_io = BytesIO()
+    if fmt == "webp":
+        image = image.convert("RGBA" if image.mode in ("RGBA", "LA", "P") else "RGB")
+        image.save(image_io, "WEBP", quality=THUMBNAIL_QUALITY)
+    else:
+        image.convert("RGB").save(image_io, "JPEG", quality=THUMBNAIL_QUALITY)
+    return image_io.getvalue()
+
+
+class ThumbnailCache(FileCache):
+    """
+    缩略图磁盘缓存
+    以 图片id + 修改时间/校验值 + 尺寸 + 格式 的哈希作为键（同时用作 ETag），文件变化后键也会变化，不会读到旧的缩略图。
+    总大小超过上限时按最近使用时间淘汰，见 FileCache。
+    """
+
+    def __init__(self, directory: str = THUMBNAIL_CACHE_PATH, max_size_mb: int = THUMBNAIL_CACHE_SIZE):
+        super().__init__(directory, max_size_mb)
+
+    @staticmethod
+    def get_key(asset_id, modify_time, checksum: str, fmt: str, size: tuple = THUMBNAIL_SIZE) -> str:
+        """
+        计算缩略图的键
+        :param asset_id: 图片id，或视频路径和帧时间，见 get_poster_key
+        """
+        raw = f"{asset_id}|{modify_time}|{checksum or ''}|{size[0]}x{size[1]}|{fmt}"
+        return hashlib.sha1(raw.encode()).hexdigest()
+
+    def get_or_create(self, key: str, fmt: str, create_image):
+        """
+        读取缩略图，没有缓存时调用 create_image 生成并保存
+        :param create_image: 函数，返回缩小后的 PIL.Image
+        :return: 缩略图文件路径；不缓存时返回 BytesIO
+        """
+        if not self.enabled:
+            return BytesIO(encode_thumbnail(create_image(), fmt))
+        path = self.get(key, fmt)
+        if path is None:
+            path = self.put(key, fmt, encode_thumbnail(create_image(), fmt))
+        return path
+
+
+def get_poster_key(path: str, frame_time: int, modify_time, checksum: str) -> str:
+    """
+    计算视频预览图的键。扫描时视频还没有写入数据库，所以用视频路径而不是id
+    :param path: str, 视频路径
+    :param frame_time: int, 帧所在的时间，单位秒
+    """
+    return ThumbnailCache.get_key(f"{path}|{frame_time}", modify_time, checksum, "jpeg", POSTER_SIZE)
+
+
+thumbnail_cache = ThumbnailCache()
+poster_cache = ThumbnailCache(VIDEO_POSTER_PATH, VIDEO_POSTER_CACHE_SIZE)  # 视频预览图缓存
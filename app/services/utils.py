@@ -1,18 +1,27 @@
 import hashlib
 import logging
+import os
 import platform
 import subprocess
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import wraps
 
 import numpy as np
 from PIL import Image, ImageOps
 from pillow_heif import register_heif_opener
 
-from app.config import LOG_LEVEL
+from app.config import CHECKSUM_MODE, LOG_LEVEL
 
 logging.basicConfig(level=LOG_LEVEL, format='%(asctime)s %(name)s %(levelname)s %(message)s')
 logger = logging.getLogger(__name__)
 register_heif_opener()
 
+FINGERPRINT_PREFIX = "fp:"  # 文件指纹的前缀，用于和SHA1区分
+FINGERPRINT_CHUNK_SIZE = 65536  # 计算文件指纹时每块读取的字节数
+FINGERPRINT_MIDDLE_CHUNKS = 4  # 计算文件指纹时在文件中间等距读取的块数
+
 
 def get_hash(bytesio):
     """
@@ -62,6 +71,127 @@ def get_file_hash(file_path):
         return None
 
 
+def get_file_fingerprint(file_path):
+    """
+    计算文件指纹：只读取文件大小以及头部、尾部和中间等距的若干块数据计算hash，不读取整个文件
+    对于小文件（不超过所有采样块的总大小）则读取整个文件
+    :param file_path: string, 文件路径
+    :return: string, "fp:" 加上十六进制hash，或 None（文件读取错误）
+    """
+    _hash = hashlib.blake2b(digest_size=16)
+    try:
+        size = os.path.getsize(file_path)
+        _hash.update(size.to_bytes(8, "little"))
+        with open(file_path, 'rb') as f:
+            if size <= FINGERPRINT_CHUNK_SIZE * (FINGERPRINT_MIDDLE_CHUNKS + 2):
+                _hash.update(f.read())
+            else:
+                step = size // (FINGERPRINT_MIDDLE_CHUNKS + 1)
+                offsets = [0] + [step * i for i in range(1, FINGERPRINT_MIDDLE_CHUNKS + 1)] + [size - FINGERPRINT_CHUNK_SIZE]
+                for offset in offsets:
+                    f.seek(offset)
+                    _hash.update(f.read(FINGERPRINT_CHUNK_SIZE))
+        return FINGERPRINT_PREFIX + _hash.hexdigest()
+    except Exception as e:
+        logger.error(f"计算文件指纹出错：{file_path} {repr(e)}")
+        return None
+
+
+def get_file_checksum(file_path):
+    """
+    根据 CHECKSUM_MODE 计算文件校验值，fingerprint 模式计算文件指纹，sha1 模式计算整个文件的SHA1
+    :param file_path: string, 文件路径
+    :return: string, 校验值，或 None（文件读取错误）
+    """
+    if CHECKSUM_MODE == "sha1":
+        return get_file_hash(file_path)
+    return get_file_fingerprint(file_path)
+
+
+def is_same_checksum_type(checksum1: str, checksum2: str) -> bool:
+    """判断两个校验值是否由同一种方式计算（都是文件指纹或都是SHA1），不同方式的校验值不能直接比较"""
+    return checksum1.startswith(FINGERPRINT_PREFIX) == checksum2.startswith(FINGERPRINT_PREFIX)
+
+
+def thread_pool_map(func, iterable, max_workers, prefetch=None):
+    """
+    用线程池按顺序计算 func(item)，与 executor.map 不同的是最多只提前提交 prefetch 个任务，可以边遍历边计算，中途停止也不会浪费太多
+    :param func: 函数
+    :param iterable: 可迭代对象
+    :param max_workers: int, 线程数
+    :param prefetch: int, 最多同时提交的任务数，默认为线程数的4倍
+    :return: 生成器，按顺序返回 (item, func(item)) 元组
+    """
+    prefetch = prefetch or max_workers * 4
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        try:
+            for item in iterable:
+                pending.append((item, executor.submit(func, item)))
+                if len(pending) >= prefetch:
+                    item, future = pending.popleft()
+                    yield item, future.result()
+            for item, future in pending:
+                yield item, future.result()
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+
+class SingleFlight:
+    """
+    合并相同的并发调用：同一个键同时只执行一次，其余调用等待第一次执行完成并共享结果（或异常）
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}  # 正在执行的调用，键 -> Future
+        self.executed = 0  # 实际执行的次数
+        self.coalesced = 0  # 被合并、直接等待其它调用结果的次数
+
+    def do(self, key, func, *args, **kwargs):
+        """
+        执行 func(*args, **kwargs)，如果相同 key 的调用正在执行，则等待并返回它的结果
+        :param key: 可哈希的调用键
+        """
+        with self.lock:
+            future = self.calls.get(key)
+            is_leader = future is None
+            if is_leader:
+                future = self.calls[key] = Future()
+                self.executed += 1
+            else:
+                self.coalesced += 1
+        if not is_leader:
+            logger.debug(f"合并相同的并发调用：{key}")
+            return future.result()
+        try:
+            result = func(*args, **kwargs)
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+    def wrap(self, func):
+        """装饰器，按函数名和参数合并相同的并发调用"""
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            return self.do((func.__name__, args, tuple(sorted(kwargs.items()))), func, *args, **kwargs)
+
+        return wrapper
+
+    def get_stats(self) -> dict:
+        """获取统计信息"""
+        with self.lock:
+            return {"executed": self.executed, "coalesced": self.coalesced, "in_flight": len(self.calls)}
+
+
 def softmax(x):
     """
     计算softmax，使得每一个元素的范围都在(0,1)之间，并且所有元素的和为1。
@@ -91,7 +221,7 @@ def crop_video(input_file, output_file, start_time, end_time):
     :param output_file: 保存文件路径
     :param start_time: int, 开始时间，单位为秒
     :param end_time: int, 结束时间，单位为秒
-    :return: None
+    :return: bool, 是否截取成功
     """
     cmd = 'ffmpeg'
     if platform.system() == 'Windows':
@@ -103,14 +233,25 @@ def crop_video(input_file, output_file, start_time, end_time):
         '-i', input_file,
         '-c:v', 'copy',
         '-c:a', 'copy',
+        '-y',
         output_file
     ]
-    logger.info("Crop video:", " ".join(command))
-    subprocess.run(command)
+    logger.info(f"Crop video: {' '.join(command)}")
+    result = subprocess.run(command, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        logger.warning(f"截取视频失败：{input_file}，{result.stderr.decode(errors='ignore')[-500:]}")
+        return False
+    return True
 
 
 def resize_image_with_aspect_ratio(image_path, target_size, convert_rgb=False):
-    image = Image.open(image_path)
+    return resize_pil_image_with_aspect_ratio(Image.open(image_path), target_size, convert_rgb)
+
+
+def resize_pil_image_with_aspect_ratio(image, target_size, convert_rgb=False):
+    """
+    按比例缩小已打开的图片，用于扫描时直接从解码好的图片生成缩略图
+    """
     image = ImageOps.exif_transpose(image)  # 根据 EXIF 信息自动旋转图像
     if convert_rgb:
         image = image.convert('RGB')
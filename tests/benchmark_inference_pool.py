@@ -0,0 +1,48 @@
+# 多进程CPU推理基准测试，用于选择 SCAN_INFERENCE_PROCESSES 和 SCAN_INFERENCE_THREADS
+# 在项目根目录运行：python -m tests.benchmark_inference_pool
+import os
+import time
+from concurrent.futures import wait
+
+import numpy as np
+from PIL import Image
+
+from app.config import *
+from app.services.inference_pool import InferencePool
+
+test_times = 100  # 每种组合计算的批次数
+
+
+def benchmark(processes, threads, images):
+    """
+    测试一种进程数和线程数的组合
+    :return: float, 每秒处理的图片数量
+    """
+    pool = InferencePool(processes, threads)
+    pool.start()
+    wait([pool.submit(images) for _ in range(processes)])  # 等待所有进程加载模型
+    t0 = time.time()
+    wait([pool.submit(images) for _ in range(test_times)])
+    cost_time = time.time() - t0
+    pool.shutdown()
+    return test_times * len(images) / cost_time
+
+
+if __name__ == "__main__":
+    if DEVICE not in ("auto", "cpu"):
+        print("多进程推理只支持CPU，请设置 DEVICE=cpu")
+    image = Image.open(os.path.join(os.path.dirname(__file__), "test.png")).convert("RGB")
+    images = [np.array(image)] * SCAN_PROCESS_BATCH_SIZE
+    cpu_count = os.cpu_count()
+    combinations = sorted({(p, max(cpu_count // p, 1)) for p in (1, 2, 4, 8, 16) if p <= cpu_count})
+    print("*" * 50)
+    print(f"开始进行多进程CPU推理基准测试。CPU核心数：{cpu_count}，批大小：{SCAN_PROCESS_BATCH_SIZE}。速度越快越好。")
+    best_speed, recommend = 0, None
+    for processes, threads in combinations:
+        speed = benchmark(processes, threads, images)
+        print(f"进程数：{processes} 每进程线程数：{threads} 速度：{speed:.2f}张/秒")
+        if speed > best_speed:
+            best_speed, recommend = speed, (processes, threads)
+    print(f"建议设置：SCAN_INFERENCE_PROCESSES={recommend[0]} SCAN_INFERENCE_THREADS={recommend[1]}")
+    print("*" * 50)
+    print("测试完毕！")
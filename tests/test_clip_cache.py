@@ -0,0 +1,86 @@
+"""
+视频片段缓存的单元测试：多个工作进程共用同一个缓存目录时，用两个缓存对象模拟两个进程。
+截取函数替换为直接写文件，不需要 ffmpeg，也不需要启动服务。
+测试方法：在项目根目录执行 pytest tests/test_clip_cache.py
+"""
+
+import os
+import threading
+import time
+
+import app.services.clip_cache as clip_cache
+import app.services.file_cache as file_cache
+from app.services.clip_cache import ClipJob, ClipJobManager
+from app.services.file_cache import FileCache
+
+KB = 1024
+
+
+def test_temp_path_contains_pid(tmp_path):
+    assert f".{os.getpid()}-" in FileCache(str(tmp_path), 1).get_temp_path("ab" * 20, "mp4")
+
+
+def test_load_keeps_temp_files_being_written(tmp_path):
+    cache = FileCache(str(tmp_path), 1)
+    os.makedirs(tmp_path / "ab")
+    writing = tmp_path / "ab" / "key.1-2.tmp.mp4"
+    stale = tmp_path / "ab" / "old.1-2.tmp.mp4"
+    writing.write_bytes(b"x")
+    stale.write_bytes(b"x")
+    old = time.time() - file_cache.STALE_TEMP_SECONDS - 10
+    os.utime(stale, (old, old))
+    assert cache.get("key", "mp4") is None
+    assert writing.exists()
+    assert not stale.exists()
+
+
+def test_get_finds_file_written_by_other_process(tmp_path):
+    first, second = FileCache(str(tmp_path), 1), FileCache(str(tmp_path), 1)
+    assert second.get("key", "jpeg") is None
+    path = first.put("key", "jpeg", b"data")
+    assert second.get("key", "jpeg") == path
+    assert second.total_bytes == 4
+
+
+def test_size_limit_applies_across_processes(tmp_path, monkeypatch):
+    first, second = FileCache(str(tmp_path), 1), FileCache(str(tmp_path), 1)
+    assert second.get("a", "bin") is None  # 第二个进程先读取了缓存目录
+    old_path = first.put("a", "bin", b"x" * 600 * KB)
+    monkeypatch.setattr(file_cache, "RESCAN_SECONDS", 0)
+    new_path = second.put("b", "bin", b"x" * 600 * KB)
+    assert not os.path.exists(old_path)
+    assert os.path.exists(new_path)
+
+
+def test_job_is_shared_across_processes(tmp_path, monkeypatch):
+    calls = []
+    started = threading.Event()
+
+    def crop_video(path, output_path, start_time, end_time):
+        calls.append(output_path)
+        started.set()
+        time.sleep(0.5)
+        with open(output_path, "wb") as f:
+            f.write(b"clip")
+        return True
+
+    monkeypatch.setattr(clip_cache, "crop_video", crop_video)
+    monkeypatch.setattr(clip_cache, "LOCK_POLL_SECONDS", 0.05)
+    first, second = ClipJobManager(str(tmp_path), 10, 1), ClipJobManager(str(tmp_path), 10, 1)
+    job = first.submit("/videos/a.mp4", 1, None, 0, 5)
+    assert started.wait(5)
+
+    other = second.get_job(job.id)  # 在另一个进程中查询任务
+    assert other is not None
+    assert other.download_name == "0_5_a.mp4"
+    assert ClipJobManager.wait(job, 5) and ClipJobManager.wait(other, 5)
+    assert job.status == other.status == ClipJob.DONE
+    assert first.get_file(job) == second.get_file(other)
+    assert len(calls) == 1  # 只截取了一次
+    assert not os.path.exists(first.cache.get_side_path(job.id, "lock"))
+
+
+def test_unknown_job(tmp_path):
+    manager = ClipJobManager(str(tmp_path), 10, 1)
+    assert manager.get_job("0" * 40) is None
+    assert manager.get_job("../../etc") is None
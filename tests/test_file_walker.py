@@ -0,0 +1,73 @@
+"""
+目录遍历和目录缓存的单元测试，只使用临时目录，不需要启动服务。
+测试方法：在项目根目录执行 pytest tests/test_file_walker.py
+"""
+
+import datetime
+import os
+
+import app.services.file_walker as file_walker
+from app.services.file_walker import FileWalker
+
+
+def make_tree(tmp_path):
+    """创建 R/r.jpg 和 R/C/c.jpg"""
+    root = tmp_path / "R"
+    (root / "C").mkdir(parents=True)
+    (root / "r.jpg").write_bytes(b"r")
+    (root / "C" / "c.jpg").write_bytes(b"c")
+    return str(root), str(root / "C"), [str(root / "C" / "c.jpg"), str(root / "r.jpg")]
+
+
+def walk(root, *args):
+    walker = FileWalker((".jpg",), [], [])
+    return sorted(walker.walk([root], *args)), walker
+
+
+def test_walk_lists_all_files(tmp_path):
+    root, _, files = make_tree(tmp_path)
+    assert walk(root)[0] == files
+
+
+def test_walk_reuses_unchanged_dirs(tmp_path):
+    root, child, files = make_tree(tmp_path)
+    _, walker = walk(root)
+    known_files = {root: [files[1]], child: [files[0]]}
+    result, walker = walk(root, walker.dir_records, known_files)
+    assert result == files
+    assert walker.reused_dirs == 2
+
+
+def test_walk_relists_expired_child_of_cached_parent(tmp_path):
+    root, child, files = make_tree(tmp_path)
+    _, walker = walk(root)
+    now = datetime.datetime.now()
+    dir_cache = dict(walker.dir_records)
+    modify_time, file_count, _ = dir_cache[child]
+    dir_cache[child] = (modify_time, file_count, now - datetime.timedelta(days=30))  # 子目录的缓存已经过期，上级目录没有
+    known_files = {root: [files[1]], child: [files[0]]}
+    result, walker = walk(root, dir_cache, known_files, now - datetime.timedelta(days=7))
+    assert result == files
+    assert walker.reused_dirs == 1
+    assert walker.dir_records[child][2] > now  # 重新列出后更新了遍历时间
+
+
+def test_walk_relists_child_that_failed_last_time(tmp_path, monkeypatch):
+    root, child, files = make_tree(tmp_path)
+    scandir = os.scandir
+
+    def failing_scandir(path):
+        if path == child:
+            raise PermissionError(path)
+        return scandir(path)
+
+    with monkeypatch.context() as m:
+        m.setattr(file_walker.os, "scandir", failing_scandir)
+        result, walker = walk(root)
+    assert result == [files[1]]
+    assert walker.dir_records[child][0] is None  # 读取失败的目录也要记录下来
+
+    known_files = {root: [files[1]], child: [files[0]]}
+    result, walker = walk(root, walker.dir_records, known_files)
+    assert result == files
+    assert walker.reused_dirs == 1
@@ -0,0 +1,204 @@
+"""
+文件监控队列、文件移动和复用特征的单元测试。
+使用临时的 SQLite 数据库，推理函数替换为固定输出，不需要启动服务，也不加载模型。
+测试方法：在项目根目录执行 pytest tests/test_file_watcher.py
+"""
+
+import datetime
+import os
+import time
+
+import numpy as np
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import app.routes.scan as scan
+import app.services.file_watcher as file_watcher
+from app.models.database import add_images
+from app.models.models import BaseModel, Image
+from app.routes.scan import Scanner
+from app.services.file_watcher import FileWatcher, QueuedFile, get_file_stat
+
+
+@pytest.fixture
+def database_session(tmp_path, monkeypatch):
+    """临时数据库，文件监控中打开的 session 也使用这个数据库"""
+    engine = create_engine(f"sqlite:///{tmp_path / 'assets.db'}", connect_args={"check_same_thread": False})
+    BaseModel.metadata.create_all(bind=engine)
+    session_maker = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    monkeypatch.setattr(file_watcher, "DatabaseSession", session_maker)
+    yield session_maker
+    engine.dispose()
+
+
+@pytest.fixture
+def inference_calls(monkeypatch):
+    """替换推理函数，记录每次推理的图片路径"""
+    calls = []
+
+    def process_images(path_list, ignore_small_images=True, thumbnails=None):
+        calls.append(list(path_list))
+        return path_list, np.ones((len(path_list), 4), dtype=np.float32)
+
+    monkeypatch.setattr(file_watcher, "process_images", process_images)
+    monkeypatch.setattr(file_watcher, "get_inference_precision", lambda: "fp32")
+    return calls
+
+
+@pytest.fixture
+def watcher(monkeypatch):
+    monkeypatch.setattr(file_watcher, "FILE_WATCH_SETTLE_SECONDS", 1)
+    monkeypatch.setattr(file_watcher, "FILE_WATCH_MAX_RETRIES", 2)
+    return FileWatcher(Scanner())
+
+
+def write_file(path, data=b"image", age=60):
+    """写入文件，并把修改时间设为 age 秒之前（已经写完的文件）"""
+    with open(path, "wb") as f:
+        f.write(data)
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+    return str(path)
+
+
+def add_image_record(session, path, checksum=None, value=1.0):
+    modify_time = datetime.datetime.fromtimestamp(os.path.getmtime(path)) if os.path.exists(path) else datetime.datetime.now()
+    features = np.full(4, value, dtype=np.float32).tobytes()
+    return add_images(session, [(path, modify_time, checksum, features)])[0]
+
+
+def test_add_to_queue_merges_events(watcher, tmp_path):
+    path = write_file(tmp_path / "a.jpg")
+    watcher.add_to_queue(path, "created")
+    watcher.add_to_queue(path, "modified")
+    assert list(watcher.file_queue) == [path]
+    assert watcher.file_queue[path].event_type == "modified"
+    assert watcher.merged_events == 1
+
+
+def test_add_to_queue_drops_events_when_full(watcher, tmp_path, monkeypatch):
+    monkeypatch.setattr(file_watcher, "FILE_WATCH_QUEUE_SIZE", 2)
+    paths = [write_file(tmp_path / f"{i}.jpg") for i in range(3)]
+    for path in paths:
+        watcher.add_to_queue(path, "created")
+    watcher.add_to_queue(paths[0], "modified")  # 已经在队列中的文件仍然可以合并
+    assert list(watcher.file_queue) == paths[:2]
+    assert watcher.dropped_events == 1
+    assert watcher.merged_events == 1
+    assert watcher.overflowed
+
+
+def test_add_to_queue_chains_moves(watcher, tmp_path):
+    path = write_file(tmp_path / "c.jpg")
+    watcher.add_to_queue(str(tmp_path / "b.jpg"), "moved", old_path=str(tmp_path / "a.jpg"))
+    watcher.add_to_queue(path, "moved", old_path=str(tmp_path / "b.jpg"))
+    assert list(watcher.file_queue) == [path]
+    assert watcher.file_queue[path].old_path == str(tmp_path / "a.jpg")
+
+
+def test_add_to_queue_move_of_pending_file(watcher, tmp_path):
+    old_path = str(tmp_path / "a.jpg")
+    path = write_file(tmp_path / "b.jpg")
+    watcher.add_to_queue(old_path, "modified")
+    watcher.add_to_queue(path, "moved", old_path=old_path)
+    # 原路径的修改还没处理，数据库中的记录已经过时，不能直接移过来
+    assert watcher.file_queue[old_path].event_type == "deleted"
+    assert watcher.file_queue[path].event_type == "created"
+    assert watcher.file_queue[path].old_path is None
+
+
+def test_check_settled_stable_file(watcher, tmp_path):
+    path = write_file(tmp_path / "a.jpg")
+    files = {path: QueuedFile("created", get_file_stat(path))}
+    assert watcher.check_settled(files) == files
+    assert not watcher.file_queue
+
+
+def test_check_settled_growing_file(watcher, tmp_path):
+    path = write_file(tmp_path / "a.jpg")
+    queued = QueuedFile("created", get_file_stat(path))
+    write_file(path, b"image and more data")
+    assert watcher.check_settled({path: queued}) == {}
+    assert watcher.file_queue[path] is queued
+    assert queued.retries == 1
+    assert queued.stat == get_file_stat(path)
+    assert watcher.settle_retries == 1
+
+
+def test_check_settled_recently_modified_file(watcher, tmp_path):
+    path = write_file(tmp_path / "a.jpg", age=0)
+    assert watcher.check_settled({path: QueuedFile("created", get_file_stat(path))}) == {}
+    assert path in watcher.file_queue
+
+
+def test_check_settled_missing_file(watcher, tmp_path):
+    path = str(tmp_path / "a.jpg")
+    settled = watcher.check_settled({path: QueuedFile("created", None)})
+    assert settled[path].event_type == "deleted"
+    assert watcher.missing_files == 1
+
+
+def test_check_settled_gives_up_after_max_retries(watcher, tmp_path):
+    path = write_file(tmp_path / "a.jpg")
+    queued = QueuedFile("created", None)
+    queued.retries = file_watcher.FILE_WATCH_MAX_RETRIES
+    assert watcher.check_settled({path: queued}) == {}
+    assert not watcher.file_queue
+    assert watcher.unsettled_files == 1
+
+
+def test_process_files_moves_record(watcher, database_session, inference_calls, tmp_path):
+    old_path = str(tmp_path / "a.jpg")
+    path = write_file(tmp_path / "b.jpg")
+    with database_session() as session:
+        image_id = add_image_record(session, old_path)
+    watcher.process_files({path: QueuedFile("moved", get_file_stat(path), old_path)})
+    with database_session() as session:
+        assert session.query(Image.id, Image.path).all() == [(image_id, path)]
+    assert watcher.moved_files == 1
+    assert inference_calls == []
+
+
+def test_process_files_move_without_record_falls_back(watcher, database_session, inference_calls, tmp_path):
+    old_path = str(tmp_path / "a.jpg")
+    path = write_file(tmp_path / "b.jpg")
+    watcher.process_files({path: QueuedFile("moved", get_file_stat(path), old_path)})
+    with database_session() as session:
+        assert [path for path, in session.query(Image.path)] == [path]
+    assert watcher.moved_files == 0
+    assert inference_calls == [[path]]
+
+
+def test_process_files_deletes_record(watcher, database_session, inference_calls, tmp_path):
+    path = str(tmp_path / "a.jpg")
+    with database_session() as session:
+        add_image_record(session, path)
+    watcher.process_files({path: QueuedFile("deleted", None)})
+    with database_session() as session:
+        assert session.query(Image).count() == 0
+    assert inference_calls == []
+
+
+def test_split_duplicate_images(database_session, tmp_path, monkeypatch):
+    monkeypatch.setattr(scan, "REUSE_DUPLICATE_FEATURES", True)
+    modify_time = datetime.datetime.now()
+    with database_session() as session:
+        add_image_record(session, str(tmp_path / "a.jpg"), checksum="same", value=2.0)
+        file_infos = {
+            "copy.jpg": (modify_time, "same"),
+            "other.jpg": (modify_time, "other"),
+            "unchecked.jpg": (modify_time, None),
+        }
+        records, remaining = Scanner().split_duplicate_images(session, file_infos)
+    assert [(path, checksum) for path, _, checksum, _ in records] == [("copy.jpg", "same")]
+    assert np.frombuffer(records[0][3], dtype=np.float32).tolist() == [2.0] * 4
+    assert list(remaining) == ["other.jpg", "unchecked.jpg"]
+
+
+def test_split_duplicate_images_disabled(database_session, tmp_path, monkeypatch):
+    monkeypatch.setattr(scan, "REUSE_DUPLICATE_FEATURES", False)
+    with database_session() as session:
+        add_image_record(session, str(tmp_path / "a.jpg"), checksum="same")
+        file_infos = {"copy.jpg": (datetime.datetime.now(), "same")}
+        assert Scanner().split_duplicate_images(session, file_infos) == ([], file_infos)
@@ -0,0 +1,98 @@
+"""
+多进程模式的单元测试：杀掉一个工作进程后，重新启动的工作进程仍然可以搜索，并且只加载文字模型。
+推理函数和模型加载替换为固定输出，不加载模型。仅 Linux/macOS。
+测试方法：在项目根目录执行 pytest tests/test_prefork.py
+"""
+
+import json
+import os
+import signal
+import socket
+import time
+import urllib.request
+
+import numpy as np
+import pytest
+from flask import Flask
+
+import app.main as main
+import app.services.process_assets as process_assets
+from app.services.prefork import PreforkServer, prefork_supported
+
+pytestmark = pytest.mark.skipif(not prefork_supported(), reason="需要 os.fork")
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def load_models():
+    """代替真实的模型加载，记录加载的是完整模型还是文字模型，以及在哪个进程中加载"""
+    process_assets.clip_model = ("text" if process_assets.text_only else "full", os.getpid())
+
+
+def encode_texts(texts):
+    process_assets.ensure_models_loaded()
+    return np.zeros((len(texts), 4), dtype=np.float32)
+
+
+def get(url):
+    with urllib.request.urlopen(url, timeout=5) as response:
+        return json.load(response)
+
+
+def wait_for_worker(url, exclude_pid=None, timeout=20):
+    """等待工作进程可以处理请求，返回它的响应"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            result = get(url)
+        except OSError:
+            time.sleep(0.2)
+            continue
+        if result["pid"] != exclude_pid:
+            return result
+    raise TimeoutError(url)
+
+
+def test_respawned_worker_can_search(monkeypatch, tmp_path):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(process_assets, "load_models", load_models)
+    monkeypatch.setitem(process_assets.inference_worker.handlers, "text", encode_texts)
+    monkeypatch.setattr(main.shared_index, "attach", lambda: None)
+
+    app = Flask(__name__)
+
+    @app.route("/search")
+    def search():
+        process_assets.inference_worker.run("text", ["test"])
+        return {"pid": os.getpid(), "model": process_assets.clip_model[0]}
+
+    def master_init():
+        # 与主进程的初始化相同：加载完整模型并启动推理线程，之后重新启动的工作进程会继承这些状态
+        process_assets.ensure_models_loaded()
+        process_assets.start_inference_worker()
+        process_assets.inference_worker.run("text", ["warmup"])
+
+    port = get_free_port()
+    server = PreforkServer(app, "127.0.0.1", port, 1, worker_init=main.init_worker)
+    server.bind()
+    master_pid = os.fork()
+    if master_pid == 0:
+        try:
+            server.run(master_init=master_init)
+        finally:
+            os._exit(0)
+    server.sock.close()
+    url = f"http://127.0.0.1:{port}/search"
+    try:
+        first = wait_for_worker(url)
+        assert first["model"] == "text"
+        os.kill(first["pid"], signal.SIGKILL)
+        replacement = wait_for_worker(url, exclude_pid=first["pid"])
+        assert replacement["model"] == "text"
+    finally:
+        os.kill(master_pid, signal.SIGTERM)
+        os.waitpid(master_pid, 0)
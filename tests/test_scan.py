@@ -0,0 +1,70 @@
+"""
+扫描的单元测试，使用临时的 SQLite 数据库和临时目录，不需要启动服务，也不加载模型。
+测试方法：在项目根目录执行 pytest tests/test_scan.py
+"""
+
+import datetime
+import os
+
+import numpy as np
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import app.main as main
+import app.routes.scan as scan
+from app.models.database import add_images
+from app.models.models import BaseModel, Image
+from app.routes.scan import Scanner
+
+
+@pytest.fixture
+def database_session(tmp_path):
+    engine = create_engine(f"sqlite:///{tmp_path / 'assets.db'}", connect_args={"check_same_thread": False})
+    BaseModel.metadata.create_all(bind=engine)
+    yield sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    engine.dispose()
+
+
+def test_streaming_scan_removes_file_vanished_during_scan(database_session, tmp_path, monkeypatch):
+    root = tmp_path / "assets"
+    root.mkdir()
+    paths = []
+    with database_session() as session:
+        for name in ("a.jpg", "b.jpg"):
+            path = root / name
+            path.write_bytes(b"image")
+            modify_time = datetime.datetime.fromtimestamp(os.path.getmtime(path))
+            add_images(session, [(str(path), modify_time, None, np.ones(4, dtype=np.float32).tobytes())])
+            paths.append(str(path))
+    monkeypatch.setattr(scan, "ASSETS_PATH", (str(root),))
+    monkeypatch.setattr(scan, "SCAN_STREAMING", True)
+    scanner = Scanner()
+    scanner.skip_paths = []
+    get_file_info = scanner.get_file_info
+    # b.jpg 在遍历之后、读取文件信息之前被删除
+    monkeypatch.setattr(scanner, "get_file_info", lambda path: None if path == paths[1] else get_file_info(path))
+
+    with database_session() as session:
+        assert scanner.scan_streaming(session, {})
+        assert [path for path, in session.query(Image.path)] == [paths[0]]
+
+
+def test_scan_resumes_after_restart(tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "TEMP_PATH", str(tmp_path / "tmp"))
+    monkeypatch.setattr(scan, "SCAN_JOURNAL_PATH", str(tmp_path / "scan_journal"))
+    monkeypatch.setattr(scan, "SCAN_STREAMING", False)
+    assets = {"a.jpg", "b.jpg", "c.jpg"}
+    # 上次扫描处理完 a.jpg 后中断
+    scanner = Scanner()
+    scanner.assets = set(assets)
+    scanner.journal.start(assets)
+    scanner.finish_asset("a.jpg")
+    scanner.save_assets()
+
+    main.clean_temp_path()  # 重启时清空临时目录
+    scanner = Scanner()
+    monkeypatch.setattr(scanner, "scan_dir", lambda: pytest.fail("不应重新遍历目录"))
+    scanner.generate_or_load_assets()
+    assert scanner.is_continue_scan
+    assert scanner.assets == {"b.jpg", "c.jpg"}
@@ -0,0 +1,54 @@
+"""
+共享索引的单元测试，使用临时的 SQLite 数据库和临时目录，不需要启动服务，也不加载模型。
+测试方法：在项目根目录执行 pytest tests/test_shared_index.py
+"""
+
+import datetime
+
+import numpy as np
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+import app.services.shared_index as shared_index_module
+from app.models.database import add_images, add_video
+from app.models.models import BaseModel
+from app.services.shared_index import SharedIndex
+
+MODIFY_TIME = datetime.datetime(2024, 1, 1)
+
+
+@pytest.fixture
+def database_session(tmp_path, monkeypatch):
+    engine = create_engine(f"sqlite:///{tmp_path / 'assets.db'}", connect_args={"check_same_thread": False})
+    BaseModel.metadata.create_all(bind=engine)
+    session_maker = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    monkeypatch.setattr(shared_index_module, "DatabaseSession", session_maker)
+    yield session_maker
+    engine.dispose()
+
+
+def features(value):
+    return np.full(4, value, dtype=np.float32).tobytes()
+
+
+def test_publish_rows_without_modify_time(database_session, tmp_path):
+    with database_session() as session:
+        add_images(session, [("a.jpg", MODIFY_TIME, None, features(1)), ("b.jpg", None, "checksum", features(2))])
+        add_video(session, "a.mp4", MODIFY_TIME, None, [(0, features(3))])
+        add_video(session, "b.mp4", None, "checksum", [(0, features(4)), (2, features(5))])
+
+    index = SharedIndex(str(tmp_path / "shared_index"))
+    index.publish()
+    index.attach()
+    snapshot = index.get()
+
+    ids, paths, image_features = snapshot.filter_images("", 0, 0)
+    assert paths == ["a.jpg", "b.jpg"]
+    assert image_features.shape == (2, 4)
+    assert [path for path, *_ in snapshot.iter_videos("", 0, 0)] == ["a.mp4", "b.mp4"]
+
+    # 与数据库查询一样，按时间筛选时没有修改时间的文件不会被选中
+    start_time = int(MODIFY_TIME.timestamp()) - 10
+    assert snapshot.filter_images("", start_time, 0)[1] == ["a.jpg"]
+    assert [path for path, *_ in snapshot.iter_videos("", start_time, 0)] == ["a.mp4"]